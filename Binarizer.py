@@ -8,11 +8,90 @@ These thresholds are set to 0.5 as default and can be optimized using AUC score
 """
 from datasetGenerator import DCASE2018
 import numpy as np
-import copy
+import json
 import sys
 from sklearn.metrics import recall_score, precision_score, f1_score, roc_curve
 
 
+class ThresholdSearch:
+    """
+    Per class F1 score of any threshold, computed from the sorted scores and the cumulative number of true positives.
+
+    The scores of each class are sorted once (O(N log N)), then the F1 of a batch of thresholds only needs a binary
+    search (no binarization of the prediction and no call to sklearn).
+    """
+
+    def __init__(self, y_true: np.array, prediction_result: np.array):
+        """
+        :param y_true: ground truth, 2-dimension array (<nb file>, <nb class>)
+        :param prediction_result: 2-dimension numpy array not binarized
+        """
+        prediction_result = np.asarray(prediction_result, dtype=np.float64)
+        y_true = np.asarray(y_true) > 0
+
+        order = np.argsort(prediction_result, axis=0, kind="mergesort")
+        self.nbFile, self.nbClass = prediction_result.shape
+
+        # ascending scores and number of positives among the k lowest scores (k = 0 .. nbFile)
+        self.scores = np.take_along_axis(prediction_result, order, axis=0)
+        sorted_true = np.take_along_axis(y_true, order, axis=0)
+        self.cumPositive = np.concatenate((np.zeros((1, self.nbClass)), np.cumsum(sorted_true, axis=0)))
+        self.positive = self.cumPositive[-1]
+
+    def __f1(self, nb_below: np.array, cls: int) -> np.array:
+        # the predicted positives are the scores above the nb_below lowest ones
+        true_positive = self.positive[cls] - self.cumPositive[nb_below, cls]
+        predicted_positive = self.nbFile - nb_below
+        denominator = predicted_positive + self.positive[cls]
+
+        return np.divide(2 * true_positive, denominator, out=np.zeros(denominator.shape), where=denominator > 0)
+
+    def f1(self, thresholds: np.array) -> np.array:
+        """
+        Batched F1 kernel.
+        :param thresholds: (..., <nb class>) array, several set of thresholds can be evaluated at once
+        :return: (..., <nb class>) array of F1 score (prediction > threshold is positive)
+        """
+        thresholds = np.asarray(thresholds, dtype=np.float64)
+        output = np.empty(thresholds.shape)
+
+        for cls in range(self.nbClass):
+            nb_below = np.searchsorted(self.scores[:, cls], thresholds[..., cls], side="right")
+            output[..., cls] = self.__f1(nb_below, cls)
+
+        return output
+
+    def best(self) -> tuple:
+        """
+        Exact search of the threshold maximizing the F1 of each class.
+        :return: the thresholds and their F1 score, two 1-dimension arrays
+        """
+        thresholds = np.empty(self.nbClass)
+        best_f1 = np.empty(self.nbClass)
+
+        for cls in range(self.nbClass):
+            scores = self.scores[:, cls]
+            nb_below = np.arange(self.nbFile + 1)
+            f1 = self.__f1(nb_below, cls)
+
+            # only the cut between two different scores can be reached by a threshold
+            valid = np.ones(self.nbFile + 1, dtype=bool)
+            valid[1:-1] = scores[:-1] < scores[1:]
+            f1[~valid] = -1
+
+            k = int(np.argmax(f1))
+            best_f1[cls] = f1[k]
+
+            if k == 0:
+                thresholds[cls] = np.nextafter(scores[0], -np.inf)
+            elif k == self.nbFile:
+                thresholds[cls] = scores[-1]
+            else:
+                thresholds[cls] = (scores[k - 1] + scores[k]) / 2
+
+        return thresholds, best_f1
+
+
 class Binarizer(object):
     _instance = None
     _exist = False
@@ -37,24 +116,28 @@ class Binarizer(object):
         for key in DCASE2018.class_correspondance:
             self.thresholds[key] = 0.5
 
-    def optimize(self, y_true: np.array, prediction_result: np.array, method: str = "simulated_annealing"):
+    def optimize(self, y_true: np.array, prediction_result: np.array, method: str = "exact"):
         """ Find the best thresholds for each classes with different methods available.
 
         methods available are
+            - "exact" -> the threshold maximizing the F1 score of each class (exhaustive search on the sorted scores)
+            - "simulated_annealing" -> random search of the thresholds maximizing the average F1 score
             - "metrics" -> use the precision, recall and f1 score to set the "optimized thresholds"
             - "auc" -> use the Aera Under the Curve methods to set the optimized thresholds
 
         :param y_true: ground truth
         :param prediction_result: 2-dimension numpy array not binarized
-        :param method: methods to use for the threshold optimization: "metrics" | "auc"
+        :param method: methods to use for the threshold optimization: "exact" | "simulated_annealing" | "metrics" | "auc"
         """
-        _method = ["metrics", "auc", "simulated_annealing"]
+        _method = ["metrics", "auc", "simulated_annealing", "exact"]
         if method == _method[0]:
             optimizer = self.__metrics_optimization
         elif method == _method[1]:
             optimizer = self.__aucOptimization
         elif method == _method[2]:
             optimizer = self.__simulated_annealing_optimization
+        elif method == _method[3]:
+            optimizer = self.__exact_optimization
         else:
             # TODO change sys.exit by raise
             print("Can't binarize on a array of dimension different that 2 or 3")
@@ -67,61 +150,55 @@ class Binarizer(object):
         optimizer(y_true, prediction_result)
         self.optimized = True
 
-    def __simulated_annealing_optimization(self, y_true, prediction_result: np.array):
-        def apply_threshold(thresh: list, prediction: np.array) -> list:
-            pred = copy.copy(prediction)
-
-            for clsInd in range(len(pred.T)):
-                pred.T[clsInd][pred.T[clsInd] > thresh[clsInd]] = 1
-                pred.T[clsInd][pred.T[clsInd] <= thresh[clsInd]] = 0
+    def __setThresholds(self, thresholds: np.array):
+        cpt = 0
+        for key in self.thresholds:
+            self.thresholds[key] = float(thresholds[cpt])
+            cpt += 1
 
-            return pred
+    def __exact_optimization(self, y_true: np.array, prediction_result: np.array):
+        thresholds, _ = ThresholdSearch(y_true, prediction_result).best()
+        self.__setThresholds(thresholds)
 
-        def init_thresholds():
-            return np.array([random.randint(40, 60) / 100 for _ in range(10)])
+    def __simulated_annealing_optimization(self, y_true, prediction_result: np.array):
+        # all the annealing (meta iteration) are run together, one F1 evaluation per iteration for all of them
+        search = ThresholdSearch(y_true, prediction_result)
+        nb_class = search.nbClass
 
         def gaussian(x, mu, sig):
             return np.exp(-np.power(x - mu, 2.) / (2 * np.power(sig, 2.)))
 
         def calc_delta(thresholds, weight):
-            output = []
-            for th in thresholds:
-                g = gaussian(th, 0.5, 0.08)
-                output.append((random.random() * 2 * g - g) * weight)
-            return np.array(output)
+            g = gaussian(thresholds, 0.5, 0.08)
+            return (np.random.random(thresholds.shape) * 2 * g - g) * weight
 
         # initialization
-        thresholds = [0.5 for _ in range(10)]
-        pred0 = apply_threshold(thresholds, prediction_result)
-        f10 = f1_score(pred0, y_true, average=None)
+        thresholds = np.full(nb_class, 0.5)
+        f10 = search.f1(thresholds)
 
         best = {"thresholds": thresholds, "mean f1": f10.mean(), "f1": f10}
 
         meta_iter = 100
         nb_iter = 30
 
-        for j in range(meta_iter):
-            thresholds = init_thresholds()
-            weight = 0.07
-            decay = weight / (nb_iter * 1.9)
+        thresholds = np.random.randint(40, 61, size=(meta_iter, nb_class)) / 100
+        weight = 0.07
+        decay = weight / (nb_iter * 1.9)
 
-            for i in range(nb_iter):
-                delta = calc_delta(thresholds, weight)
-                thresholds += delta
-                weight -= decay
+        for i in range(nb_iter):
+            thresholds += calc_delta(thresholds, weight)
+            weight -= decay
 
-                nPred = apply_threshold(thresholds, prediction_result)
-                f1 = f1_score(nPred, y_true, average=None)
+            f1 = search.f1(thresholds)
+            mean_f1 = f1.mean(axis=1)
+            j = int(np.argmax(mean_f1))
 
-                if f1.mean() > best["mean f1"]:
-                    best["thresholds"] = thresholds
-                    best["mean f1"] = f1.mean()
-                    best["f1"] = f1
+            if mean_f1[j] > best["mean f1"]:
+                best["thresholds"] = thresholds[j].copy()
+                best["mean f1"] = mean_f1[j]
+                best["f1"] = f1[j]
 
-        cpt = 0
-        for key in self.thresholds:
-            self.thresholds[key] = best["thresholds"][cpt]
-            cpt += 1
+        self.__setThresholds(best["thresholds"])
 
     def __metrics_optimization(self, y_true: np.array, prediction_result: np.array):
         bin_prediction = self.binarize(prediction_result)
@@ -155,49 +232,64 @@ class Binarizer(object):
         self.__init_thresholds()
         self.optimized = False
 
-    def binarize(self, prediction_result: np.array) -> np.array:
+    def save(self, path: str):
         """
-        Binarize the prediction results given using the defines thresholds, Can work with global prediction and
-        temporal prediction
-        :param prediction_result: 2 or 3 dimensions numpy array not binarized
-        :return: 2 or 3 dimension numpy array representing the binarized prediction
+        Save the thresholds of each class into a json file, to reuse them at inference.
+        :param path: path of the json file
         """
-        if len(prediction_result.shape) == 2: return self.__global_binarization(prediction_result)
-        elif len(prediction_result.shape) == 3: return self.__temporal_binarization(prediction_result)
-        else:
-            # TODO change sys.exit by raise
-            print("Can't binarize on a array of dimension different that 2 or 3")
-            sys.exit(1)
+        with open(path, "w") as f:
+            json.dump({"optimized": self.optimized, "thresholds": self.thresholds}, f, indent=4)
 
-    def __global_binarization(self, prediction_result: np.array) -> np.array:
-        output = []
-        mappedScore = np.nan_to_num([self.thresholds[key] for key in self.thresholds])
-        for i in range(len(prediction_result)):
-            line = copy.copy(prediction_result[i])
+    def load(self, path: str):
+        """
+        Load the thresholds saved with save().
+        :param path: path of the json file
+        :return: the binarizer itself
+        """
+        with open(path, "r") as f:
+            data = json.load(f)
 
-            line[line > mappedScore] = 1
-            line[line <= mappedScore] = 0
-            output.append(line)
+        for key in self.thresholds:
+            self.thresholds[key] = float(data["thresholds"][key])
+        self.optimized = bool(data["optimized"])
 
-        return np.array(output)
+        return self
 
-    def __temporal_binarization(self, temporal_prediction: np.array) -> np.array:
-        output = []
-        mapped_score = np.nan_to_num([self.thresholds[key] for key in self.thresholds])
+    def thresholdVector(self, thresholds=None) -> np.array:
+        """
+        Convert the thresholds into a vector ordered like the classes, ready to be broadcast on the predictions.
+        :param thresholds: dict {class name: threshold} or an already computed vector, default the Binarizer ones
+        :return: 1-dimension numpy array of thresholds
+        """
+        if thresholds is None:
+            thresholds = self.thresholds
 
-        for clip in temporal_prediction:
-            bin = []
+        if isinstance(thresholds, dict):
+            thresholds = [thresholds[key] for key in thresholds]
 
-            for i in range(len(clip)):
-                line = copy.copy(clip[i])
+        return np.nan_to_num(np.asarray(thresholds, dtype=np.float64))
 
-                line[line > mapped_score] = 1
-                line[line <= mapped_score] = 0
-                bin.append(line)
+    def binarize(self, prediction_result: np.array, thresholds=None, out: np.array = None,
+                 dtype=np.uint8) -> np.array:
+        """
+        Binarize the prediction results given using the defines thresholds, Can work with global prediction and
+        temporal prediction
+        :param prediction_result: 2 or 3 dimensions numpy array not binarized
+        :param thresholds: dict of thresholds or threshold vector (see thresholdVector), default the Binarizer ones
+        :param out: Optional preallocated buffer receiving the result
+        :param dtype: dtype of the result when out is not given (uint8 or bool)
+        :return: 2 or 3 dimension numpy array representing the binarized prediction
+        """
+        if len(prediction_result.shape) not in (2, 3):
+            # TODO change sys.exit by raise
+            print("Can't binarize on a array of dimension different that 2 or 3")
+            sys.exit(1)
 
-            output.append(bin)
+        if out is None:
+            out = np.empty(prediction_result.shape, dtype=dtype)
 
-        return np.array(output)
+        # the class axis is the last one for both global and temporal prediction, one broadcast comparison
+        return np.greater(prediction_result, self.thresholdVector(thresholds), out=out)
 
 
 if __name__ == "__main__":
@@ -1,29 +1,246 @@
 from keras.callbacks import Callback
-from sklearn.metrics import precision_score, recall_score, f1_score
+from keras import backend as K
 
 from datasetGenerator import DCASE2018
 from Binarizer import Binarizer
+import DataSequence
+import Metrics
 
+from collections import deque
+import heapq
+import numpy as np
 import os, sys, time
+import queue, threading
+
+
+class Snapshot(dict):
+    """
+    The weights of the model at one epoch and its scores ("epoch", "average f1", ...). The weights are kept in memory
+    or spilled into a npz file, snapshot["weights"] gives them back in both cases.
+    """
+    def __init__(self, weights: list, spillPath: str = None, **scores):
+        super().__init__(**scores)
+        self.spillPath = spillPath
+        self.weights = weights
+
+        if spillPath is not None:
+            np.savez(spillPath, *weights)
+            self.weights = None
+
+    def __getitem__(self, key):
+        if key == "weights":
+            if self.weights is not None:
+                return self.weights
+
+            with np.load(self.spillPath) as f:
+                return [f["arr_%d" % i] for i in range(len(f.files))]
+
+        return super().__getitem__(key)
+
+    def release(self):
+        if self.spillPath is not None and os.path.isfile(self.spillPath):
+            os.remove(self.spillPath)
+        self.weights = None
+
+
+class SnapshotStore:
+    """
+    Bounded history of the model weights: the <best_size> best snapshots by validation f1 (min heap) and the
+    <recent_size> last ones (ring buffer) for the fallback. A snapshot is taken once and shared by both, it is
+    released when it leaves the two of them.
+    """
+    def __init__(self, best_size: int = 10, recent_size: int = 10, spillDir: str = None):
+        self.best_size = best_size
+        self.best = []      # heap of (average f1, epoch, snapshot)
+        self.recent = deque(maxlen=recent_size)
+        self.spillDir = spillDir
+
+        if spillDir is not None and not os.path.isdir(spillDir):
+            os.makedirs(spillDir)
+
+    def add(self, weights: list, epoch: int, average_f1: float, **scores) -> Snapshot:
+        spillPath = None
+        if self.spillDir is not None:
+            spillPath = os.path.join(self.spillDir, "snapshot_%d.npz" % epoch)
+
+        scores.update({"epoch": epoch, "average f1": average_f1})
+        snapshot = Snapshot(weights, spillPath, **scores)
+        dropped = []
+
+        if len(self.recent) == self.recent.maxlen:
+            dropped.append(self.recent[0])
+        self.recent.append(snapshot)
+
+        entry = (average_f1, epoch, snapshot)
+        if len(self.best) < self.best_size:
+            heapq.heappush(self.best, entry)
+        elif entry[:2] > self.best[0][:2]:
+            dropped.append(heapq.heapreplace(self.best, entry)[2])
+        else:
+            dropped.append(snapshot)
+
+        self.__release(dropped)
+        return snapshot
+
+    def sorted(self) -> list:
+        """ The best snapshots by increasing f1 (the last one is the best, the latest in case of tie) """
+        return [entry[2] for entry in sorted(self.best, key=lambda entry: entry[:2])]
+
+    def clear(self):
+        """ Forget and release all the snapshots (new training) """
+        snapshots = list(self.recent) + [entry[2] for entry in self.best]
+        self.recent.clear()
+        self.best = []
+
+        self.__release(snapshots)
+
+    def truncateRecent(self, epoch: int):
+        """ Forget the recent snapshots taken after <epoch> """
+        dropped = []
+        while self.recent and self.recent[-1]["epoch"] > epoch:
+            dropped.append(self.recent.pop())
+
+        self.__release(dropped)
+
+    def __release(self, snapshots: list):
+        for snapshot in snapshots:
+            inRecent = any(s is snapshot for s in self.recent)
+            inBest = any(entry[2] is snapshot for entry in self.best)
+            if not inRecent and not inBest:
+                snapshot.release()
+
+
+class LogWriter(threading.Thread):
+    """
+    Background writer of the log files. The training thread only queues the lines, they are written by batch every
+    <flushInterval> seconds or when a flush is asked (end of epoch), so a slow storage never stalls the training.
+    An error of the writer (full disk, missing directory, ...) stops it and is raised again on the training thread by
+    the next call.
+    """
+    def __init__(self, flushInterval: float = 5.0):
+        super().__init__(daemon=True)
+        self.flushInterval = flushInterval
+        self.queue = queue.Queue()
+        self.files = {}
+        self.pending = {}
+        self.error = None
+        self.start()
+
+    def open(self, key: str, path: str, mode: str = "w"):
+        self.__raiseError()
+        self.queue.put(("open", key, (path, mode)))
+
+    def write(self, key: str, text: str):
+        self.__raiseError()
+        self.queue.put(("write", key, text))
+
+    def save(self, path: str, arrays: dict):
+        """ (Re)write a npz file, the previous version stays readable until the new one is complete """
+        self.__raiseError()
+        self.queue.put(("save", None, (path, arrays)))
+
+    def flush(self):
+        self.__raiseError()
+        self.queue.put(("flush", None, None))
+
+    def close(self):
+        """ Write the remaining lines, close the files and wait for the thread to end """
+        self.queue.put(("close", None, None))
+        self.join()
+        self.__raiseError()
+
+    def __raiseError(self):
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        try:
+            self.__process()
+        except Exception as error:
+            self.error = error
+        finally:
+            for file in self.files.values():
+                file.close()
+
+    def __process(self):
+        lastFlush = time.time()
+        command = None
+
+        while command != "close":
+            try:
+                command, key, payload = self.queue.get(timeout=max(0, self.flushInterval - (time.time() - lastFlush)))
+            except queue.Empty:
+                command, key, payload = "flush", None, None
+
+            if command == "open":
+                self.__writePending()
+                path, mode = payload
+                self.files[key] = open(path, mode)
+                self.pending[key] = []
+
+            elif command == "write":
+                self.pending[key].append(payload)
+
+            elif command == "save":
+                path, arrays = payload
+                np.savez(path + ".tmp.npz", **arrays)
+                os.replace(path + ".tmp.npz", path)
+
+            if command in ("flush", "close") or time.time() - lastFlush >= self.flushInterval:
+                self.__writePending()
+                lastFlush = time.time()
+
+    def __writePending(self):
+        for key, lines in self.pending.items():
+            if lines:
+                self.files[key].write("".join(lines))
+                self.files[key].flush()
+                lines.clear()
+
 
 class CompleteLogger(Callback):
+    CLASS_COLUMNS = ["class_precision", "class_recall", "class_f1"]
+
     def __init__(self, logPath: str, validation_data: tuple, history_size: int = 10,
             fallback: bool = False, fallBackThreshold: int = 5, stopAt: int = 100,
-            display: bool = True
+            display: bool = True, eval_interval: int = 1, batch_size: int = 32, spillDir: str = None,
+            displayInterval: float = 0.5, flushInterval: float = 5.0, normalizer=None
             ):
+        """
+        The validation is done here, once per epoch, instead of by keras (no validation_data given to fit): the
+        val_loss and val_<metric> are written into the logs of the epoch for the next callbacks (EarlyStopping,
+        ReduceLROnPlateau, ...), the logger must then be the first of the list.
+
+        :param validation_data: (inputs, outputs) of the validation, the inputs are the raw features. Or a
+            DCASE2018Sequence, not shuffled (see setValidation)
+        :param normalizer: Normalizer (already fit) applied on each batch of the validation inputs
+        :param batch_size: Number of file per validation batch, the metrics are averaged over the batches as keras does
+        """
 
         super().__init__()
 
-        self.validation_input = validation_data[0]
-        self.validation_output = validation_data[1]
+        self.normalizer = normalizer
+        self.batch_size = batch_size
+        self.validation_sequence = None
+        self.validation_output = None
+        self.validationFunction = None
+        self.usesLearningPhase = False
+        self.setValidation(validation_data)
+
+        # the per classes metrics are computed every <eval_interval> epochs (and at the last one)
+        self.eval_interval = max(1, eval_interval)
+        self.precision = self.recall = self.f1 = None
 
         self.metrics = []
         self.trainMetrics = []
         self.validationMetrics = []
 
         self.logging = logPath is not None
+        self.logBase = logPath
         self.logPath = {"general": logPath}
-        self.logFile = {}
+        self.logWriter = None
+        self.flushInterval = flushInterval
+        self.columns = None     # full precision log of every epoch, saved in <logPath>_log.npz
 
         self.currentEpoch = 0
         self.stopAt = stopAt
@@ -31,9 +248,7 @@ class CompleteLogger(Callback):
         self.epochDuration = 0
 
         self.history_size = history_size
-        self.history = []       # a history of the best models
-        self.sortedHistory = []
-        self.f1History = {"train": [], "val": []}
+        self.snapshots = SnapshotStore(history_size, history_size, spillDir)
 
         self.fallbackCooldown = self.history_size
         self.fallbackTh = fallBackThreshold
@@ -44,21 +259,60 @@ class CompleteLogger(Callback):
 
         self.transferMode = False
         self.display = display
+        self.displayInterval = displayInterval   # minimal time between two progress lines (seconds)
+        self.lastDisplay = 0
         self.binarizer = Binarizer()
 
+    @property
+    def history(self) -> list:
+        """ The snapshots of the last <history_size> epochs (fallback window) """
+        return list(self.snapshots.recent)
+
+    @property
+    def sortedHistory(self) -> list:
+        """ The <history_size> best snapshots by increasing validation f1 """
+        return self.snapshots.sorted()
+
+    def setValidation(self, validation_data):
+        """ :param validation_data: (inputs, outputs) of the validation or a DCASE2018Sequence (not shuffled) """
+        if isinstance(validation_data, DataSequence.DCASE2018Sequence):
+            self.validation_sequence = validation_data
+        else:
+            self.validation_sequence = DataSequence.DCASE2018Sequence(
+                [validation_data], batch_size=self.batch_size, normalizer=self.normalizer, shuffle=False)
+
     def toggleTransfer(self):
         self.transferMode != self.transferMode
 
     def on_train_begin(self, logs=None):
         super().on_train_begin(logs)
 
+        # each training has its own epochs, snapshots and fallbacks (the weights of another model can't be restored)
+        self.snapshots.clear()
+        self.currentEpoch = 0
+        self.nbFallback = 0
+        self.cooldown = 0
+        self.coolingDown = False
+
         self.__initLogFiles()
 
-        # Split the complete list of metrics into two separated list. training and validation (left and right)
-        middle = int(len(self.params["metrics"]) / 2)
-        self.metrics = self.params["metrics"]
-        self.trainMetrics = self.params["metrics"][:middle]
-        self.validationMetrics = self.params["metrics"][middle:]
+        # training metrics given by keras, the validation ones are computed here (see __validate)
+        self.trainMetrics = [m for m in self.params["metrics"] if not m.startswith("val_")]
+        self.validationMetrics = ["val_" + m for m in self.trainMetrics]
+        self.metrics = self.trainMetrics + self.validationMetrics
+
+        # test function of the compiled model (as keras builds it), which also returns the predictions: the loss, the
+        # metrics and the per class metrics come from the same forward pass
+        model = self.model
+        self.usesLearningPhase = model.uses_learning_phase and not isinstance(K.learning_phase(), int)
+        self.validationFunction = K.function(
+            model.inputs + model.targets + model.sample_weights + ([K.learning_phase()] if self.usesLearningPhase else []),
+            [model.total_loss] + model.metrics_tensors + model.outputs,
+            updates=model.state_updates + model.metrics_updates
+        )
+
+        if self.columns is None or not self.transferMode:
+            self.columns = {key: [] for key in ["epoch", "duration"] + self.metrics + self.CLASS_COLUMNS}
 
         self.__printHeader()
         self.__logGeneralHeader()
@@ -70,7 +324,11 @@ class CompleteLogger(Callback):
             self.__finishLogFiles()
 
     def on_batch_end(self, batch, logs=None):
-        self.__printMetrics(logs)
+        # rate limited progress, the terminal writes are slower than the small batches
+        now = time.time()
+        if now - self.lastDisplay >= self.displayInterval:
+            self.lastDisplay = now
+            self.__printMetrics(logs)
 
     def on_epoch_begin(self, epoch, logs=None):
         super().on_epoch_begin(epoch, logs)
@@ -90,12 +348,20 @@ class CompleteLogger(Callback):
         super().on_epoch_end(epoch, logs)
         self.epochDuration = time.time() - self.epochStart
 
-        self.__computeMetrics()
+        evaluate = self.currentEpoch % self.eval_interval == 0 or self.currentEpoch == self.stopAt
+        prediction = self.__validate(logs)
+        if evaluate:
+            self.__computeMetrics(prediction)
         self.__toHistory(logs)
 
         self.__printMetrics(logs, validation=True, overwrite=False)
         self.__logGeneralEpoch(logs)
-        self.__logClassesEpoch()
+        if evaluate:
+            self.__logClassesEpoch()
+        self.__logColumns(logs, evaluate)
+
+        if self.logging:
+            self.logWriter.flush()
 
         self.__fallingBack()
 
@@ -106,51 +372,47 @@ class CompleteLogger(Callback):
     # ==================================================================================================================
     #       Classes metrics compute
     # ==================================================================================================================
-    def __computeMetrics(self):
+    def __validate(self, logs: dict) -> np.array:
+        # val_loss and val_<metric> of the epoch, averaged over the validation batches weighted by their size
+        # (as keras evaluate_generator does), return the predictions of the validation
+        nbMetric = len(self.validationMetrics)
+        values, sizes, predictions, outputs = [], [], [], []
+        for i in range(len(self.validation_sequence)):
+            x, y = self.validation_sequence[i]
+            results = self.validationFunction(
+                [x, y, np.ones(len(y), dtype=np.float32)] + ([0] if self.usesLearningPhase else []))
+
+            values.append(results[:nbMetric])
+            predictions.append(results[nbMetric])
+            outputs.append(y)
+            sizes.append(len(y))
+
+        for name, value in zip(self.validationMetrics, np.average(values, axis=0, weights=sizes)):
+            logs[name] = float(value)
+
+        self.validation_output = np.concatenate(outputs)
+        return np.concatenate(predictions)
+
+    def __computeMetrics(self, prediction: np.array):
         # compute the results of the metrics and log them to the files
 
-        # calc metrics for each classes separately
-        prediction = self.model.predict(self.validation_input)
-        prediction = self.binarizer.binarize(prediction)
+        # calc metrics for each classes separately, from the validation prediction of the epoch
+        prediction = self.binarizer.binarize(prediction, dtype=bool)
 
-        self.precision = precision_score(self.validation_output, prediction, average=None)
-        self.recall = recall_score(self.validation_output, prediction, average=None)
-        self.f1 = f1_score(self.validation_output, prediction, average=None)
+        counts = Metrics.confusion_counts(self.validation_output, prediction)
+        self.precision, self.recall, self.f1 = Metrics.class_scores(*counts)
 
     # ==================================================================================================================
     #       HISTORY AND FALLBACK FUNCTION
     # ==================================================================================================================
     def __toHistory(self, logs=None):
-        average_f1 = float(logs[self.validationMetrics[-1]])
-
-        # add the current model to the list of history
-        self.history.append(
-                {"weights": self.model.get_weights(),
-                 "average f1": average_f1,
-                 "epoch": self.currentEpoch}
-                )
-        self.sortedHistory.append(
-                {"weights": self.model.get_weights(),
-                 "average f1": average_f1,
-                 "epoch": self.currentEpoch}
-                )
-        self.f1History["train"].append(float(logs[self.trainMetrics[-1]]))
-        self.f1History["val"].append(float(logs[self.validationMetrics[-1]]))
-
-
-        # sort the list using the average f1 key
-        self.sortedHistory = sorted(self.history, key=lambda k: k['average f1'])
-
-        # keep only the <history_size> first
-        self.history = self.history[:self.history_size]
-        self.sortedHistory = self.sortedHistory[-self.history_size:]
-        self.f1History["train"] = self.f1History["train"][:self.history_size]
-        self.f1History["val"] = self.f1History["val"][:self.history_size]
-
-    def __cutHistoryTo(self, toCut: int):
-        self.history = self.history[:toCut]
-        self.f1History["train"] = self.f1History["train"][:toCut]
-        self.f1History["val"] = self.f1History["val"][:toCut]
+        # one snapshot of the current model, shared by the best and the recent histories
+        self.snapshots.add(
+            self.model.get_weights(),
+            epoch=self.currentEpoch,
+            average_f1=float(logs[self.validationMetrics[-1]]),
+            **{"train f1": float(logs[self.trainMetrics[-1]])}
+        )
 
     def __fallingBack(self):
         # managing cooling down
@@ -169,31 +431,31 @@ class CompleteLogger(Callback):
             return
 
         # if not enough time spent
-        if self.currentEpoch < self.history_size:
+        recent = self.history
+        if len(recent) < self.history_size:
             return
 
-        curF1Val = self.f1History["val"][-1]
-        curF1Tra = self.f1History["train"][-1]
+        curF1Val = recent[-1]["average f1"]
+        curF1Tra = recent[-1]["train f1"]
         diff = curF1Tra - curF1Val
 
         if diff > self.fallbackTh:
 
-            betterEpoch = self.history_size - 1
+            better = recent[-1]
             mini = diff
-            for i in range(self.history_size - 1, -1, -1):
-                cDiff = self.f1History["train"][i] - self.f1History["val"][i]
+            for snapshot in reversed(recent):
+                cDiff = snapshot["train f1"] - snapshot["average f1"]
                 if cDiff < mini:
                     mini = cDiff
-                    betterEpoch = i
+                    better = snapshot
 
-            print("Overfitting... going back in time %s epochs behind" % (betterEpoch))
+            print("Overfitting... going back in time %s epochs behind" % (self.currentEpoch - better["epoch"]))
             print("train, val diff: %.2f" % mini)
-            self.model.set_weights(self.history[betterEpoch]["weights"])
+            self.model.set_weights(better["weights"])
             self.nbFallback += 1
 
             # pruning history
-            cutoff = self.currentEpoch - (self.history_size - betterEpoch)
-            self.__cutHistoryTo(cutoff)
+            self.snapshots.truncateRecent(better["epoch"])
 
             # starting cooldown
             self.coolingDown = True
@@ -206,7 +468,7 @@ class CompleteLogger(Callback):
         if not self.logging:
             return
 
-        dirPath = self.logPath["general"]
+        dirPath = self.logBase
         dirName = os.path.dirname(dirPath)
         fileName = os.path.basename(dirPath)
 
@@ -219,68 +481,87 @@ class CompleteLogger(Callback):
         self.logPath["precision"] = dirPath + "_precision.csv"
         self.logPath["recall"] = dirPath + "_recall.csv"
         self.logPath["f1"] = dirPath + "_f1.csv"
-        self.logPath["general"] += "_metrics.csv"
+        self.logPath["general"] = dirPath + "_metrics.csv"
+        self.columnsPath = dirPath + "_log.npz"
 
-        # open the files
+        # open the files (in the writer thread)
+        self.logWriter = LogWriter(self.flushInterval)
         for key in self.logPath.keys():
             if not self.transferMode:
-                self.logFile[key] = open(self.logPath[key], "w")
+                self.logWriter.open(key, self.logPath[key], "w")
             else:
-                self.logFile[key] = open(self.logPath[key], "a")
+                self.logWriter.open(key, self.logPath[key], "a")
 
         # write headers
         if not self.transferMode:
-            for key in self.logFile:
+            for key in self.logPath:
                 if key != "general":
-                    self.__logClassesheader(self.logFile[key])
+                    self.__logClassesheader(key)
             self.__logGeneralHeader()
 
     def __finishLogFiles(self):
         if not self.logging:
             return
 
-        for key in self.logPath.keys():
-            self.logFile[key].close()
+        self.logWriter.close()
 
     def __logGeneralHeader(self):
         if self.logging:
-            self.logFile["general"].write("epoch,progress,")
+            line = "epoch,progress,"
 
             for m in self.metrics:
-                self.logFile["general"].write("%s," % m)
+                line += "%s," % m
 
-            self.logFile["general"].write("duration\n")
+            self.logWriter.write("general", line + "duration\n")
 
     def __logGeneralEpoch(self, logs: dict):
         if self.logging:
-            self.logFile["general"].write("%s,100," % (self.currentEpoch))
+            line = "%s,100," % (self.currentEpoch)
 
             # all metrics
             for m in self.metrics:
                 if m != self.validationMetrics[-1]:
-                    self.logFile["general"].write("%s," % str(logs[m])[:6])
+                    line += "%s," % str(logs[m])[:6]
                 else:
-                    self.logFile["general"].write("%s" % str(logs[m])[:6])
+                    line += "%s" % str(logs[m])[:6]
 
-            self.logFile["general"].write("%s\n" % self.epochDuration)
+            self.logWriter.write("general", line + "%s\n" % self.epochDuration)
 
-    def __logClassesheader(self, file):
+    def __logClassesheader(self, key: str):
         if self.logging:
-            file.write("epoch,")
-            for key in DCASE2018.class_correspondance.keys():
-                if key != list(DCASE2018.class_correspondance.keys())[-1]:
-                    file.write("%s," % key)
-                else:
-                    file.write("%s\n" % key)
+            self.logWriter.write(key, "epoch," + ",".join(DCASE2018.class_correspondance.keys()) + "\n")
 
     def __logClassesEpoch(self):
         def convertToCSV(line: list):
             return ",".join(map(str, line))
 
         if self.logging:
-            self.logFile["precision"].write(str(self.currentEpoch) + "," + convertToCSV(self.precision) + "\n")
-            self.logFile["recall"].write(str(self.currentEpoch) + "," + convertToCSV(self.recall) + "\n")
-            self.logFile["f1"].write(str(self.currentEpoch) + "," + convertToCSV(self.f1) + "\n")
+            self.logWriter.write("precision", str(self.currentEpoch) + "," + convertToCSV(self.precision) + "\n")
+            self.logWriter.write("recall", str(self.currentEpoch) + "," + convertToCSV(self.recall) + "\n")
+            self.logWriter.write("f1", str(self.currentEpoch) + "," + convertToCSV(self.f1) + "\n")
+
+    def __logColumns(self, logs: dict, evaluated: bool):
+        """ One row per epoch, the metrics at full precision and the per class ones (nan when not computed) """
+        if not self.logging:
+            return
+
+        self.columns["epoch"].append(self.currentEpoch)
+        self.columns["duration"].append(self.epochDuration)
+        for m in self.metrics:
+            self.columns[m].append(float(logs[m]))
+
+        nbClass = len(DCASE2018.class_correspondance)
+        for key, values in zip(self.CLASS_COLUMNS, (self.precision, self.recall, self.f1)):
+            self.columns[key].append(values if evaluated else np.full(nbClass, np.nan))
+
+        arrays = {key: np.array(self.columns[key], dtype=float) for key in self.columns}
+        arrays["epoch"] = arrays["epoch"].astype(int)
+        arrays["metrics"] = np.array(self.metrics)
+        arrays["classes"] = np.array(list(DCASE2018.class_correspondance.keys()))
+        for key in self.CLASS_COLUMNS:
+            arrays[key] = arrays[key].reshape(-1, nbClass)
+
+        self.logWriter.save(self.columnsPath, arrays)
 
     # ==================================================================================================================
     #       DISPLAY FUNCTIONS
@@ -291,7 +572,11 @@ class CompleteLogger(Callback):
             print("{:<8}".format(self.currentEpoch), end="")
 
             if "batch" in logs.keys():
-                percent = int(logs["batch"]) * int(self.params["batch_size"]) / int(self.params["samples"]) * 100
+                if self.params.get("steps"):
+                    # fit_generator, the progress is given in number of batch
+                    percent = (int(logs["batch"]) + 1) / int(self.params["steps"]) * 100
+                else:
+                    percent = int(logs["batch"]) * int(self.params["batch_size"]) / int(self.params["samples"]) * 100
                 print("%{:<10}".format(str(int(percent))[:3]), end="")
             else:
                 print("%{:<10}".format("100"), end="")
@@ -342,3 +627,32 @@ class CompleteLogger(Callback):
         sys.exit(2)
 
 
+if __name__ == "__main__":
+    # the validation of CompleteLogger against model.evaluate, on a tiny model (dropout and batch normalization, so
+    # the learning phase matters)
+    from keras.layers import BatchNormalization, Dense, Dropout, Flatten
+    from keras.models import Sequential
+
+    rng = np.random.RandomState(0)
+    inputs = rng.rand(100, 64, 20).astype(np.float32)
+    outputs = (rng.rand(100, 10) > 0.7).astype(np.float32)
+    training = DataSequence.DCASE2018Sequence([(inputs[:70], outputs[:70])], batch_size=8)
+
+    model = Sequential([Flatten(input_shape=(64, 20, 1)), Dense(32, activation="relu"), BatchNormalization(),
+                        Dropout(0.5), Dense(10, activation="sigmoid")])
+    model.compile("adam", "binary_crossentropy", metrics=["accuracy", Metrics.f1])
+
+    class Check(Callback):
+        def on_epoch_end(self, epoch, logs=None):
+            names = ["val_" + name for name in self.model.metrics_names]
+            expected = self.model.evaluate(inputs[70:, ..., np.newaxis], outputs[70:], batch_size=7, verbose=0)
+            difference = max(abs(logs[name] - value) for name, value in zip(names, expected))
+            print("epoch %d, %s, max |logger - evaluate|: %.2e" % (
+                epoch + 1, ", ".join("%s %.4f" % (name, logs[name]) for name in names), difference))
+
+    logger = CompleteLogger(None, (inputs[70:], outputs[70:]), display=False, batch_size=7)
+    model.fit_generator(training, epochs=3, callbacks=[logger, Check()], verbose=0)
+
+    prediction = model.predict(inputs[70:, ..., np.newaxis]) > 0.5
+    counts = Metrics.confusion_counts(outputs[70:], prediction)
+    print("per class f1, max |logger - predict|: %.2e" % np.abs(logger.f1 - Metrics.class_scores(*counts)[2]).max())
@@ -0,0 +1,71 @@
+import numpy as np
+from keras.utils import Sequence
+
+
+class DCASE2018Sequence(Sequence):
+    """ Batch generator streaming from several (input, output) sources without concatenating them.
+
+    The sources can be in memory arrays, memory-mapped ones or rows read on demand (see datasetGenerator.LazyRows),
+    only the current batch is materialized. The normalizer, if any, must already be fit and is applied batch per batch.
+    """
+
+    def __init__(self, sources: list, batch_size: int = 8, normalizer=None, shuffle: bool = True):
+        """
+        :param sources: list of (input, output) couples, used as if they were concatenated. The output can be None
+            (prediction), the batches are then the inputs only
+        :param batch_size: Number of file per batch
+        :param normalizer: Normalizer (already fit) to apply on each batch
+        :param shuffle: If the files order must be shuffle at each epoch
+        """
+        self.sources = sources
+        self.batch_size = batch_size
+        self.normalizer = normalizer
+        self.shuffle = shuffle
+
+        lengths = [len(source[0]) for source in sources]
+        self.offsets = np.cumsum([0] + lengths)
+        self.indexes = np.arange(self.offsets[-1])
+
+        if self.shuffle:
+            np.random.shuffle(self.indexes)
+
+    def __len__(self):
+        return int(np.ceil(len(self.indexes) / self.batch_size))
+
+    def __getitem__(self, index: int):
+        # sorted to read the memory maps sequentially, the order inside a batch doesn't matter
+        batch = np.sort(self.indexes[index * self.batch_size:(index + 1) * self.batch_size])
+        source_index = np.searchsorted(self.offsets, batch, side="right") - 1
+
+        inputs, outputs = [], []
+        for s in np.unique(source_index):
+            rows = batch[source_index == s] - self.offsets[s]
+            source_input = self.sources[s][0][rows]
+
+            # normalization is done on (<nb file>, <dim 1>, <dim 2>) batches, the channel axis is added after
+            if source_input.ndim == 4 and source_input.shape[-1] == 1:
+                source_input = source_input[..., 0]
+
+            inputs.append(source_input)
+            if self.sources[s][1] is not None:
+                outputs.append(np.asarray(self.sources[s][1])[rows])
+
+        inputs = np.concatenate(inputs)
+        if self.normalizer is not None:
+            inputs = self.normalizer.transform(inputs)
+        inputs = np.expand_dims(inputs, axis=-1)
+
+        if len(outputs) == 0:
+            return inputs
+
+        return inputs, np.concatenate(outputs)
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            np.random.shuffle(self.indexes)
+
+
+def predict(model, inputs, normalizer=None, batch_size: int = 64) -> np.array:
+    """ Prediction of raw inputs (array or rows read on demand), normalized batch per batch, in their order """
+    sequence = DCASE2018Sequence([(inputs, None)], batch_size=batch_size, normalizer=normalizer, shuffle=False)
+    return model.predict_generator(sequence)
@@ -1,72 +1,43 @@
 import sys, os
 import numpy as np
-import copy
 
+import Smoothing
 from Binarizer import Binarizer
 from datasetGenerator import DCASE2018
 
 class Encoder:
+    # one line per detected event, the onset and offset are frame indexes (offset excluded)
+    SEGMENT_DTYPE = np.dtype([("clip", np.int32), ("cls", np.int32), ("onset", np.int32), ("offset", np.int32)])
+
     def __init__(self):
         self.frameLength = 0
         self.nbFrame = 0
 
-    def __pad(self, array: list, window_size: int, method: str = "same"):
-        """ Pad and array using the methods given and a window_size.
+    def __smooth(self, temporalPrediction: np.array, method: str = "smoothMovingAvg", **kwargs) -> np.array:
+        """ Smooth the whole temporal prediction tensor (see Smoothing).
 
-        :param array: the array to pad
-        :param window_size: the size of the working window
-        :param method: methods of padding, two available "same" | "reflect"
-        :return: the padded array
+        :param temporalPrediction: A 3-dimension numpy array (<nb clip>, <nb frame>, <nb class>)
+        :param method: "smoothMovingAvg" (window_len, weight) | "smoothMedian" (window_len) | "smoothExponential" (alpha)
+        :return: the smoothed prediction
         """
-        missing = len(array) % window_size
-        output = copy.copy(array)
-
-        if missing > 0:
-            output = np.concatenate((output, [output[-1]] * missing))
-
-        return output
-
-    def __smooth(self, temporalPrediction: np.array, method: str = "smoothMovingAvg", **kwargs) -> np.array:
-        _methods = ["smoothMovingAvg"]
+        _methods = ["smoothMovingAvg", "smoothMedian", "smoothExponential"]
         if method not in _methods:
             print("method %s doesn't exist. Only ", _methods, " available")
             sys.exit(1)
 
-        if method == _methods[0]: smoother = self.__smoothMeanAvg
-        else:
-            return
-
-        return smoother(temporalPrediction, **kwargs)
+        keys = kwargs.keys()
+        window_len = kwargs["window_len"] if "window_len" in keys else 11
 
-    def __smoothMeanAvg(self, temporalPrediction: np.array, **kwargs):
-        print("Smooting using the smooth moving average algorithm")
-        def smooth(data, window_len = 11):
-            # retreiving extract arguments
-            keys = kwargs.keys()
-            window_len = kwargs["window_len"] if "window_len" in keys else 11
+        if method == _methods[0]:
             weight = kwargs["weight"] if "weight" in keys else 2
+            return Smoothing.moving_average(temporalPrediction, window_len, weight)
 
-            window_len = int(window_len)
+        elif method == _methods[1]:
+            return Smoothing.median(temporalPrediction, window_len)
 
-            if window_len < 3:
-                return data
-
-            s = np.r_[weight * data[0] - data[window_len - 1::-1], data, weight * data[-1] - data[-1:-window_len:-1]]
-            w = np.ones(window_len, 'd')
-            y = np.convolve(w / w.sum(), s, mode='same')
-            return y[window_len:-window_len + 1]
-
-        outputs = []
-        for clipInd in range(len(temporalPrediction)):
-            clip = temporalPrediction[clipInd]
-            curves = []
-            for clsInd in range(len(clip.T)):
-                #clip.T[clsInd] = smooth(clip.T[clsInd])
-                curves.append(smooth(clip.T[clsInd]))
-            curves = np.array(curves)
-            outputs.append(curves.T)
-        outputs = np.array(outputs)
-        return outputs
+        else:
+            alpha = kwargs["alpha"] if "alpha" in keys else 0.3
+            return Smoothing.exponential(temporalPrediction, alpha)
 
     def binToClass(self, prediction: np.array, binarize: bool = False) -> np.array:
         """ Given the prediction output of the network, match the results to the class name.
@@ -100,7 +71,8 @@ class Encoder:
 
         return np.array(output)
 
-    def encode(self, temporalPrediction: np.array, method: str = "threshold", smooth: str = None, **kwargs) -> str:
+    def encode(self, temporalPrediction: np.array, method: str = "threshold", smooth: str = None,
+               fill_gap=None, min_duration=0, **kwargs) -> np.array:
         """
         Perform the localization of the sound event present in the file.
 
@@ -109,8 +81,15 @@ class Encoder:
         There is two methods implemented here, one using a simple threshold based segmentation and an other using
         a modulation system based on the variance of the prediction over the time.
 
+        Each method computes the activity mask of the whole (<nb clip>, <nb frame>, <nb class>) tensor at once, the
+        mask is post-processed (holes filling, short events removal) and the segments are then extracted from the mask
+        boundaries.
+
         :param temporalPrediction: A 3-dimension numpy array (<nb clip>, <nb frame>, <nb class>)
-        :return: The result of the system under the form of a strong annotation text where each represent on timed event
+        :param fill_gap: The holes shorter than fill_gap (ms) are filled. One value, one per class or a dict by class name.
+            Default 200 ms for the threshold method (as it always did), no filling for the others
+        :param min_duration: The events shorter than min_duration (ms) are removed. Same format as fill_gap
+        :return: The segments found, a structured array of dtype Encoder.SEGMENT_DTYPE (clip, cls, onset, offset)
         """
         # parameters verification
         _methods=["threshold", "hysteresis", "derivative", "primitive", "dynamic-threshold"]
@@ -129,160 +108,136 @@ class Encoder:
             temporalPrediction = self.__smooth(temporalPrediction, method=smooth, **kwargs)
 
         self.nbFrame = temporalPrediction.shape[1]
-        self.frameLength = 10 / self.nbFrame
-        return encoder(temporalPrediction, **kwargs)
-
-    def __encodeUsingHysteresis(self, temporalPrediction: np.array, **kwargs) -> list:
-        """ Hysteresys based localization of the sound event in the clip using the temporal prediction.
-
-        :param temporalPrediction: A 3-dimension numpy array (<nb clip>, <nb frame>, <nb class>)
-        :param low: low thresholds
-        :param high: high thresholds
-        :return: the result of the system under the form of a strong annotation text where each line represent on timed event
-        """
-        low = kwargs["low"] if "low" in kwargs.keys() else 0.4
-        high = kwargs["high"] if "high" in kwargs.keys() else 0.6
-        prediction = temporalPrediction
-
-        output = []
-
-        for clip in prediction:
-            labeled = dict()
-
-            cls = 0
-            for predictionPerClass in clip.T:
-                converted = list()
-                segment = [0, 0]
-                nbSegment = 1
-                for i in range(len(predictionPerClass)):
-                    element = predictionPerClass[i]
-
-                    # first element
-                    if i == 0:
-                        segment = [1.0, 1] if element > high else [0.0, 1]
-
-                    # then
-                    if element > high and segment[0] == 1:
-                        segment[1] += 1
-
-                    elif element > high and segment[0] == 0:
-                        converted.append(segment)
-                        nbSegment += 1
-                        segment = [1.0, 1]
+        self.frameLength = DCASE2018.CLIP_LENGTH / self.nbFrame
+        if fill_gap is None:
+            fill_gap = 200 if method == "threshold" else 0
 
-                    elif element <= low and segment[0] == 0:
-                        segment[1] += 1
+        mask = encoder(temporalPrediction, **kwargs)
+        mask = self.__postProcessing(mask, fill_gap, min_duration)
 
-                    elif element <= low and segment[0] == 1:
-                        converted.append(segment)
-                        nbSegment += 1
-                        segment = [0.0, 0]
+        return self.__segments(mask)
 
-                if nbSegment == 1:
-                    converted.append(segment)
+    def __perClass(self, value, nbClass: int) -> np.array:
+        """ Convert a parameter given once, for each class or as a dict {class name: value} into a vector."""
+        if isinstance(value, dict):
+            vector = np.zeros(nbClass)
+            for key in value:
+                vector[DCASE2018.class_correspondance[key]] = value[key]
+            return vector
 
-                labeled[cls] = copy.copy(converted)
-                cls += 1
+        return np.broadcast_to(np.asarray(value, dtype=np.float64), (nbClass,))
 
-            output.append(labeled)
+    def __runMask(self, shape: tuple, runs: np.array) -> np.array:
+        """ Boolean mask covering the given runs (structured array of segments)."""
+        delta = np.zeros((shape[0], shape[1] + 1, shape[2]), dtype=np.int32)
+        np.add.at(delta, (runs["clip"], runs["onset"], runs["cls"]), 1)
+        np.add.at(delta, (runs["clip"], runs["offset"], runs["cls"]), -1)
 
-        return output
+        return np.cumsum(delta, axis=1)[:, :-1] > 0
 
-    def __encodeUsingThreshold(self, temporalPrediction: np.array, **kwargs) -> list:
-        """ Threshold based localization of the sound event in the clip using the temporal prediction.
+    def __postProcessing(self, mask: np.array, fill_gap=0, min_duration=0) -> np.array:
+        """ Closing then opening of the activity mask, computed on the runs of the whole tensor.
 
-        :param temporalPrediction: A 3-dimension numpy array (<nb clip>, <nb frame>, <nb class>)
-        :param kwargs: Extra arguments. None possible in this method
-        :return: The result of the system under the form of a strong annotation text where each represent on timed event
+        :param mask: A 3-dimension boolean array (<nb clip>, <nb frame>, <nb class>)
+        :param fill_gap: The holes (inside an event) shorter than fill_gap (ms) are filled
+        :param min_duration: The events shorter than min_duration (ms) are removed
+        :return: the post processed mask
         """
-        output = []
-        temporalPrecision = 200        # ms
-
-        # binarize the results using the thresholds (default or optimized) provided by the Binarizer
-        binarizer = Binarizer()
-        binPrediction = binarizer.binarize(temporalPrediction)
-
-        # Merging "hole" that are smaller than 200 ms
-        stepLength = DCASE2018.CLIP_LENGTH / temporalPrediction.shape[1] * 1000     # in ms
-        maxHoleSize = int(temporalPrecision / stepLength)
+        nbFrame, nbClass = mask.shape[1], mask.shape[2]
+        stepLength = DCASE2018.CLIP_LENGTH / nbFrame * 1000     # in ms
+
+        # fill the holes, only the one surrounded by two events
+        maxGap = self.__perClass(fill_gap, nbClass)
+        if maxGap.any():
+            holes = self.__segments(~mask)
+            inside = (holes["onset"] > 0) & (holes["offset"] < nbFrame)
+            short = (holes["offset"] - holes["onset"]) * stepLength < maxGap[holes["cls"]]
+            mask = mask | self.__runMask(mask.shape, holes[inside & short])
+
+        # remove the short events
+        minDuration = self.__perClass(min_duration, nbClass)
+        if minDuration.any():
+            events = self.__segments(mask)
+            short = (events["offset"] - events["onset"]) * stepLength < minDuration[events["cls"]]
+            mask = mask & ~self.__runMask(mask.shape, events[short])
+
+        return mask
+
+    def __segments(self, mask: np.array) -> np.array:
+        """ Extract the onset and offset of each active segment of a binary mask.
+
+        :param mask: A 3-dimension boolean array (<nb clip>, <nb frame>, <nb class>)
+        :return: structured array of dtype Encoder.SEGMENT_DTYPE, ordered by clip, class and onset
+        """
+        nbClip, nbFrame, nbClass = mask.shape
 
-        for clip in binPrediction:
-            labeled = dict()
+        # (clip, class, frame) order so the boundaries come out sorted by clip, class then time
+        padded = np.zeros((nbClip, nbClass, nbFrame + 2), dtype=np.int8)
+        padded[:, :, 1:-1] = np.transpose(mask, (0, 2, 1))
+        boundaries = np.diff(padded, axis=2)
 
-            cls = 0
-            for binPredictionPerClass in clip.T:
-                # convert the binarized list into a list of tuple representing the element and it's number of
-                # occurrence. The order is conserved and the total sum should be equal to 10s
+        clip, cls, onset = np.nonzero(boundaries == 1)
+        offset = np.nonzero(boundaries == -1)[2]
 
-                # first pass --> Fill the holes
-                for i in range(len(binPredictionPerClass) - maxHoleSize):
-                    window = binPredictionPerClass[i : i+maxHoleSize]
+        segments = np.empty(len(onset), dtype=Encoder.SEGMENT_DTYPE)
+        segments["clip"] = clip
+        segments["cls"] = cls
+        segments["onset"] = onset
+        segments["offset"] = offset
 
-                    if window[0] == window[-1] == 1:
-                        window[:] = [window[0]] * maxHoleSize
+        return segments
 
-                # second pass --> split into segments
-                converted = []
-                cpt = 0
-                nbSegment = 0
-                previousElt = None
-                for element in binPredictionPerClass:
-                    if previousElt is None:
-                        previousElt = element
-                        cpt += 1
-                        nbSegment = 1
-                        continue
+    def __hold(self, decision: np.array) -> np.array:
+        """ Forward fill the undecided frames (-1) with the last decision (0 or 1) along the time axis.
 
-                    if element == previousElt:
-                        cpt += 1
+        :param decision: A 3-dimension int8 array (<nb clip>, <nb frame>, <nb class>), the first frame must be decided
+        :return: the boolean activity mask
+        """
+        frames = np.arange(decision.shape[1]).reshape(1, -1, 1)
+        lastDecided = np.where(decision >= 0, frames, 0)
+        np.maximum.accumulate(lastDecided, axis=1, out=lastDecided)
 
-                    else:
-                        converted.append((previousElt, cpt))
-                        previousElt = element
-                        nbSegment += 1
-                        cpt = 1
+        return np.take_along_axis(decision, lastDecided, axis=1) == 1
 
-                # case where the class is detect during the whole clip
-                if nbSegment == 1:
-                    converted.append((previousElt, cpt))
+    def __encodeUsingHysteresis(self, temporalPrediction: np.array, **kwargs) -> np.array:
+        """ Hysteresys based localization of the sound event in the clip using the temporal prediction.
 
-                labeled[cls] = copy.copy(converted)
-                cls += 1
+        :param temporalPrediction: A 3-dimension numpy array (<nb clip>, <nb frame>, <nb class>)
+        :param low: low thresholds
+        :param high: high thresholds
+        :return: the activity mask (<nb clip>, <nb frame>, <nb class>)
+        """
+        low = kwargs["low"] if "low" in kwargs.keys() else 0.4
+        high = kwargs["high"] if "high" in kwargs.keys() else 0.6
 
-            output.append(labeled)
+        # 1 above high, 0 below low, otherwise keep the previous state
+        decision = np.full(temporalPrediction.shape, -1, dtype=np.int8)
+        decision[temporalPrediction > high] = 1
+        decision[temporalPrediction <= low] = 0
+        decision[:, 0] = temporalPrediction[:, 0] > high
 
-        return output
+        return self.__hold(decision)
 
-    def __encodeUsingDerivative(self, temporalPrediction: np.array, **kwargs) -> list:
+    def __encodeUsingThreshold(self, temporalPrediction: np.array, **kwargs) -> np.array:
         """ Threshold based localization of the sound event in the clip using the temporal prediction.
 
         :param temporalPrediction: A 3-dimension numpy array (<nb clip>, <nb frame>, <nb class>)
-        :return: The result of the system under the form of a strong annotation text where each represent on timed event
+        :param kwargs: Extra arguments. None possible in this method
+        :return: the activity mask (<nb clip>, <nb frame>, <nb class>)
         """
+        # binarize the results using the thresholds (default or optimized) provided by the Binarizer
+        # the holes smaller than 200 ms are merged by the post processing (see encode fill_gap)
+        binarizer = Binarizer()
+        return binarizer.binarize(temporalPrediction, dtype=bool)
 
-        def futureIsFlat(prediction: np.array, currentPos: int, flat: float = 0.05, window_size: int = 5) -> bool:
-            """
-            Detect what is following is "kinda" flat.
-            :param prediction: The prediction values of the current class
-            :param currentPos: The current position of the window (left side)
-            :return: True is the near future of the curve is flat, False otherwise
-            """
-            slopes = 0
-
-            # if not future possible (end of the curve)
-            if (currentPos + 2 * window_size) > len(prediction):
-                return False
-
-            # sum the slope value for the next <window_size> window
-            for i in range(currentPos, currentPos + 2 * window_size):
-                window = prediction[i:i + window_size]
-                slopes += window[-1] - window[0]
-
-            averageSlope = slopes / 2 * window_size
+    def __encodeUsingDerivative(self, temporalPrediction: np.array, **kwargs) -> np.array:
+        """ Threshold based localization of the sound event in the clip using the temporal prediction.
 
-            # is approximately flat, the return True, else False
-            return abs(averageSlope) < flat
+        A rising slope start a segment, a decreasing slope followed by a flat plateau end it.
 
+        :param temporalPrediction: A 3-dimension numpy array (<nb clip>, <nb frame>, <nb class>)
+        :return: the activity mask (<nb clip>, <nb frame>, <nb class>)
+        """
         # retreive the argument from kwargs
         keys = kwargs.keys()
         rising = kwargs["rising"] if "rising" in keys else 0.5
@@ -291,66 +246,30 @@ class Encoder:
         window_size = kwargs["window_size"] if "window_size" in keys else 5
         high = kwargs["high"] if "high" in keys else 0.5
 
-        output = []
-
-        for clip in temporalPrediction:
-            cls = 0
-            labeled = dict()
-
-            for predictionPerClass in clip.T:
-
-                nbSegment = 1
-                segments = []
-                segment = [0.0, 0]
-                for i in range(len(predictionPerClass) - window_size):
-                    window = predictionPerClass[i:i+window_size]
+        nbFrame = temporalPrediction.shape[1]
 
-                    slope = window[-1] - window[0]
+        # slope of the window starting at each frame (the windows are truncated at the end of the clip)
+        last = np.minimum(np.arange(nbFrame) + window_size - 1, nbFrame - 1)
+        slope = temporalPrediction[:, last] - temporalPrediction
 
-                    # first element
-                    if i == 0:
-                        segment = [1.0, 1] if window[0] > high else [0.0, 1]
+        # the near future is "flat" when the average slope of the next 2 * <window_size> windows is small
+        cumSlope = np.zeros((slope.shape[0], nbFrame + 1, slope.shape[2]))
+        np.cumsum(slope, axis=1, out=cumSlope[:, 1:])
+        futureIsFlat = np.zeros(slope.shape, dtype=bool)
+        nbFuture = max(nbFrame - 2 * window_size + 1, 0)
+        futureSlopes = cumSlope[:, 2 * window_size:2 * window_size + nbFuture] - cumSlope[:, :nbFuture]
+        futureIsFlat[:, :nbFuture] = np.abs(futureSlopes / 2 * window_size) < flat
 
-                    # rising slope while on "low" segment --> changing segment
-                    if slope > rising and segment[0] == 0:
-                        segments.append(segment)
-                        nbSegment += 1
-                        segment = [1.0, 1]
+        # rising slope --> high segment, decreasing slope followed by a flat future --> low segment
+        decision = np.full(temporalPrediction.shape, -1, dtype=np.int8)
+        decision[:, 0] = temporalPrediction[:, 0] > high
+        decision[(slope < decreasing) & futureIsFlat] = 0
+        decision[slope > rising] = 1
+        decision[:, max(nbFrame - window_size, 1):] = -1
 
-                    # rising slope while on "high" segment --> same segment
-                    elif slope > rising and segment[0] == 1:
-                        segment[1] += 1
+        return self.__hold(decision)
 
-                    # decreasing slope while on "low" segment --> same segment
-                    elif slope < decreasing and segment[0] == 0:
-                        segment[1] += 1
-
-                    # decreasing slope while on "high" segment --> one extra condition, future is flat ?
-                    elif slope < decreasing and segment[0] == 1:
-                        # is there is no flat plateau right after --> same segment
-                        if not futureIsFlat(predictionPerClass, i, flat, window_size):
-                            segment[1] += 1
-
-                        # Otherwise --> change segment
-                        else:
-                            segments.append(segment)
-                            nbSegment += 1
-                            segment = [0.0, 1]
-
-
-                    else:
-                        segment[1] += 1
-
-                if nbSegment == 1:
-                    segments.append(copy.copy(segment))
-
-                labeled[cls] = segments
-                cls += 1
-
-            output.append(labeled)
-        return output
-
-    def __encodeUsingPrimitive(self, temporalPrediction: np.array, **kwargs) -> list:
+    def __encodeUsingPrimitive(self, temporalPrediction: np.array, **kwargs) -> np.array:
         """ Area under the curve based localization of the sound event using the temporal prediction.
 
         Given a sliding window, the area under the curve of the window is computed and, The area under the curve
@@ -359,104 +278,110 @@ class Encoder:
 
         :param temporalPrediction: A 3-dimension numpy array (<nb clip>, <nb frame>, <nb class>)
         :param kwargs: Extra arguments like "window_size" and "threshold"
-        :return: The result of the system under the form of a strong annotation text where each represent on timed event
+        :return: the activity mask (<nb clip>, <nb frame>, <nb class>)
         """
-
-        def area(window: list) -> float:
-            """ Compute the area under the curve inside a window
-
-            :param window: the current window
-            :return: the area under the curve
-            """
-            area = 0
-            for i in range(len(window) - 1):
-                area += (window[i+1] + window[i]) / 2
-
-            return area
-
         # retreiving extra arguments
         keys = kwargs.keys()
         window_size = kwargs["window_size"] if "window_size" in keys else 5
         threshold = kwargs["threshold"] if "threshold" in keys else window_size / 4
         stride = kwargs["stride"] if "stride" in keys else 1
-        padding = kwargs["padding"] if "padding" in keys else "same"
 
-        output = []
-        for clip in temporalPrediction:
-            labeled = dict()
-            cls = 0
-            for predictionPerClass in clip.T:
-                paddedPredictionPerClass = self.__pad(predictionPerClass, window_size, method=padding)
-
-                nbSegment = 1
-                segments = []
-                segment = None
-                for i in range(0, len(paddedPredictionPerClass) - window_size, stride):
-                    window = paddedPredictionPerClass[i:i+window_size]
-                    wArea = area(window)
-
-                    # first element
-                    if i == 0:
-                        segment = [1.0, 1] if wArea > threshold else [0.0, 1]
-
-                    # then
-                    if wArea > threshold and segment[0] == 1:
-                        segment[1] += 1
-
-                    elif wArea > threshold and segment[0] == 0:
-                        segments.append(segment)
-                        nbSegment += 1
-                        segment = [1.0, 1]
-
-                    elif wArea <= threshold and segment[0] == 0:
-                        segment[1] += 1
-
-                    elif wArea <= threshold and segment[0] == 1:
-                        segments.append(segment)
-                        nbSegment += 1
-                        segment = [0.0, 1]
-
-                if nbSegment == 1:
-                    segments.append(segment)
-
-                labeled[cls] = copy.copy(segments)
-                cls += 1
-
-            output.append(labeled)
-        return output
-
-    def parse(self, allSegments: str, testFilesName: list) -> str:
+        nbFrame = temporalPrediction.shape[1]
+
+        # "same" padding, the last value is repeated so every frame has a complete window
+        padded = np.concatenate(
+            (temporalPrediction, np.repeat(temporalPrediction[:, -1:], window_size - 1, axis=1)), axis=1)
+
+        # trapezoidal area: sum of the window minus half of its two borders
+        cumulative = np.zeros((padded.shape[0], padded.shape[1] + 1, padded.shape[2]))
+        np.cumsum(padded, axis=1, out=cumulative[:, 1:])
+        windowSum = cumulative[:, window_size:window_size + nbFrame] - cumulative[:, :nbFrame]
+        area = windowSum - (padded[:, :nbFrame] + padded[:, window_size - 1:window_size - 1 + nbFrame]) / 2
+
+        # one decision every <stride> frames, kept until the next one
+        decided = (np.arange(nbFrame) // stride) * stride
+        return area[:, decided] > threshold
+
+    def __lines(self, allSegments: np.array, testFilesName: list):
+        """ Generate the strong annotation lines, one per segment and one (filename only) per empty clip."""
+        for filename, clipSegments in self.__clips(allSegments, testFilesName):
+            for segment in clipSegments:
+                yield "%s\t%f\t%f\t%s\n" % (
+                    filename,
+                    segment["onset"] * self.frameLength,
+                    segment["offset"] * self.frameLength,
+                    DCASE2018.class_correspondence_reverse[int(segment["cls"])]
+                )
+
+            if len(clipSegments) == 0:
+                yield "%s\n" % filename
+
+    def __clips(self, allSegments: np.array, testFilesName: list):
+        """ Generate the (filename, segments of the clip) couples, in the order of the clips."""
+        # the segments are sorted by clip, bounds of the segments of each clip
+        bounds = np.searchsorted(allSegments["clip"], np.arange(len(testFilesName) + 1))
+
+        for clipIndex in range(len(testFilesName)):
+            filename = os.path.basename(testFilesName[clipIndex])[:-4]
+            yield filename, allSegments[bounds[clipIndex]:bounds[clipIndex + 1]]
+
+    def toEvents(self, allSegments: np.array, testFilesName: list) -> list:
+        """ Transform the segments into an event list that can be evaluated directly (no file needed).
+
+        :param allSegments: the structured array of segments returned by encode
+        :param testFilesName: the list of filename in the same order than the clips given to encode
+        :return: a list of dict {"filename", "onset", "offset", "event_label"}, one per segment
+        """
+        onsets = allSegments["onset"] * self.frameLength
+        offsets = allSegments["offset"] * self.frameLength
+        filenames = [os.path.basename(f)[:-4] for f in testFilesName]
+
+        return [
+            {
+                "filename": filenames[allSegments["clip"][i]],
+                "onset": float(onsets[i]),
+                "offset": float(offsets[i]),
+                "event_label": DCASE2018.class_correspondence_reverse[int(allSegments["cls"][i])]
+            }
+            for i in range(len(allSegments))
+        ]
+
+    def clipEvents(self, allSegments: np.array, nbClip: int) -> list:
+        """ Group the events by clip, for clips without filename (inference on raw features).
+
+        :param allSegments: the structured array of segments returned by encode
+        :param nbClip: number of clips given to encode
+        :return: one list per clip of dict {"onset", "offset", "event_label"}
+        """
+        events = [[] for _ in range(nbClip)]
+        for segment in allSegments:
+            events[int(segment["clip"])].append({
+                "onset": float(segment["onset"] * self.frameLength),
+                "offset": float(segment["offset"] * self.frameLength),
+                "event_label": DCASE2018.class_correspondence_reverse[int(segment["cls"])]
+            })
+
+        return events
+
+    def parse(self, allSegments: np.array, testFilesName: list) -> str:
         """ Transform a list of segment into a txt file ready for evaluation.
 
-        :param allSegments: a list of dict of 10 key. the list length is equal to the number of file, the dict number
-        of key to the number of class
-        :param testFilesName: the list of filename in the same order than the list allSegments
+        :param allSegments: the structured array of segments returned by encode
+        :param testFilesName: the list of filename in the same order than the clips given to encode
         :return: a str file ready for evaluation using dcase_util evaluation_measure.py
         """
-        output = ""
-
-        for clipIndex in range(len(allSegments)):
-            clip = allSegments[clipIndex]
-
-            nbSegment = 0
-            for cls in clip:
-                start = 0
-
-                for segment in clip[cls]:
-                    if segment[0] == 1.0:
-                        output += "%s\t%f\t%f\t%s\n" % (
-                            os.path.basename(testFilesName[clipIndex])[:-4],
-                            start * self.frameLength,
-                            (start + segment[1]) * self.frameLength,
-                            DCASE2018.class_correspondence_reverse[cls]
-                        )
-                        nbSegment += 1
-                    start += segment[1]
-                
-            if nbSegment == 0:
-                output += "%s\n" % (os.path.basename(testFilesName[clipIndex])[:-4])
-
-        return output
+        return "".join(self.__lines(allSegments, testFilesName))
+
+    def export(self, allSegments: np.array, testFilesName: list, path: str):
+        """ Write the segments into a csv file ready for evaluation, line after line through a buffered writer.
+
+        :param allSegments: the structured array of segments returned by encode
+        :param testFilesName: the list of filename in the same order than the clips given to encode
+        :param path: path of the csv file
+        """
+        with open(path, "w", buffering=1 << 20) as f:
+            f.write("filename\tonset\toffset\tevent_label\n")
+            f.writelines(self.__lines(allSegments, testFilesName))
 
 if __name__=='__main__':
     import random
@@ -480,9 +405,8 @@ if __name__=='__main__':
 
         #o = e.encode(prediction)       # basic thresold with hold filling
         o = e.encode(prediction, method="primitive")
-        for k in o:
-            print(len(k[0]), k[0])
-        t = e.parse(o, prediction[:,0,0])
+        print(o[o["clip"] == 0])
+        t = e.parse(o, ["clip_%s.wav.npy" % i for i in range(len(prediction))])
 
 
     fakeTemporalPrediction()
@@ -0,0 +1,138 @@
+"""
+Per class fusion of several temporal predictions (heads of a model or models of an ensemble).
+
+The fusion is described by a weight matrix (<nb source>, <nb class>) giving the weight of each source for each class:
+ - select: the class c is taken from the source of highest weight for c (see selection_weights)
+ - average: weighted average of the sources, the weights of each class being normalized
+ - max: maximum of the sources having a positive weight for the class
+fuse works on numpy arrays, fuse_tensors is the same operation on Keras tensors (see Models.fused_temporal).
+"""
+import numpy as np
+
+MODES = ("select", "average", "max")
+
+
+def selection_weights(sources, nb_source: int = None) -> np.array:
+    """
+    One hot weight matrix from the source of each class.
+    :param sources: index of the source of each class (list of <nb class> int)
+    :param nb_source: number of sources, default the highest index + 1
+    :return: (<nb source>, <nb class>) matrix of 0 and 1
+    """
+    sources = np.asarray(sources, dtype=int)
+    if nb_source is None:
+        nb_source = sources.max() + 1
+
+    weights = np.zeros((nb_source, len(sources)), dtype=np.float32)
+    weights[sources, np.arange(len(sources))] = 1
+    return weights
+
+
+def check_weights(weights, nb_source: int, mode: str) -> np.array:
+    weights = np.asarray(weights, dtype=np.float32)
+
+    if mode not in MODES:
+        raise ValueError("Unknown fusion mode: %s %s" % (mode, MODES))
+    if weights.ndim != 2 or weights.shape[0] != nb_source:
+        raise ValueError("The weights must be a (<nb source>, <nb class>) matrix, %d sources" % nb_source)
+    if (weights < 0).any() or not (weights > 0).any(axis=0).all():
+        raise ValueError("The weights must be positive with at least one source for each class")
+
+    return weights
+
+
+def fuse(predictions, weights, mode: str = "select", out: np.array = None) -> np.array:
+    """
+    Fuse N temporal predictions class by class.
+    :param predictions: list of N arrays (..., <nb class>) of the same shape, or one array (N, ..., <nb class>)
+    :param weights: (N, <nb class>) weight of each source for each class
+    :param mode: select, average or max
+    :param out: Optional preallocated buffer receiving the result
+    :return: the fused prediction (..., <nb class>)
+    """
+    stacked = np.asarray(predictions)
+    weights = check_weights(weights, stacked.shape[0], mode)
+    broadcast = (1,) * (stacked.ndim - 2) + (weights.shape[1],)
+
+    if mode == "select":
+        sources = np.argmax(weights, axis=0).reshape((1,) + broadcast)
+        fused = np.take_along_axis(stacked, sources, axis=0)[0]
+
+    elif mode == "average":
+        fused = np.einsum("n...c,nc->...c", stacked, weights / weights.sum(axis=0))
+
+    else:
+        masked = np.where(weights.reshape((-1,) + broadcast) > 0, stacked, -np.inf)
+        fused = masked.max(axis=0)
+
+    if out is None:
+        return fused.astype(stacked.dtype, copy=False)
+
+    out[...] = fused
+    return out
+
+
+def fuse_tensors(tensors: list, weights, mode: str = "select"):
+    """
+    Same fusion as fuse on a list of N Keras tensors (<batch>, ..., <nb class>), the weights being constants.
+    """
+    from keras import backend as K
+
+    weights = check_weights(weights, len(tensors), mode)
+    broadcast = (len(tensors),) + (1,) * (K.ndim(tensors[0]) - 1) + (weights.shape[1],)
+    stacked = K.stack(tensors, axis=0)
+
+    if mode == "select":
+        weights = selection_weights(np.argmax(weights, axis=0), len(tensors))
+    elif mode == "average":
+        weights = weights / weights.sum(axis=0)
+    else:
+        # the sources without weight are pushed far below the others
+        penalty = K.constant(np.where(weights > 0, 0, -1e9).reshape(broadcast))
+        return K.max(stacked + penalty, axis=0)
+
+    return K.sum(stacked * K.constant(weights.reshape(broadcast)), axis=0)
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nb_clip", type=int, default=288)
+    parser.add_argument("--nb_frame", type=int, default=215)
+    parser.add_argument("--nb_source", type=int, default=2)
+    args = parser.parse_args()
+
+    nbClass = 10
+    predictions = [np.random.rand(args.nb_clip, args.nb_frame, nbClass).astype(np.float32)
+                   for _ in range(args.nb_source)]
+    sources = np.random.randint(args.nb_source, size=nbClass)
+
+    # the former mixing loop of main.py (one list of list per clip, one column at a time)
+    start = time.time()
+    expected = []
+    for i in range(args.nb_clip):
+        curves = np.array([[0] * nbClass for _ in range(args.nb_frame)], dtype=np.float32)
+        for c in range(nbClass):
+            curves[:, c] = predictions[sources[c]][i][:, c]
+        expected.append(curves)
+    expected = np.array(expected)
+    loopTime = time.time() - start
+
+    start = time.time()
+    fused = fuse(predictions, selection_weights(sources, args.nb_source), mode="select")
+    fuseTime = time.time() - start
+
+    print("select, loop: %.4f s, fuse: %.4f s (x%.0f), identical: %s" % (
+        loopTime, fuseTime, loopTime / fuseTime, np.array_equal(expected, fused)))
+
+    weights = np.random.rand(args.nb_source, nbClass)
+    average = fuse(predictions, weights, mode="average")
+    reference = sum(w * p for w, p in zip(weights / weights.sum(axis=0), predictions))
+    print("average, max |difference|: %.2e" % np.abs(average - reference).max())
+
+    mask = selection_weights(sources, args.nb_source) + (np.random.rand(args.nb_source, nbClass) > 0.5)
+    maximum = fuse(predictions, mask, mode="max")
+    reference = np.max([np.where(m > 0, p, -np.inf) for m, p in zip(mask, predictions)], axis=0)
+    print("max, identical: %s" % np.array_equal(maximum, reference))
@@ -1,4 +1,5 @@
 from keras import backend as K
+import numpy as np
 
 
 # ==================================================================================================================
@@ -64,3 +65,41 @@ def f1(y_true, y_pred):
     return 2 * ((prec * rec) / (prec + rec + K.epsilon()))
 
 
+
+
+# ==================================================================================================================
+#   Metrics for numpy (per class, on the whole set)
+# ==================================================================================================================
+def confusion_counts(y_true: np.array, y_pred: np.array) -> tuple:
+    """
+    Count the true positives, false positives and false negatives of each class in one pass.
+    :param y_true: the binary labels, the classes on the last axis
+    :param y_pred: the binarized prediction, same shape
+    :return: tp, fp, fn, one vector of <nb class> counts each
+    """
+    nb_class = y_true.shape[-1]
+    y_true = np.asarray(y_true, dtype=bool).reshape(-1, nb_class)
+    y_pred = np.asarray(y_pred, dtype=bool).reshape(-1, nb_class)
+
+    tp = np.count_nonzero(y_true & y_pred, axis=0)
+    fp = np.count_nonzero(y_pred, axis=0) - tp
+    fn = np.count_nonzero(y_true, axis=0) - tp
+
+    return tp, fp, fn
+
+
+def class_scores(tp: np.array, fp: np.array, fn: np.array) -> tuple:
+    """
+    Precision, recall and f1 of each class from the confusion counts, 0 when undefined (as sklearn does).
+    :return: precision, recall, f1, one vector of <nb class> values each
+    """
+    def ratio(numerator, denominator):
+        result = np.zeros(len(numerator))
+        np.divide(numerator, denominator, out=result, where=denominator != 0)
+        return result
+
+    precision = ratio(tp, tp + fp)
+    recall = ratio(tp, tp + fn)
+    f1 = ratio(2 * tp, 2 * tp + fp + fn)
+
+    return precision, recall, f1
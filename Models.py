@@ -1,11 +1,17 @@
+import os
+
 from datasetGenerator import DCASE2018
+import Fusion
+
+import numpy as np
 
 import keras.utils
 from keras.layers import Reshape, BatchNormalization, Activation, MaxPooling2D, Conv2D, Dropout, GRU, Dense, \
     Input, Bidirectional, TimeDistributed, GlobalAveragePooling1D, Concatenate, GRUCell, SpatialDropout2D, \
     Flatten, Multiply, GlobalAveragePooling2D, GlobalMaxPooling2D
 
-from keras.models import Model, model_from_json
+from keras.models import Model, model_from_json, load_model
+from keras.engine.topology import Layer
 from keras import backend as K
 from keras import regularizers
 
@@ -25,8 +31,17 @@ class CustomGRUCell(GRUCell):
                          kernel_constraint, recurrent_constraint, bias_constraint, dropout, recurrent_dropout,
                          implementation, reset_after, **kwargs)
 
+        # set by CustomGRU when the inputs are already projected by the kernel (implementation 2)
+        self.precomputed = False
+
         print("Temporal weight : ", self.temporal_weight)
 
+    def build(self, input_shape):
+        super().build(input_shape)
+
+        # recurrent kernel of the update and reset gates, sliced once instead of at each timestep (implementation 2)
+        self.recurrent_kernel_zr = self.recurrent_kernel[:, :2 * self.units]
+
     def call(self, inputs, states, training=None):
         h_tm1 = states[0]  # previous memory
 
@@ -67,14 +82,8 @@ class CustomGRUCell(GRUCell):
                 x_r = K.bias_add(x_r, self.input_bias_r)
                 x_h = K.bias_add(x_h, self.input_bias_h)
 
-            if 0. < self.recurrent_dropout < 1.:
-                h_tm1_z = h_tm1 * self.temporal_weight  # rec_dp_mask[0]
-                h_tm1_r = h_tm1 * self.temporal_weight  # rec_dp_mask[1]
-                h_tm1_h = h_tm1 * self.temporal_weight  # rec_dp_mask[2]
-            else:
-                h_tm1_z = h_tm1 * self.temporal_weight
-                h_tm1_r = h_tm1 * self.temporal_weight
-                h_tm1_h = h_tm1 * self.temporal_weight
+            # the temporal weight replaces the recurrent dropout masks
+            h_tm1_z = h_tm1_r = h_tm1_h = h_tm1 * self.temporal_weight
 
             recurrent_z = K.dot(h_tm1_z, self.recurrent_kernel_z)
             recurrent_r = K.dot(h_tm1_r, self.recurrent_kernel_r)
@@ -96,30 +105,33 @@ class CustomGRUCell(GRUCell):
 
             hh = self.activation(x_h + recurrent_h)
         else:
-            if 0. < self.dropout < 1.:
-                inputs *= dp_mask[0]
+            if self.precomputed:
+                # inputs already projected for all the timesteps (see CustomGRU.call)
+                matrix_x = inputs
+            else:
+                if 0. < self.dropout < 1.:
+                    inputs *= dp_mask[0]
 
-            # inputs projected by all gate matrices at once
-            matrix_x = K.dot(inputs, self.kernel)
-            if self.use_bias:
-                # biases: bias_z_i, bias_r_i, bias_h_i
-                matrix_x = K.bias_add(matrix_x, self.input_bias)
+                # inputs projected by all gate matrices at once
+                matrix_x = K.dot(inputs, self.kernel)
+                if self.use_bias:
+                    # biases: bias_z_i, bias_r_i, bias_h_i
+                    matrix_x = K.bias_add(matrix_x, self.input_bias)
             x_z = matrix_x[:, :self.units]
             x_r = matrix_x[:, self.units: 2 * self.units]
             x_h = matrix_x[:, 2 * self.units:]
 
-            if 0. < self.recurrent_dropout < 1.:
-                h_tm1 *= rec_dp_mask[0]
+            # the temporal weight replaces the recurrent dropout mask, the update below uses the plain h_tm1
+            h_tm1_w = h_tm1 * self.temporal_weight
 
             if self.reset_after:
                 # hidden state projected by all gate matrices at once
-                matrix_inner = K.dot(h_tm1, self.recurrent_kernel)
+                matrix_inner = K.dot(h_tm1_w, self.recurrent_kernel)
                 if self.use_bias:
                     matrix_inner = K.bias_add(matrix_inner, self.recurrent_bias)
             else:
                 # hidden state projected separately for update/reset and new
-                matrix_inner = K.dot(h_tm1,
-                                     self.recurrent_kernel[:, :2 * self.units])
+                matrix_inner = K.dot(h_tm1_w, self.recurrent_kernel_zr)
 
             recurrent_z = matrix_inner[:, :self.units]
             recurrent_r = matrix_inner[:, self.units: 2 * self.units]
@@ -130,8 +142,7 @@ class CustomGRUCell(GRUCell):
             if self.reset_after:
                 recurrent_h = r * matrix_inner[:, 2 * self.units:]
             else:
-                recurrent_h = K.dot(r * h_tm1,
-                                    self.recurrent_kernel[:, 2 * self.units:])
+                recurrent_h = K.dot(r * h_tm1_w, self.recurrent_kernel_h)
 
             hh = self.activation(x_h + recurrent_h)
 
@@ -144,6 +155,11 @@ class CustomGRUCell(GRUCell):
 
         return h, [h]
 
+    def get_config(self):
+        config = super().get_config()
+        config["temporal_weight"] = self.temporal_weight
+        return config
+
 
 class CustomGRU(GRU):
 
@@ -152,7 +168,8 @@ class CustomGRU(GRU):
                  kernel_regularizer=None, recurrent_regularizer=None, bias_regularizer=None, activity_regularizer=None,
                  kernel_constraint=None, recurrent_constraint=None, bias_constraint=None, dropout=0.,
                  recurrent_dropout=0., implementation=1, return_sequences=False, return_state=False, go_backwards=False,
-                 stateful=False, unroll=False, reset_after=False, temporal_weight: float = 0.5, **kwargs):
+                 stateful=False, unroll=False, reset_after=False, temporal_weight: float = 0.5,
+                 precompute_inputs: bool = False, **kwargs):
         """
         super().__init__(units, activation=activation, recurrent_activation=recurrent_activation,
                          use_bias=use_bias, kernel_initializer=kernel_initializer,
@@ -167,6 +184,9 @@ class CustomGRU(GRU):
         """
 
         self.temporal_weight = temporal_weight
+        # implementation 2 only: project the inputs of all the timesteps before the recurrence. Slower with the
+        # TensorFlow CPU backend (K.rnn transposes and reverses the 3 times wider projections), see the __main__
+        self.precompute_inputs = precompute_inputs
 
         cell = CustomGRUCell(units,
                              activation=activation,
@@ -199,9 +219,18 @@ class CustomGRU(GRU):
     def get_config(self):
         config = super().get_config()
         config["temporal_weight"] = self.temporal_weight
+        config["precompute_inputs"] = self.precompute_inputs
         return config
 
     def call(self, inputs, mask=None, training=None, initial_state=None):
+        # one projection of the inputs of all the timesteps, outside of the recurrence
+        self.cell.precomputed = self.precompute_inputs and self.cell.implementation == 2 \
+            and not 0. < self.cell.dropout < 1.
+        if self.cell.precomputed:
+            inputs = K.dot(inputs, self.cell.kernel)
+            if self.cell.use_bias:
+                inputs = K.bias_add(inputs, self.cell.input_bias)
+
         return super().call(inputs, mask, True, initial_state)
 
 
@@ -226,33 +255,91 @@ def save(dir_path: str, model: Model, transfer: bool = False):
         open(dir_path + "_transfer", "w").write("")
 
 
-def use_wgru(model_path: str) -> Model:
-    with open(model_path + "_model.json") as modelJsonFile:
-        model = model_from_json(modelJsonFile.read())
-        print("model loaded")
+class FusionLayer(Layer):
+    """
+    Per class fusion of several temporal predictions (<batch>, <frame>, <class>) of the same shape (see Fusion).
+    """
+    def __init__(self, fusion_weights, mode: str = "select", **kwargs):
+        self.fusion_weights = np.asarray(fusion_weights, dtype=np.float32).tolist()
+        self.mode = mode
+        super().__init__(**kwargs)
+
+    def call(self, inputs, **kwargs):
+        return Fusion.fuse_tensors(inputs, self.fusion_weights, self.mode)
+
+    def compute_output_shape(self, input_shape):
+        return input_shape[0]
 
-    layers = [l for l in model.layers]
+    def get_config(self):
+        config = super().get_config()
+        config["fusion_weights"] = self.fusion_weights
+        config["mode"] = self.mode
+        return config
 
-    x = layers[0].output
-    for i in range(1, len(layers)):
-        if layers[i].name[:5] == "bidir":
-            x = Bidirectional(
-                CustomGRU(units=64, kernel_initializer='glorot_uniform', recurrent_dropout=0.8,
-                          dropout=0.0, return_sequences=True, temporal_weight=0.25), name="custom_bi")(x)
 
-        elif layers[i].name[:5] == "time_":
-            time_name = layers[i].name
-            print("name ::::::: ", time_name)
-            x = TimeDistributed(Dense(10, activation="sigmoid"))(x)
+def fused_temporal(model: Model, wgru_classes: list, temporal_weight: float = 0.25) -> Model:
+    """
+    One inference model for the temporal predictions of the GRU and WGRU heads. The CNN trunk is shared, the WGRU head
+    is a copy of the recurrent and time distributed layers of <model> (same weights) using a CustomGRU, and the output
+    is the WGRU curve for the classes of <wgru_classes> and the GRU one for the others.
+    :param model: a trained crnn, its first Bidirectional and TimeDistributed layers form the GRU head
+    :param wgru_classes: index of the classes taken from the WGRU head
+    :param temporal_weight: weight of the previous state in the gates of the WGRU
+    :return: the model giving the fused temporal prediction (<nb clip>, <nb frame>, <nb class>)
+    """
+    bidirectional = [l for l in model.layers if isinstance(l, Bidirectional)][0]
+    distributed = [l for l in model.layers if isinstance(l, TimeDistributed)][0]
+
+    # WGRU head, built on the output of the trunk then loaded with the GRU head weights
+    wgru_bidirectional = Bidirectional(
+        CustomGRU(units=bidirectional.forward_layer.units, kernel_initializer='glorot_uniform', recurrent_dropout=0.8,
+                  dropout=0.0, return_sequences=True, temporal_weight=temporal_weight, implementation=2),
+        name="custom_bi")
+
+    dense_config = distributed.layer.get_config()
+    dense_config["name"] = "custom_dense"
+    wgru_distributed = TimeDistributed(Dense.from_config(dense_config), name="custom_time_distributed")
+
+    wgru_output = wgru_distributed(wgru_bidirectional(bidirectional.input))
+    wgru_bidirectional.set_weights(bidirectional.get_weights())
+    wgru_distributed.set_weights(distributed.get_weights())
+
+    nbClass = distributed.layer.units
+    sources = [1 if c in wgru_classes else 0 for c in range(nbClass)]
+    weights = Fusion.selection_weights(sources, nb_source=2)
+    output = FusionLayer(weights, mode="select", name="fusion")([distributed.output, wgru_output])
+
+    return Model(inputs=model.inputs, outputs=output)
 
-        else:
-            x = layers[i](x)
-        print(x)
 
-    new_model = Model(input=layers[0].input, output=x)
-    new_model.load_weights(model_path + "_weight.h5py")
+# layers of the repository, needed to deserialize the models using them
+CUSTOM_OBJECTS = {"CustomGRUCell": CustomGRUCell, "CustomGRU": CustomGRU, "FusionLayer": FusionLayer}
+keras.utils.get_custom_objects().update(CUSTOM_OBJECTS)
 
-    return Model(input=new_model.input, output=new_model.get_layer("time_distributed_1").output)
+
+def save_inference(dir_path: str, model: Model):
+    """ Save the complete inference model (architecture and weights, without optimizer) in <dir_path>_inference.h5 """
+    model.save(dir_path + "_inference.h5", include_optimizer=False)
+
+
+def load_inference(dir_path: str) -> Model:
+    """ Load the model saved by save_inference as it is, not compiled """
+    return load_model(dir_path + "_inference.h5", custom_objects=CUSTOM_OBJECTS, compile=False)
+
+
+def temporal_model(dir_path: str, wgru_classes: list = (0, 2, 1), temporal_weight: float = 0.25) -> Model:
+    """
+    The fused temporal model of a trained crnn: the inference artifact if it exists, otherwise it is built once from
+    the saved crnn (see fused_temporal) and saved next to it.
+    :param wgru_classes: see fused_temporal, only used when the artifact is built
+    :param temporal_weight: see fused_temporal, only used when the artifact is built
+    """
+    if os.path.isfile(dir_path + "_inference.h5"):
+        return load_inference(dir_path)
+
+    model = fused_temporal(load(dir_path), wgru_classes=list(wgru_classes), temporal_weight=temporal_weight)
+    save_inference(dir_path, model)
+    return model
 
 
 def crnn_mel64_tr2(dataset: DCASE2018) -> Model:
@@ -386,3 +473,64 @@ def full_cnn(dataset):
 
     model1 = Model(inputs=[melInput], outputs=output)
     model1.summary(line_length=100)
+
+
+if __name__ == "__main__":
+    import argparse
+    import shutil
+    import tempfile
+    import time
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nb_clip", type=int, default=32)
+    parser.add_argument("--nb_frame", type=int, default=215, help="timesteps (output frames of the CNN)")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    # CPU step time of the recurrent heads on the trunk output (<nb frame>, 64)
+    features = np.random.randn(args.nb_clip, args.nb_frame, 64).astype(np.float32)
+    heads = {
+        "GRU": GRU(units=64, return_sequences=True),
+        "WGRU implementation 1": CustomGRU(units=64, recurrent_dropout=0.8, return_sequences=True,
+                                           temporal_weight=0.25, implementation=1),
+        "WGRU implementation 2": CustomGRU(units=64, recurrent_dropout=0.8, return_sequences=True,
+                                           temporal_weight=0.25, implementation=2),
+        "WGRU 2, precomputed": CustomGRU(units=64, recurrent_dropout=0.8, return_sequences=True,
+                                         temporal_weight=0.25, implementation=2, precompute_inputs=True),
+    }
+
+    predictions = {}
+    for name, layer in heads.items():
+        head_input = Input((args.nb_frame, 64))
+        head = Model(inputs=head_input, outputs=Bidirectional(layer)(head_input))
+        if predictions:
+            head.set_weights(weights)
+        weights = head.get_weights()
+
+        predictions[name] = head.predict(features, batch_size=args.nb_clip)
+        start = time.time()
+        for _ in range(args.repeat):
+            head.predict(features, batch_size=args.nb_clip)
+        duration = (time.time() - start) / args.repeat
+
+        print("%-22s %7.1f ms / batch, %6.3f ms / step" % (name, duration * 1000, duration * 1000 / args.nb_frame))
+
+    for name in ("WGRU implementation 2", "WGRU 2, precomputed"):
+        difference = np.abs(predictions["WGRU implementation 1"] - predictions[name]).max()
+        print("WGRU implementation 1 / %s, max |difference|: %.2e" % (name, difference))
+
+    # save -> load -> predict round trip of a fused GRU / WGRU head (see save_inference)
+    head_input = Input((args.nb_frame, 64))
+    gru = Bidirectional(GRU(units=64, return_sequences=True))(head_input)
+    crnn = Model(inputs=head_input, outputs=TimeDistributed(Dense(10, activation="sigmoid"))(gru))
+    fused = fused_temporal(crnn, wgru_classes=[0, 2, 1])
+
+    path = os.path.join(tempfile.mkdtemp(), "model")
+    save_inference(path, fused)
+    start = time.time()
+    loaded = load_inference(path)
+    duration = time.time() - start
+
+    difference = np.abs(fused.predict(features) - loaded.predict(features)).max()
+    print("inference model loaded in %.2f s, max |difference|: %.2e" % (duration, difference))
+    shutil.rmtree(os.path.dirname(path))
@@ -17,37 +17,107 @@ class MethodsDoesNotExist(Exception):
         super().__init__(*args, **kwargs)
 
 
+def output_buffer(m: np.array, out: np.array = None, dtype=None) -> np.array:
+    """
+    Return the array that will receive the result of a transformation.
+    :param m: N-dimension array to transform
+    :param out: Caller-supplied buffer, can be m itself for an in place transformation
+    :param dtype: dtype of the new buffer when out is not given, default to the (floating) dtype of m
+    :return: the buffer to fill, of the same shape than m
+    """
+    if out is not None:
+        if out.shape != m.shape:
+            raise WrongShapeException("Output buffer should be of shape %s" % str(m.shape))
+        return out
+
+    if dtype is None:
+        dtype = m.dtype if np.issubdtype(m.dtype, np.floating) else np.float64
+
+    return np.empty(m.shape, dtype=dtype)
+
+
+def feature_axes(m: np.array) -> tuple:
+    """ Axes reduced by the "global" statistics: all of them but the last one (the features)."""
+    return tuple(range(m.ndim - 1))
+
+
 class Scaler:
+    # name of the attributes holding the fitted statistics (see save and load)
+    STATISTICS = ()
+
+    # number of files processed at once when fitting the "global" statistics
+    FIT_CHUNK = 512
+
     def __init__(self, methods: str = "local"):
         self.methods = methods
 
     def fit(self, m: np.array):
         raise NotImplementedError
 
-    def transform(self, m: np.array) -> np.array:
+    def partial_fit(self, m: np.array):
+        """
+        Update the "global" statistics with a new batch of files, the whole dataset never has to be in memory.
+        :param m: 3-dimension array (<nb file>, <dim 1>, <dim 2>)
+        """
         raise NotImplementedError
 
-    def __2d_transform(self, m: np.array) -> np.array:
+    def reset(self):
+        for key in self.STATISTICS:
+            setattr(self, key, None)
+
+    def _chunked_fit(self, m: np.array):
+        # refit from scratch, chunk after chunk to avoid full size temporary arrays
+        self.reset()
+        for start in range(0, len(m), self.FIT_CHUNK):
+            self.partial_fit(m[start:start + self.FIT_CHUNK])
+
+    def save(self, path: str):
+        """
+        Save the fitted statistics into a .npz file, to reuse them at inference.
+        :param path: path of the .npz file
+        """
+        statistics = {key: getattr(self, key) for key in self.STATISTICS if getattr(self, key) is not None}
+        np.savez(path, methods=self.methods, **statistics)
+
+    def load(self, path: str):
+        """
+        Load statistics saved with save(). The scaler is then considered as fit.
+        :param path: path of the .npz file
+        :return: the scaler itself
+        """
+        with np.load(path) as data:
+            self.methods = str(data["methods"])
+
+            for key in self.STATISTICS:
+                setattr(self, key, data[key] if key in data.files else None)
+
+        return self
+
+    def transform(self, m: np.array, out: np.array = None, dtype=None) -> np.array:
         raise NotImplementedError
 
-    def __3d_transform(self, m: np.array) -> np.array:
+    def __2d_transform(self, m: np.array, out: np.array = None, dtype=None) -> np.array:
         raise NotImplementedError
 
-    def fit_transform(self, m: np.array) -> np.array:
+    def __3d_transform(self, m: np.array, out: np.array = None, dtype=None) -> np.array:
+        raise NotImplementedError
+
+    def fit_transform(self, m: np.array, out: np.array = None, dtype=None) -> np.array:
         raise NotImplementedError
 
 
 class MinMaxScaler(Scaler):
+    STATISTICS = ("mini", "maxi")
+
     def __init__(self, methods: str = "local"):
         super().__init__(methods)
-        self.mini = []
-        self.maxi = []
+        self.mini = None
+        self.maxi = None
 
     def fit(self, m: np.array, force: bool = False):
-        if (self.maxi == [] and self.mini == []) or force:
+        if (self.maxi is None and self.mini is None) or force:
             if self.methods == "global":
-                self.mini = m.min(axis=1).min(axis=0)
-                self.maxi = m.max(axis=1).max(axis=0)
+                self._chunked_fit(m)
 
             elif self.methods == "local":
                 self.mini = m.min(axis=0)
@@ -56,50 +126,63 @@ class MinMaxScaler(Scaler):
             else:
                 raise MethodsDoesNotExist("Only available methods: \"global\" or \"local\"")
 
-    def transform(self, m: np.array) -> np.array:
+    def partial_fit(self, m: np.array):
+        # running min and max
+        mini = m.min(axis=feature_axes(m))
+        maxi = m.max(axis=feature_axes(m))
+
+        self.mini = mini if self.mini is None else np.minimum(self.mini, mini)
+        self.maxi = maxi if self.maxi is None else np.maximum(self.maxi, maxi)
+
+    def transform(self, m: np.array, out: np.array = None, dtype=None) -> np.array:
         if self.methods == "global":
-            return self.__3d_transform(m)
+            return self.__3d_transform(m, out, dtype)
         elif self.methods == "local":
-            return self.__2d_transform(m)
+            return self.__2d_transform(m, out, dtype)
         else:
             raise MethodsDoesNotExist("Only available methods: \"global\" or \"local\"")
 
-    def fit_transform(self, m: np.array) -> np.array:
+    def fit_transform(self, m: np.array, out: np.array = None, dtype=None) -> np.array:
         self.fit(m)
-        return self.transform(m)
+        return self.transform(m, out, dtype)
 
-    def __3d_transform(self, m: np.array):
-        if self.mini == [] or self.maxi == []:
+    def __3d_transform(self, m: np.array, out: np.array = None, dtype=None):
+        if self.mini is None or self.maxi is None:
             raise NotFitYet("Data haven't been fit yet, can't perform scaling")
 
         if len(m.shape) != 3:
             raise WrongShapeException("Matrix should be of dimension 3")
 
-        results = []
+        out = output_buffer(m, out, dtype)
+        np.subtract(m, self.mini, out=out)
+        np.divide(out, self.maxi - self.mini, out=out)
 
-        for d in m:
-            results.append((d - self.mini) / (self.maxi - self.mini))
+        return out
 
-        return np.array(results)
+    def __2d_transform(self, m: np.array, out: np.array = None, dtype=None):
+        # statistics of each file, computed before out is written (out can be m)
+        mini = m.min(axis=1, keepdims=True)
+        scale = m.max(axis=1, keepdims=True) - mini
 
-    def __2d_transform(self, m: np.array):
-        results = []
+        out = output_buffer(m, out, dtype)
+        np.subtract(m, mini, out=out)
+        np.divide(out, scale, out=out)
 
-        for d in m:
-            results.append((d - d.min(axis=0)) / (d.max(axis=0) - d.min(axis=0)))
-
-        return np.array(results)
+        return out
 
 
 class MeanScaler(Scaler):
+    STATISTICS = ("mean", "count")
+
     def __init__(self, methods: str = "local"):
         super().__init__(methods)
-        self.mean = []
+        self.mean = None
+        self.count = None
 
     def fit(self, m: np.array, force: bool = False):
-        if self.mean == [] or force:
+        if self.mean is None or force:
             if self.methods == "global":
-                self.mean = m.mean(axis=1).mean(axis=0)
+                self._chunked_fit(m)
 
             elif self.methods == "local":
                 self.mean = m.mean(axis=0)
@@ -107,58 +190,62 @@ class MeanScaler(Scaler):
             else:
                 raise MethodsDoesNotExist("Only available methods: \"global\" or \"local\"")
 
-    def transform(self, m: np.array) -> np.array:
+    def partial_fit(self, m: np.array):
+        # running mean, weighted by the number of values already seen
+        count = m.size // m.shape[-1]
+        mean = m.mean(axis=feature_axes(m), dtype=np.float64)
+
+        if self.count is None:
+            self.count, self.mean = count, mean
+        else:
+            total = self.count + count
+            self.mean = self.mean + (mean - self.mean) * count / total
+            self.count = total
+
+    def transform(self, m: np.array, out: np.array = None, dtype=None) -> np.array:
         if self.methods == "global":
-            return self.__3d_transform(m)
+            return self.__3d_transform(m, out, dtype)
 
         elif self.methods == "local":
-            return self.__2d_transform(m)
+            return self.__2d_transform(m, out, dtype)
 
         else:
             raise MethodsDoesNotExist("Only available methods: \"global\" or \"local\"")
 
-    def fit_transform(self, m: np.array) -> np.array:
+    def fit_transform(self, m: np.array, out: np.array = None, dtype=None) -> np.array:
         self.fit(m)
-        return self.transform(m)
+        return self.transform(m, out, dtype)
 
-    def __3d_transform(self, m: np.array):
-        if not self.mean:
+    def __3d_transform(self, m: np.array, out: np.array = None, dtype=None):
+        if self.mean is None:
             raise NotFitYet("Data haven't been fit yet, can't perform scaling")
 
         if len(m.shape) != 3:
             raise WrongShapeException("Matrix should be of dimension 3")
 
-        results = []
-
-        for d in m:
-            results.append(d - self.mean)
-
-        return np.array(results)
+        out = output_buffer(m, out, dtype)
+        np.subtract(m, self.mean, out=out)
 
-    def __2d_transform(self, m: np.array):
-        results = []
+        return out
 
-        for d in m:
-            results.append(d - d.mean(axis=0))
+    def __2d_transform(self, m: np.array, out: np.array = None, dtype=None):
+        return file_mean_normalization(m, out, dtype)
 
-        return np.array(results)
 
-
-def file_mean_normalization(data: np.array) -> np.array:
+def file_mean_normalization(data: np.array, out: np.array = None, dtype=None) -> np.array:
     """
     Perform a Mean normalization of each file independently.
     :param data: N-dimension array to normalize
+    :param out: Optional buffer receiving the result, can be data itself
+    :param dtype: dtype of the result when out is not given
     :return: data: N-dimension array locally normalized
     """
+    mean = data.mean(axis=1, keepdims=True)
 
-    result = []
-
-    for d in data:
-        mean = d.mean(axis=0)
+    out = output_buffer(data, out, dtype)
+    np.subtract(data, mean, out=out)
 
-        result.append(d - mean)
-
-    return np.array(result)
+    return out
 
 
 def global_mean_normalization(data: np.array) -> np.array:
@@ -175,16 +262,19 @@ def global_mean_normalization(data: np.array) -> np.array:
 
 
 class StandardScaler(Scaler):
+    STATISTICS = ("mean", "std", "count", "m2")
+
     def __init__(self, methods: str = "local"):
         super().__init__(methods)
-        self.std = []
-        self.mean = []
+        self.std = None
+        self.mean = None
+        self.count = None
+        self.m2 = None
 
     def fit(self, m: np.array, force: bool = False):
-        if (self.mean == [] and self.std == []) or force:
+        if (self.mean is None and self.std is None) or force:
             if self.methods == "global":
-                self.mean = m.mean(axis=1).mean(axis=0)
-                self.std = m.std(axis=1).std(axis=0)
+                self._chunked_fit(m)
 
             elif self.methods == "local":
                 self.mean = m.mean(axis=0)
@@ -193,59 +283,80 @@ class StandardScaler(Scaler):
             else:
                 raise MethodsDoesNotExist("Only available methods: \"global\" or \"local\"")
 
-    def transform(self, m: np.array) -> np.array:
+    def partial_fit(self, m: np.array):
+        # Welford / Chan update: merge the mean and the sum of squared deviations (m2) of the batch
+        count = m.size // m.shape[-1]
+        mean = m.mean(axis=feature_axes(m), dtype=np.float64)
+        m2 = np.square(m - mean).sum(axis=feature_axes(m))
+
+        if self.count is None:
+            self.count, self.mean, self.m2 = count, mean, m2
+        else:
+            total = self.count + count
+            delta = mean - self.mean
+
+            self.mean = self.mean + delta * count / total
+            self.m2 = self.m2 + m2 + np.square(delta) * self.count * count / total
+            self.count = total
+
+        self.std = np.sqrt(self.m2 / self.count)
+
+    def transform(self, m: np.array, out: np.array = None, dtype=None) -> np.array:
         if self.methods == "global":
-            return self.__3d_transform(m)
+            return self.__3d_transform(m, out, dtype)
 
         elif self.methods == "local":
-            return self.__2d_transform(m)
+            return self.__2d_transform(m, out, dtype)
 
         else:
             raise MethodsDoesNotExist("Only available methods: \"global\" or \"local\"")
 
-    def fit_transform(self, m: np.array) -> np.array:
+    def fit_transform(self, m: np.array, out: np.array = None, dtype=None) -> np.array:
         self.fit(m)
-        return self.transform(m)
+        return self.transform(m, out, dtype)
 
-    def __3d_transform(self, m: np.array):
-        if not self.mean:
+    def __3d_transform(self, m: np.array, out: np.array = None, dtype=None):
+        if self.mean is None or self.std is None:
             raise NotFitYet("Data haven't been fit yet, can't perform scaling")
 
         if len(m.shape) != 3:
             raise WrongShapeException("Matrix should be of dimension 3")
 
-        results = []
+        out = output_buffer(m, out, dtype)
+        np.subtract(m, self.mean, out=out)
+        np.divide(out, self.std, out=out)
 
-        for d in m:
-            results.append((d - self.mean) / self.std)
+        return out
 
-        return np.array(results)
+    def __2d_transform(self, m: np.array, out: np.array = None, dtype=None):
+        mean = m.mean(axis=1, keepdims=True)
 
-    def __2d_transform(self, m: np.array):
-        results = []
+        out = output_buffer(m, out, dtype)
+        np.subtract(m, mean, out=out)
 
-        for d in m:
-            results.append((d - d.mean(axis=0)) / d.std(axis=0))
+        # std of each file from the centered values already in out, no extra temporary array
+        std = np.sqrt(np.einsum("ij...,ij...->i...", out, out) / m.shape[1])
+        np.divide(out, np.expand_dims(std, axis=1), out=out)
 
-        return np.array(results)
+        return out
 
 
-def file_standardization(data: np.array) -> np.array:
+def file_standardization(data: np.array, out: np.array = None, dtype=None) -> np.array:
     """
     Perform a file wise standardization
     :param data: N-dimension array to normalize
+    :param out: Optional buffer receiving the result, can be data itself
+    :param dtype: dtype of the result when out is not given
     :return: data: N-dimension array locally normalized
     """
+    mean = data.mean(axis=1, keepdims=True)
+    var = data.var(axis=1, keepdims=True)
 
-    result = []
-
-    for d in data:
-        mean = d.mean(axis=0)
-        var = d.var(axis=0)
-
-        result.append((d - mean) / var)
+    out = output_buffer(data, out, dtype)
+    np.subtract(data, mean, out=out)
+    np.divide(out, var, out=out)
 
-    return np.array(result)
+    return out
 
 
 def global_standardization(data: np.array) -> np.array:
@@ -269,26 +380,24 @@ class UnitScaler(Scaler):
     def fit(self, m: np.array, force: bool = False):
         pass
 
-    def transform(self, m: np.array) -> np.array:
-        results = []
-
-        for d in m:
-            results.append(d / np.linalg.norm(d, ord=None, axis=0))
+    def partial_fit(self, m: np.array):
+        pass
 
-        return np.array(results)
+    def transform(self, m: np.array, out: np.array = None, dtype=None) -> np.array:
+        return unit_length(m, out=out, dtype=dtype)
 
-    def fit_transform(self, m: np.array) -> np.array:
+    def fit_transform(self, m: np.array, out: np.array = None, dtype=None) -> np.array:
         self.fit(m)
-        return self.transform(m)
+        return self.transform(m, out, dtype)
 
 
-def unit_length(data: np.array, order: int = None) -> np.array:
-    result = []
+def unit_length(data: np.array, order: int = None, out: np.array = None, dtype=None) -> np.array:
+    norm = np.linalg.norm(data, ord=order, axis=1, keepdims=True)
 
-    for d in data:
-        result.append(d / np.linalg.norm(d, ord=order, axis=0))
+    out = output_buffer(data, out, dtype)
+    np.divide(data, norm, out=out)
 
-    return np.array(result)
+    return out
 
 
 class LogScaler(Scaler):
@@ -298,14 +407,83 @@ class LogScaler(Scaler):
     def fit(self, m: np.array, force: bool = False):
         pass
 
-    def transform(self, m: np.array) -> np.array:
-        results = []
+    def partial_fit(self, m: np.array):
+        pass
+
+    def transform(self, m: np.array, out: np.array = None, dtype=None) -> np.array:
+        # power_to_db clip each file relatively to its own maximum (top_db), kept file by file
+        out = output_buffer(m, out, dtype)
 
-        for d in m:
-            results.append(power_to_db(d))
+        for i in range(len(m)):
+            out[i] = power_to_db(m[i])
 
-        return np.array(results)
+        return out
 
-    def fit_transform(self, m: np.array) -> np.array:
+    def fit_transform(self, m: np.array, out: np.array = None, dtype=None) -> np.array:
         self.fit(m)
-        return self.transform(m)
+        return self.transform(m, out, dtype)
+
+
+# scalers selectable by name (command line of main.py and server.py)
+SCALERS = {
+    "file_MinMax": lambda: MinMaxScaler(),
+    "file_Mean": lambda: MeanScaler(),
+    "file_Standard": lambda: StandardScaler(),
+    "global_MinMax": lambda: MinMaxScaler(methods="global"),
+    "global_Mean": lambda: MeanScaler(methods="global"),
+    "global_Standard": lambda: StandardScaler(methods="global"),
+    "unit": lambda: UnitScaler(),
+}
+
+
+def get(name: str) -> Scaler:
+    """ A new scaler from its name (see SCALERS), None if the name is unknown """
+    return SCALERS[name]() if name in SCALERS else None
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="Throughput of the per-file (legacy) and vectorized scalers")
+    parser.add_argument("--nb_file", type=int, default=14000)
+    parser.add_argument("--nb_frame", type=int, default=431)
+    parser.add_argument("--nb_band", type=int, default=64)
+    args = parser.parse_args()
+
+    # legacy implementations, one file at a time then np.array
+    def loop_minmax(m):
+        return np.array([(d - d.min(axis=0)) / (d.max(axis=0) - d.min(axis=0)) for d in m])
+
+    def loop_mean(m):
+        return np.array([d - d.mean(axis=0) for d in m])
+
+    def loop_standard(m):
+        return np.array([(d - d.mean(axis=0)) / d.std(axis=0) for d in m])
+
+    def loop_unit(m):
+        return np.array([d / np.linalg.norm(d, ord=None, axis=0) for d in m])
+
+    def bench(name: str, function, data: np.array):
+        start = time.time()
+        function(data)
+        duration = time.time() - start
+        print("{:<30}{:>10.2f} s{:>14.0f} files/s".format(name, duration, len(data) / duration))
+
+    # dataset layout (<nb file>, <nb band>, <nb frame>), as the mel features are stored and normalized
+    data = np.random.rand(args.nb_file, args.nb_band, args.nb_frame).astype(np.float32)
+    buffer = np.empty(data.shape, dtype=np.float32)
+
+    scalers = [
+        ("file_MinMax", loop_minmax, MinMaxScaler()),
+        ("file_Mean", loop_mean, MeanScaler()),
+        ("file_Standard", loop_standard, StandardScaler()),
+        ("unit", loop_unit, UnitScaler()),
+    ]
+
+    print("data: %s, %s" % (str(data.shape), data.dtype))
+    for name, loop, scaler in scalers:
+        bench(name + " (loop)", loop, data)
+        bench(name + " (vectorized)", scaler.transform, data)
+        bench(name + " (buffer float32)", lambda m: scaler.transform(m, out=buffer), data)
+        assert np.allclose(loop(data[:16]), scaler.transform(data[:16]), equal_nan=True)
@@ -0,0 +1,247 @@
+"""
+Incremental inference of the recurrent heads (Bidirectional GRU / WGRU + TimeDistributed Dense) for streaming input.
+
+The heads are run in numpy from the weights of the Keras layers. The forward direction keeps its hidden state from one
+chunk to the next, so a new chunk only costs its own frames. The backward direction can't wait for the end of the
+stream: it is started from a zero state <lookahead> frames after the last frame to output, so each chunk costs its
+frames plus the lookahead and the output is delayed by <lookahead> frames. The larger the lookahead, the closer the
+output is to the full clip inference (see the benchmark of the __main__).
+"""
+import numpy as np
+
+
+def hard_sigmoid(x: np.array) -> np.array:
+    """ Keras hard sigmoid (default recurrent activation of the GRU) """
+    return np.clip(0.2 * x + 0.5, 0, 1)
+
+
+def sigmoid(x: np.array) -> np.array:
+    return 1 / (1 + np.exp(-x))
+
+
+# numpy version of the Keras activations, by name
+ACTIVATIONS = {
+    "hard_sigmoid": hard_sigmoid,
+    "sigmoid": sigmoid,
+    "tanh": np.tanh,
+    "relu": lambda x: np.maximum(x, 0),
+    "linear": lambda x: x,
+}
+
+
+def activation(name: str):
+    """ :param name: name of a Keras activation (or the Keras function itself) """
+    name = getattr(name, "__name__", name)
+    if name not in ACTIVATIONS:
+        raise ValueError("Unsupported activation: %s %s" % (name, tuple(ACTIVATIONS)))
+    return ACTIVATIONS[name]
+
+
+class GRUDirection:
+    """
+    One direction of a Keras GRU (reset_after=False), or of a CustomGRU: the previous state is weighted by
+    temporal_weight in the gates (1 for the stock GRU), as in CustomGRUCell.
+    """
+    def __init__(self, kernel: np.array, recurrent_kernel: np.array, bias: np.array = None,
+                 temporal_weight: float = 1.0, activation_name: str = "tanh",
+                 recurrent_activation_name: str = "hard_sigmoid"):
+        self.units = recurrent_kernel.shape[0]
+        self.kernel = kernel
+        self.recurrent_kernel = recurrent_kernel
+        self.bias = np.zeros(3 * self.units, dtype=kernel.dtype) if bias is None else bias
+        self.temporal_weight = temporal_weight
+        self.activation = activation(activation_name)
+        self.recurrent_activation = activation(recurrent_activation_name)
+
+    @staticmethod
+    def from_layer(layer) -> "GRUDirection":
+        """ :param layer: a Keras GRU or CustomGRU """
+        if getattr(layer, "reset_after", False):
+            raise ValueError("reset_after GRU not supported")
+
+        weights = layer.get_weights()
+        bias = weights[2] if len(weights) > 2 else None
+        return GRUDirection(weights[0], weights[1], bias, getattr(layer, "temporal_weight", 1.0),
+                            layer.activation, layer.recurrent_activation)
+
+    def project(self, x: np.array) -> np.array:
+        """ Input projections of all the timesteps at once (<batch>, <time>, 3 * units) """
+        return np.dot(x, self.kernel) + self.bias
+
+    def run(self, projected: np.array, h: np.array = None, reverse: bool = False) -> tuple:
+        """
+        :param projected: the input projections (<batch>, <time>, 3 * units), see project
+        :param h: the initial state (<batch>, units), default zeros
+        :param reverse: process the timesteps from the last one (backward direction)
+        :return: the output of each timestep (<batch>, <time>, units) in the input order, the last state
+        """
+        u = self.units
+        if h is None:
+            h = np.zeros((projected.shape[0], u), dtype=projected.dtype)
+
+        outputs = np.empty(projected.shape[:2] + (u,), dtype=projected.dtype)
+        steps = range(projected.shape[1] - 1, -1, -1) if reverse else range(projected.shape[1])
+
+        recurrent_zr = self.recurrent_kernel[:, :2 * u]
+        recurrent_h = self.recurrent_kernel[:, 2 * u:]
+        for t in steps:
+            x = projected[:, t]
+            weighted = h * self.temporal_weight
+
+            zr = self.recurrent_activation(x[:, :2 * u] + np.dot(weighted, recurrent_zr))
+            z, r = zr[:, :u], zr[:, u:]
+            hh = self.activation(x[:, 2 * u:] + np.dot(r * weighted, recurrent_h))
+
+            h = z * h + (1 - z) * hh
+            outputs[:, t] = h
+
+        return outputs, h
+
+
+class IncrementalHead:
+    """
+    Bidirectional GRU (concatenated directions) followed by a Dense on each frame, fed chunk after chunk.
+
+        head = IncrementalHead.from_layers(bidirectional, distributed, lookahead=20)
+        for features in chunks:                     # (<batch>, <new frames>, <features>)
+            probabilities = head.push(features)     # (<batch>, <ready frames>, <nb class>)
+        probabilities = head.flush()
+    """
+    def __init__(self, forward: GRUDirection, backward: GRUDirection, kernel: np.array, bias: np.array,
+                 lookahead: int = 20, activation_name: str = "sigmoid"):
+        self.forward = forward
+        self.backward = backward
+        self.kernel = kernel
+        self.bias = bias
+        self.lookahead = lookahead
+        self.activation = activation(activation_name)
+        self.reset()
+
+    @staticmethod
+    def from_layers(bidirectional, distributed, lookahead: int = 20) -> "IncrementalHead":
+        """
+        :param bidirectional: the Keras Bidirectional layer (GRU or CustomGRU)
+        :param distributed: the Keras TimeDistributed(Dense) layer
+        """
+        if bidirectional.merge_mode != "concat":
+            raise ValueError("Unsupported merge mode: %s (concat)" % bidirectional.merge_mode)
+
+        kernel, bias = distributed.layer.get_weights()
+        return IncrementalHead(GRUDirection.from_layer(bidirectional.forward_layer),
+                               GRUDirection.from_layer(bidirectional.backward_layer),
+                               kernel, bias, lookahead, distributed.layer.activation)
+
+    def reset(self):
+        """ Start a new stream """
+        self.h = None
+        self.pending = None     # forward outputs and backward projections of the frames not output yet
+
+    def push(self, features: np.array) -> np.array:
+        """
+        :param features: the next frames (<batch>, <new frames>, <features>)
+        :return: the probabilities of the frames having <lookahead> frames after them (<batch>, <frames>, <nb class>)
+        """
+        forward, self.h = self.forward.run(self.forward.project(features), self.h)
+        pending = (forward, self.backward.project(features))
+
+        if self.pending is not None:
+            pending = tuple(np.concatenate((old, new), axis=1) for old, new in zip(self.pending, pending))
+        self.pending = pending
+
+        return self.__output(self.pending[0].shape[1] - self.lookahead)
+
+    def flush(self) -> np.array:
+        """ The probabilities of the last frames (end of the stream) """
+        if self.pending is None:
+            return np.zeros((0, 0, len(self.bias)))
+
+        probabilities = self.__output(self.pending[0].shape[1])
+        self.reset()
+        return probabilities
+
+    def __output(self, nbReady: int) -> np.array:
+        forward, projected = self.pending
+        nbReady = max(0, nbReady)
+
+        # backward pass from the end of the pending frames (the ready ones and their lookahead)
+        backward, _ = self.backward.run(projected[:, :nbReady + self.lookahead], reverse=True)
+
+        output = np.concatenate((forward[:, :nbReady], backward[:, :nbReady]), axis=2)
+        self.pending = (forward[:, nbReady:], projected[:, nbReady:])
+
+        return self.activation(np.dot(output, self.kernel) + self.bias)
+
+    def full(self, features: np.array) -> np.array:
+        """ Reference inference on complete sequences (<batch>, <time>, <features>), same as the Keras layers """
+        forward, _ = self.forward.run(self.forward.project(features))
+        backward, _ = self.backward.run(self.backward.project(features), reverse=True)
+
+        return self.activation(np.dot(np.concatenate((forward, backward), axis=2), self.kernel) + self.bias)
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", help="basename of a saved model (see Models.save), random weights otherwise")
+    parser.add_argument("--features", help=".npy mel features of clips (<nb clip>, 64, 431), random otherwise")
+    parser.add_argument("--chunk", type=int, default=10, help="frames pushed at once (output frames)")
+    parser.add_argument("--lookahead", default="0,5,10,20,50,100", help="lookaheads to compare (output frames)")
+    args = parser.parse_args()
+
+    heads = {}
+    if args.model is not None:
+        from keras.layers import Bidirectional, TimeDistributed
+        from keras.models import Model
+        import Models
+
+        fused = Models.temporal_model(args.model)
+        bidirectionals = [l for l in fused.layers if isinstance(l, Bidirectional)]
+        distributeds = [l for l in fused.layers if isinstance(l, TimeDistributed)]
+
+        trunk = Model(inputs=fused.inputs, outputs=bidirectionals[0].input)
+        clips = np.load(args.features)[..., np.newaxis]
+        features = trunk.predict(clips)
+
+        for name, bidirectional, distributed in zip(("GRU", "WGRU"), bidirectionals, distributeds):
+            heads[name] = lambda lookahead, b=bidirectional, d=distributed: IncrementalHead.from_layers(b, d, lookahead)
+
+            # the numpy head against the Keras layers
+            keras_head = Model(inputs=fused.inputs, outputs=distributed.output).predict(clips)
+            print("%s, numpy / Keras max |difference|: %.2e" % (
+                name, np.abs(heads[name](0).full(features) - keras_head).max()))
+    else:
+        rng = np.random.RandomState(0)
+        nbClip, nbFrame, nbFeature, units = 16, 215, 64, 64
+        features = rng.randn(nbClip, nbFrame, nbFeature).astype(np.float32)
+
+        def glorot(*shape):
+            return (rng.randn(*shape) * np.sqrt(2 / sum(shape))).astype(np.float32)
+
+        directions = [(glorot(nbFeature, 3 * units), glorot(units, 3 * units)) for _ in range(2)]
+        dense = (glorot(2 * units, 10), np.zeros(10, dtype=np.float32))
+
+        for name, temporal_weight in (("GRU", 1.0), ("WGRU", 0.25)):
+            heads[name] = lambda lookahead, tw=temporal_weight: IncrementalHead(
+                GRUDirection(*directions[0], temporal_weight=tw), GRUDirection(*directions[1], temporal_weight=tw),
+                *dense, lookahead=lookahead)
+
+    print("%d clips of %d frames, chunks of %d frames" % (features.shape[0], features.shape[1], args.chunk))
+    print("{:<6}{:<11}{:<12}{:<12}{:<16}{:<12}".format(
+        "head", "lookahead", "mean |err|", "max |err|", "decision agr.", "ms / chunk"))
+
+    for name, build in heads.items():
+        reference = build(0).full(features)
+
+        for lookahead in [int(l) for l in args.lookahead.split(",")]:
+            head = build(lookahead)
+            start = time.time()
+            outputs = [head.push(features[:, i:i + args.chunk]) for i in range(0, features.shape[1], args.chunk)]
+            duration = (time.time() - start) / len(outputs)
+            streamed = np.concatenate(outputs + [head.flush()], axis=1)
+
+            error = np.abs(streamed - reference)
+            agreement = np.mean((streamed > 0.5) == (reference > 0.5))
+            print("{:<6}{:<11}{:<12.5f}{:<12.5f}{:<16.4f}{:<12.2f}".format(
+                name, lookahead, error.mean(), error.max(), agreement, duration * 1000))
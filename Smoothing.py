@@ -0,0 +1,93 @@
+"""
+Smoothing of the temporal predictions before the localization (see Encoder).
+
+All the filters work along the time axis of the whole (<nb clip>, <nb frame>, <nb class>) tensor at once. The
+parameters can be given once or for each class, the classes sharing the same value are filtered together.
+"""
+import numpy as np
+from scipy.ndimage import median_filter
+from scipy.signal import lfilter
+
+
+def per_class(value, nb_class: int) -> np.array:
+    """ Broadcast a parameter given once or for each class into a vector of <nb class> values."""
+    return np.broadcast_to(np.asarray(value), (nb_class,))
+
+
+def apply_per_class(prediction: np.array, value, smoother) -> np.array:
+    """
+    Apply a filter on each group of classes sharing the same parameter value.
+    :param prediction: A 3-dimension numpy array (<nb clip>, <nb frame>, <nb class>)
+    :param value: the parameter of the filter, one value or one per class
+    :param smoother: function(sub tensor, value) -> smoothed sub tensor
+    :return: the smoothed tensor
+    """
+    values = per_class(value, prediction.shape[2])
+    unique = np.unique(values)
+
+    if len(unique) == 1:
+        return smoother(prediction, unique[0])
+
+    output = np.empty(prediction.shape, dtype=np.result_type(prediction.dtype, np.float32))
+    for v in unique:
+        classes = np.flatnonzero(values == v)
+        output[:, :, classes] = smoother(prediction[:, :, classes], v)
+
+    return output
+
+
+def moving_average(prediction: np.array, window_len=11, weight: float = 2) -> np.array:
+    """
+    Moving average, the borders are extended with a point reflection (weight * border - reflected curve).
+    :param prediction: A 3-dimension numpy array (<nb clip>, <nb frame>, <nb class>)
+    :param window_len: length of the window, one or one per class. Below 3 the curve is not smoothed
+    :param weight: weight of the border value in the reflection (2 -> point reflection)
+    :return: the smoothed prediction
+    """
+    def smooth(data: np.array, window_len) -> np.array:
+        window_len = int(window_len)
+        if window_len < 3:
+            return data
+
+        nb_frame = data.shape[1]
+        head = weight * data[:, :1] - data[:, window_len - 1::-1]
+        tail = weight * data[:, -1:] - data[:, -1:-window_len:-1]
+        padded = np.concatenate((head, data, tail), axis=1)
+
+        # sum of each window from the cumulative sum, one padded copy for the whole tensor
+        cumulative = np.zeros((padded.shape[0], padded.shape[1] + 1, padded.shape[2]))
+        np.cumsum(padded, axis=1, out=cumulative[:, 1:])
+
+        start = (window_len - 1) // 2 + 1
+        return (cumulative[:, start + window_len:start + window_len + nb_frame] -
+                cumulative[:, start:start + nb_frame]) / window_len
+
+    return apply_per_class(prediction, window_len, smooth)
+
+
+def median(prediction: np.array, window_len=11) -> np.array:
+    """
+    Median filter, the borders are extended by repeating the first and last values.
+    :param prediction: A 3-dimension numpy array (<nb clip>, <nb frame>, <nb class>)
+    :param window_len: length of the window, one or one per class
+    :return: the smoothed prediction
+    """
+    def smooth(data: np.array, window_len) -> np.array:
+        return median_filter(data, size=(1, int(window_len), 1), mode="nearest")
+
+    return apply_per_class(prediction, window_len, smooth)
+
+
+def exponential(prediction: np.array, alpha=0.3) -> np.array:
+    """
+    Exponential moving average: y[t] = alpha * x[t] + (1 - alpha) * y[t - 1], with y[0] = x[0].
+    :param prediction: A 3-dimension numpy array (<nb clip>, <nb frame>, <nb class>)
+    :param alpha: smoothing factor in ]0, 1], one or one per class
+    :return: the smoothed prediction
+    """
+    def smooth(data: np.array, alpha) -> np.array:
+        initial = (1 - alpha) * data[:, :1]
+        output, _ = lfilter([alpha], [1, alpha - 1], data, axis=1, zi=initial)
+        return output
+
+    return apply_per_class(prediction, alpha, smooth)
@@ -0,0 +1,335 @@
+"""
+Online detection on a continuous (unbounded) stream of mel frames.
+
+The stream is cut into overlapping windows of the model input length, the temporal predictions of the windows are
+stitched on a common output frame grid by a weighted overlap-add, and the events are tracked class by class on the
+frames no future window will change. An event is emitted once it is over (its hole became longer than fill_gap), with
+absolute timestamps: it is reported at most one window duration plus fill_gap after its offset, so the delay from its
+onset grows with its duration.
+"""
+import numpy as np
+
+from Binarizer import Binarizer
+from datasetGenerator import DCASE2018
+
+
+class EventTracker:
+    """
+    Incremental version of the Encoder threshold localization and post processing: the holes shorter than fill_gap are
+    filled and the events shorter than min_duration removed, on decisions arriving block after block.
+    """
+    def __init__(self, nbClass: int, frameLength: float, fill_gap=200, min_duration=0, start_time: float = 0.0):
+        """
+        :param nbClass: number of classes
+        :param frameLength: duration of one output frame (s)
+        :param fill_gap: the holes shorter than fill_gap (ms) are filled, one value or one per class
+        :param min_duration: the events shorter than min_duration (ms) are dropped, one value or one per class
+        :param start_time: absolute time of the first frame (s)
+        """
+        self.frameLength = frameLength
+        self.start_time = start_time
+        self.maxGap = np.broadcast_to(np.asarray(fill_gap, dtype=np.float64), (nbClass,)) / 1000
+        self.minDuration = np.broadcast_to(np.asarray(min_duration, dtype=np.float64), (nbClass,)) / 1000
+
+        self.onset = np.full(nbClass, -1)     # first frame of the open event of each class, -1 if none
+        self.end = np.zeros(nbClass, dtype=int)  # frame following the last active frame of the open event
+        self.nbFrame = 0
+
+    def update(self, decision: np.array) -> list:
+        """
+        :param decision: the binary decisions of the next frames (<nb frame>, <nb class>)
+        :return: the events closed by these frames
+        """
+        events = []
+        first = self.nbFrame
+        self.nbFrame += len(decision)
+
+        padded = np.zeros((len(decision) + 2, decision.shape[1]), dtype=np.int8)
+        padded[1:-1] = decision
+        boundaries = np.diff(padded, axis=0)
+
+        for cls in range(decision.shape[1]):
+            onsets = np.flatnonzero(boundaries[:, cls] == 1) + first
+            offsets = np.flatnonzero(boundaries[:, cls] == -1) + first
+
+            for onset, offset in zip(onsets, offsets):
+                # a run starting where the open event stops continues it (cut between two blocks)
+                gap = onset - self.end[cls]
+                if self.onset[cls] >= 0 and (gap == 0 or gap * self.frameLength < self.maxGap[cls]):
+                    self.end[cls] = offset
+                else:
+                    events += self.__close(cls)
+                    self.onset[cls], self.end[cls] = onset, offset
+
+            # the hole is already too long to be filled (the next block may continue an event reaching its end)
+            gap = self.nbFrame - self.end[cls]
+            if self.onset[cls] >= 0 and gap > 0 and gap * self.frameLength >= self.maxGap[cls]:
+                events += self.__close(cls)
+
+        return events
+
+    def close(self) -> list:
+        """ Close the events still open (end of the stream) """
+        events = []
+        for cls in range(len(self.onset)):
+            events += self.__close(cls)
+        return events
+
+    def __close(self, cls: int) -> list:
+        onset, end = self.onset[cls], self.end[cls]
+        self.onset[cls] = -1
+
+        if onset < 0 or (end - onset) * self.frameLength < self.minDuration[cls]:
+            return []
+
+        return [{
+            "onset": float(self.start_time + onset * self.frameLength),
+            "offset": float(self.start_time + end * self.frameLength),
+            "event_label": DCASE2018.class_correspondence_reverse[cls]
+        }]
+
+
+class StreamingDetector:
+    """
+    Sliding window detection: push the mel frames as they come, get the finished events back.
+
+        detector = StreamingDetector(Models.temporal_model("results/model.name"), normalizer=normalizer)
+        for chunk in stream:            # (<nb band>, <any nb frame>)
+            for event in detector.push(chunk):
+                ...
+        events = detector.flush()
+    """
+    def __init__(self, model, window: int = 431, hop: int = 216, ratio: int = 2,
+                 frameLength: float = DCASE2018.CLIP_LENGTH / 431, normalizer=None, fill_gap=200, min_duration=0,
+                 weighting: str = "hann", start_time: float = 0.0, thresholds=None):
+        """
+        :param model: the temporal model, predict((<n>, <nb band>, <window>, 1)) -> (<n>, <window / ratio>, <nb class>)
+        :param window: number of input frames of a window (the model input length)
+        :param hop: number of input frames between two windows, a multiple of ratio
+        :param ratio: number of input frames per output frame (time pooling of the model)
+        :param frameLength: duration of one input frame (s)
+        :param normalizer: the fitted Normalizer of the training, applied on each window
+        :param fill_gap: see EventTracker
+        :param min_duration: see EventTracker
+        :param weighting: weight of the frames of a window in the overlap-add, "hann" (less weight on the window
+            borders where the recurrent layers have less context) or "uniform" (plain average)
+        :param start_time: absolute time of the first frame of the stream (s)
+        :param thresholds: thresholds of the classes (see Binarizer.thresholdVector), default the Binarizer ones
+        """
+        if hop % ratio != 0 or not 0 < hop <= window:
+            raise ValueError("The hop must be a multiple of the ratio (%d) between 1 and the window" % ratio)
+
+        self.model = model
+        self.window = window
+        self.hop = hop
+        self.ratio = ratio
+        self.nbOutput = window // ratio
+        self.normalizer = normalizer
+        self.thresholds = Binarizer().thresholdVector(thresholds)
+
+        if weighting == "hann":
+            self.weights = np.hanning(self.nbOutput + 2)[1:-1]
+        elif weighting == "uniform":
+            self.weights = np.ones(self.nbOutput)
+        else:
+            raise ValueError("Unknown weighting: %s (hann | uniform)" % weighting)
+
+        self.tracker = EventTracker(len(self.thresholds), frameLength * ratio, fill_gap, min_duration, start_time)
+
+        self.buffer = None      # input frames from the next window start
+        self.nbInput = 0        # number of input frames received
+        self.nextStart = 0      # input frame of the next window
+        self.accumulated = None  # weighted sum of the predictions of the output frames not final yet
+        self.weightSum = None
+        self.accStart = 0       # output frame of accumulated[0]
+
+    def push(self, frames: np.array) -> list:
+        """
+        :param frames: the next mel frames (<nb band>, <nb frame>)
+        :return: the events finished with these frames
+        """
+        self.buffer = frames if self.buffer is None else np.concatenate((self.buffer, frames), axis=1)
+        self.nbInput += frames.shape[1]
+
+        nbWindow = 0 if self.buffer.shape[1] < self.window else (self.buffer.shape[1] - self.window) // self.hop + 1
+        if nbWindow == 0:
+            return []
+
+        starts = np.arange(nbWindow) * self.hop
+        windows = np.stack([self.buffer[:, s:s + self.window] for s in starts])
+        self.buffer = self.buffer[:, nbWindow * self.hop:]
+
+        return self.__process(windows)
+
+    def flush(self) -> list:
+        """ Predict the last frames (window completed by repeating the last frame) and close all the events """
+        events = []
+
+        # end of the input covered by the windows already predicted
+        covered = self.nextStart - self.hop + self.window if self.nextStart > 0 else 0
+        if self.nbInput > covered:
+            window = np.pad(self.buffer, ((0, 0), (0, self.window - self.buffer.shape[1])), mode="edge")
+            events += self.__process(window[np.newaxis], end=self.nbInput // self.ratio)
+        elif self.accumulated is not None:
+            events += self.__final(self.nbInput // self.ratio)
+
+        self.buffer = None
+        return events + self.tracker.close()
+
+    def __process(self, windows: np.array, end: int = None) -> list:
+        """ Predict the windows starting at nextStart, add them to the grid and track the final frames """
+        if self.normalizer is not None:
+            windows = self.normalizer.transform(windows)
+
+        prediction = self.model.predict(np.expand_dims(windows, axis=-1))
+        nbWindow, nbClass = len(windows), prediction.shape[2]
+
+        # grid extended up to the end of the last window
+        first = self.nextStart // self.ratio
+        last = first + (nbWindow - 1) * self.hop // self.ratio + self.nbOutput
+        if self.accumulated is None:
+            self.accumulated = np.zeros((0, nbClass))
+            self.weightSum = np.zeros(0)
+
+        extension = last - self.accStart - len(self.accumulated)
+        if extension > 0:
+            self.accumulated = np.concatenate((self.accumulated, np.zeros((extension, nbClass))))
+            self.weightSum = np.concatenate((self.weightSum, np.zeros(extension)))
+
+        # overlap-add, one window after the other (they overlap)
+        for i in range(nbWindow):
+            start = first + i * self.hop // self.ratio - self.accStart
+            self.accumulated[start:start + self.nbOutput] += prediction[i, :self.nbOutput] * self.weights[:, None]
+            self.weightSum[start:start + self.nbOutput] += self.weights
+
+        self.nextStart += nbWindow * self.hop
+
+        # the frames before the next window start will not receive any other prediction
+        return self.__final(self.nextStart // self.ratio if end is None else end)
+
+    def __final(self, end: int) -> list:
+        nbFinal = max(0, end - self.accStart)
+        if nbFinal == 0:
+            return []
+
+        probabilities = self.accumulated[:nbFinal] / self.weightSum[:nbFinal, None]
+        self.accumulated = self.accumulated[nbFinal:]
+        self.weightSum = self.weightSum[nbFinal:]
+        self.accStart += nbFinal
+
+        return self.tracker.update(probabilities > self.thresholds)
+
+
+def offline_events(decision: np.array, frameLength: float, fill_gap=200, min_duration=0) -> list:
+    """
+    Reference of the EventTracker: the holes filled and the short events removed on the whole decision at once.
+    :param decision: the binary decisions of the whole stream (<nb frame>, <nb class>)
+    """
+    events = []
+    padded = np.zeros((len(decision) + 2, decision.shape[1]), dtype=np.int8)
+    padded[1:-1] = decision
+    boundaries = np.diff(padded, axis=0)
+    maxGap = np.broadcast_to(np.asarray(fill_gap, dtype=np.float64), (decision.shape[1],)) / 1000
+    minDuration = np.broadcast_to(np.asarray(min_duration, dtype=np.float64), (decision.shape[1],)) / 1000
+
+    for cls in range(decision.shape[1]):
+        runs = []
+        for onset, offset in zip(np.flatnonzero(boundaries[:, cls] == 1), np.flatnonzero(boundaries[:, cls] == -1)):
+            if runs and (onset - runs[-1][1]) * frameLength < maxGap[cls]:
+                runs[-1][1] = offset
+            else:
+                runs.append([onset, offset])
+
+        events += [{
+            "onset": float(onset * frameLength), "offset": float(offset * frameLength),
+            "event_label": DCASE2018.class_correspondence_reverse[cls]
+        } for onset, offset in runs if (offset - onset) * frameLength >= minDuration[cls]]
+
+    return events
+
+
+def check(chunks=(1, 37, 431, 1000)):
+    """ The events must not depend on where the stream is cut """
+    rng = np.random.RandomState(0)
+
+    def key(events):
+        return sorted((round(e["onset"], 6), round(e["offset"], 6), e["event_label"]) for e in events)
+
+    # tracker alone, decisions made of runs and holes of random lengths
+    decision = np.repeat(rng.rand(600, 10) > 0.6, rng.randint(1, 12, size=600), axis=0)
+    frameLength = DCASE2018.CLIP_LENGTH / 215
+    for fill_gap, min_duration in ((0, 0), (200, 0), (200, 250), ([0, 100, 200, 300, 400] * 2, 100)):
+        reference = key(offline_events(decision, frameLength, fill_gap, min_duration))
+        for chunk in chunks + (len(decision),):
+            tracker = EventTracker(10, frameLength, fill_gap, min_duration)
+            events = []
+            for i in range(0, len(decision), chunk):
+                events += tracker.update(decision[i:i + chunk])
+            identical = key(events + tracker.close()) == reference
+            print("tracker, fill_gap %s, min_duration %s, chunk %4d: %d events, identical: %s" % (
+                fill_gap, min_duration, chunk, len(reference), identical))
+
+    # detector with a stand-in model whose output frames only depend on their own input frames
+    class FrameModel:
+        def predict(self, windows):
+            pairs = windows[:, :10, :430, 0].reshape(len(windows), 10, 215, 2).mean(axis=3)
+            return 1 / (1 + np.exp(-4 * pairs.transpose(0, 2, 1)))
+
+    features = np.repeat(rng.randn(64, 200), rng.randint(5, 60, size=200), axis=1)
+    features += rng.randn(*features.shape) * 0.5
+
+    results = []
+    for chunk in chunks + (features.shape[1],):
+        detector = StreamingDetector(FrameModel(), fill_gap=0)
+        events = []
+        for i in range(0, features.shape[1], chunk):
+            events += detector.push(features[:, i:i + chunk])
+        results.append(key(events + detector.flush()))
+        print("detector, fill_gap 0, chunk %5d: %d events, identical: %s" % (chunk, len(results[-1]),
+                                                                             results[-1] == results[0]))
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", help="basename of the saved model (see Models.save)")
+    parser.add_argument("--features", help=".npy mel features of a long recording (<nb band>, <nb frame>)")
+    parser.add_argument("--thresholds", help="thresholds of the Binarizer, default <model>_thresholds.json")
+    parser.add_argument("--normalizer", type=str, help="normalizer used for the training (see main.py)")
+    parser.add_argument("--wgru_classes", default="0,2,1", help="classes taken from the WGRU head, if the inference model is built")
+    parser.add_argument("--hop", type=int, default=216, help="input frames between two windows")
+    parser.add_argument("--chunk", type=int, default=50, help="input frames pushed at once")
+    parser.add_argument("-check", help="Check that the events don't depend on the chunk size (no model)", action="store_true")
+    args = parser.parse_args()
+
+    if args.check:
+        check()
+        raise SystemExit
+
+    if args.model is None or args.features is None:
+        parser.error("--model and --features are required")
+
+    import Models
+    import Normalizer
+
+    Binarizer().load(args.thresholds or args.model + "_thresholds.json")
+    normalizer = Normalizer.get(args.normalizer)
+    if normalizer is not None:
+        normalizer.load(args.model + "_normalizer.npz")
+
+    model = Models.temporal_model(args.model, [int(c) for c in args.wgru_classes.split(",")])
+    detector = StreamingDetector(model, hop=args.hop, normalizer=normalizer)
+
+    features = np.load(args.features)
+    start = time.time()
+    for i in range(0, features.shape[1], args.chunk):
+        for event in detector.push(features[:, i:i + args.chunk]):
+            print("%8.2f  %8.2f  %s" % (event["onset"], event["offset"], event["event_label"]))
+
+    for event in detector.flush():
+        print("%8.2f  %8.2f  %s" % (event["onset"], event["offset"], event["event_label"]))
+
+    duration = features.shape[1] * DCASE2018.CLIP_LENGTH / 431
+    print("%.1f s of audio processed in %.1f s" % (duration, time.time() - start))
@@ -1,9 +1,199 @@
 import os
 from random import shuffle
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import tqdm
 
+
+def parallel_load(paths: list, nb_workers: int = 8) -> np.array:
+    """ Load a list of .npy files concurrently into one preallocated array.
+
+    Each worker writes directly into its row of the output, therefore the files order is kept and no intermediate
+    list is built. The loading is I/O bound and np.load release the GIL while reading, threads are enough.
+
+    :param paths: The files to load, they must all have the same shape and dtype
+    :param nb_workers: Number of files read at the same time
+    :return: A (<nb file>, <file shape>) numpy array
+    """
+    if len(paths) == 0:
+        raise ValueError("No file to load (the shape of the output is given by the files)")
+
+    first = np.load(paths[0])
+    output = np.empty((len(paths),) + first.shape, dtype=first.dtype)
+    output[0] = first
+
+    def load(index: int):
+        output[index] = np.load(paths[index])
+
+    with ThreadPoolExecutor(max_workers=nb_workers) as pool:
+        list(pool.map(load, range(1, len(paths))))
+
+    return output
+
+
+class FeatureStore:
+    """ Consolidated, memory-mapped copy of the per-clip feature files.
+
+    The pack step is done only once: for each subset and feature, all the ``.npy`` clip files are written into a
+    single contiguous array ``<subset>_<feature>.npy`` and the file names, in row order, into
+    ``<subset>_<feature>.index``. The store can then be opened with ``np.load(mmap_mode="r")``, only the rows actually
+    used are read from the disk.
+    """
+    SUBSETS = {
+        "weak": ("train", "weak"),
+        "unlabel_in_domain": ("train", "unlabel_in_domain"),
+        "unlabel_out_of_domain": ("train", "unlabel_out_of_domain"),
+        "test": ("test",),
+    }
+
+    def __init__(self, store_root: str):
+        self.storeRoot = store_root
+        self.arrays = {}
+        self.indexes = {}
+
+    def __path(self, subset: str, feature: str) -> str:
+        return os.path.join(self.storeRoot, "%s_%s" % (subset, feature))
+
+    def exist(self, subset: str, feature: str) -> bool:
+        path = self.__path(subset, feature)
+        return os.path.isfile(path + ".npy") and os.path.isfile(path + ".index")
+
+    @staticmethod
+    def pack(feature_root: str, store_root: str, features: list, subsets: list = None):
+        """ Write each subset / feature couple into one contiguous memory-mapped array plus its filename index.
+
+        :param feature_root: Root of the features directory (same as the DCASE2018 one)
+        :param store_root: Directory where the packed arrays will be written
+        :param features: List of the features to pack (ex: ["mel"])
+        :param subsets: List of the subsets to pack, default all of them (see FeatureStore.SUBSETS)
+        """
+        if subsets is None:
+            subsets = list(FeatureStore.SUBSETS.keys())
+
+        if not os.path.isdir(store_root):
+            os.makedirs(store_root)
+
+        for subset in subsets:
+            for feature in features:
+                directory = os.path.join(feature_root, *FeatureStore.SUBSETS[subset], feature)
+                if not os.path.isdir(directory):
+                    print("%s doesn't exist, skipping" % directory)
+                    continue
+
+                file_list = sorted([f for f in os.listdir(directory) if f.endswith(".npy")])
+                if len(file_list) == 0:
+                    continue
+
+                # shape and dtype are given by the first file, all the clips have the same length
+                first = np.load(os.path.join(directory, file_list[0]))
+                path = os.path.join(store_root, "%s_%s" % (subset, feature))
+                packed = np.lib.format.open_memmap(path + ".npy", mode="w+", dtype=first.dtype,
+                                                   shape=(len(file_list),) + first.shape)
+
+                for i in tqdm.tqdm(range(len(file_list)), desc="%s %s" % (subset, feature), unit="Files"):
+                    packed[i] = np.load(os.path.join(directory, file_list[i]))
+
+                packed.flush()
+                del packed
+
+                with open(path + ".index", "w") as f:
+                    f.write("\n".join(file_list) + "\n")
+
+    def open(self, subset: str, feature: str) -> tuple:
+        """ Open (only once) a packed subset.
+
+        :return: The read-only memory-mapped array and the dict mapping the file name to its row
+        """
+        key = (subset, feature)
+        if key not in self.arrays:
+            path = self.__path(subset, feature)
+            self.arrays[key] = np.load(path + ".npy", mmap_mode="r")
+
+            with open(path + ".index", "r") as f:
+                file_list = f.read().split()
+            self.indexes[key] = {file_list[i]: i for i in range(len(file_list))}
+
+        return self.arrays[key], self.indexes[key]
+
+    def file_list(self, subset: str, feature: str) -> list:
+        _, index = self.open(subset, feature)
+        return sorted(index.keys(), key=index.get)
+
+    def rows(self, subset: str, feature: str, file_list: list) -> np.array:
+        """ Row of each file in the packed array, -1 if the file is not present in the store."""
+        _, index = self.open(subset, feature)
+        return np.array([index.get(f, -1) for f in file_list], dtype=np.int64)
+
+
+class LazyRows:
+    """ Rows of a dataset read only when indexed (a batch at a time), used like a (<nb file>, <dim 1>, <dim 2>) array """
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return self.read(np.array([index]))[0]
+
+        return self.read(np.arange(len(self))[index])
+
+    def __array__(self, dtype=None):
+        rows = self.read(np.arange(len(self)))
+        return rows if dtype is None else rows.astype(dtype)
+
+    def read(self, indexes: np.array) -> np.array:
+        raise NotImplementedError
+
+
+class StoreRows(LazyRows):
+    """ Rows selected in one or several packed arrays of the FeatureStore (memory maps), seen as one array """
+
+    def __init__(self, parts: list):
+        """
+        :param parts: list of (array, rows) couples, the rows of each array in their order of use
+        """
+        self.parts = parts
+        self.offsets = np.cumsum([0] + [len(rows) for _, rows in parts])
+        self.shape = (int(self.offsets[-1]),) + parts[0][0].shape[1:]
+        self.dtype = parts[0][0].dtype
+
+    def read(self, indexes: np.array) -> np.array:
+        output = np.empty((len(indexes),) + self.shape[1:], dtype=self.dtype)
+        part = np.searchsorted(self.offsets, indexes, side="right") - 1
+
+        for p in np.unique(part):
+            array, rows = self.parts[p]
+            output[part == p] = array[rows[indexes[part == p] - self.offsets[p]]]
+
+        return output
+
+
+class FileRows(LazyRows):
+    """ Per-clip .npy files, the files of the rows indexed are loaded concurrently (see parallel_load) """
+
+    def __init__(self, paths: list, nb_workers: int = 8):
+        if len(paths) == 0:
+            raise ValueError("No file to load (the shape of the rows is given by the files)")
+
+        self.paths = paths
+        self.nbWorkers = nb_workers
+
+        first = np.load(paths[0], mmap_mode="r")
+        self.shape = (len(paths),) + first.shape
+        self.dtype = first.dtype
+
+    def read(self, indexes: np.array) -> np.array:
+        if len(indexes) == 0:
+            return np.empty((0,) + self.shape[1:], dtype=self.dtype)
+
+        return parallel_load([self.paths[i] for i in indexes], self.nbWorkers)
+
+
 class DCASE2018:
     CLIP_LENGTH = 10
     NB_CLASS = 10
@@ -18,7 +208,7 @@ class DCASE2018:
                  feature_root: str, meta_root: str, features: list,
                  expand_with_uod: bool = False, expand_percent: float = 0.20,
                  validation_percent: float = 0.2,
-                 normalizer=None):
+                 normalizer=None, store_root: str = None, nb_workers: int = 8):
 
         # directories
         self.featureRoot = feature_root
@@ -34,6 +224,9 @@ class DCASE2018:
         self.meta_train_uod = os.path.join(meta_root, "unlabel_out_of_domain.csv")
         self.meta_test = os.path.join(meta_root, "test.csv")
 
+        # packed features (see FeatureStore), used instead of the per-clip files when available
+        self.store = FeatureStore(store_root) if store_root is not None else None
+
         # dataset parameters
         self.features = features
         self.metadata = {}
@@ -43,6 +236,7 @@ class DCASE2018:
         self.validationPercent = validation_percent
         self.originalShape = {}
         self.normalizer = normalizer
+        self.nbWorkers = nb_workers
 
         self.nbClass = 10
         DCASE2018.NB_CLASS = 10
@@ -89,26 +283,24 @@ class DCASE2018:
         print(feature)
         self.originalShape[feature] = self.training_dataset[feature]["input"][0].shape
 
-        # convert to np.array
-        self.training_dataset[feature]["input"] = np.array(self.training_dataset[feature]["input"])
-        self.validation_dataset[feature]["input"] = np.array(self.validation_dataset[feature]["input"])
-        self.training_dataset[feature]["output"] = np.array(self.training_dataset[feature]["output"])
-        self.validation_dataset[feature]["output"] = np.array(self.validation_dataset[feature]["output"])
-        self.testing_dataset[feature]["input"] = np.array(self.testing_dataset[feature]["input"])
-        self.testing_dataset[feature]["output"] = np.array(self.testing_dataset[feature]["output"])
+        # the inputs stay on the disk (see LazyRows), only the outputs are converted
+        self.training_dataset[feature]["output"] = np.asarray(self.training_dataset[feature]["output"])
+        self.validation_dataset[feature]["output"] = np.asarray(self.validation_dataset[feature]["output"])
+        self.testing_dataset[feature]["output"] = np.asarray(self.testing_dataset[feature]["output"])
 
-
-        # normalization
-        if self.normalizer is not None:
+        # normalization statistics, computed on the training subset only (if not already fit or loaded). The inputs
+        # are normalized batch per batch by the DCASE2018Sequence (see DataSequence), not here.
+        # The local methods normalize each file with its own statistics, they have nothing to fit.
+        if self.normalizer is not None and self.normalizer.methods == "global":
             print("==== Normalization stage ====")
-            self.training_dataset[feature]["input"] = self.normalizer.fit_transform(self.training_dataset[feature]["input"])
-            self.validation_dataset[feature]["input"] = self.normalizer.fit_transform(self.validation_dataset[feature]["input"])
-            self.testing_dataset[feature]["input"] = self.normalizer.fit_transform(self.testing_dataset[feature]["input"])
 
-        # extend dataset to have enough dim for conv2D
-        self.training_dataset[feature]["input"] = np.expand_dims(self.training_dataset[feature]["input"], axis=-1)
-        self.validation_dataset[feature]["input"] = np.expand_dims(self.validation_dataset[feature]["input"], axis=-1)
-        self.testing_dataset[feature]["input"] = np.expand_dims(self.testing_dataset[feature]["input"], axis=-1)
+            # chunk after chunk, only <FIT_CHUNK> files are read at once
+            training = self.training_dataset[feature]["input"]
+            alreadyFit = any(getattr(self.normalizer, key) is not None for key in self.normalizer.STATISTICS)
+            if not alreadyFit:
+                chunk = self.normalizer.FIT_CHUNK
+                for start in range(0, len(training), chunk):
+                    self.normalizer.partial_fit(training[start:start + chunk])
 
     def __loadMeta(self):
         """ Load the metadata for all subset of the DCASE2018 task4 dataset"""
@@ -142,40 +334,45 @@ class DCASE2018:
                 f[0] = [self.featureRoot, "train", "unlabel_out_of_domain", "feature", f[0]]
             self.metadata["weak"].extend(self.metadata["uod"])
 
-    def load_uid(self) -> dict:
+    def load_uid(self, nb_workers: int = None) -> dict:
         """ Load the features for the "unlabel_in_domain" dataset.
 
         It is not done when building the dataset since this part is not always necessarily.
 
-        :return: dict containing the data of the features (the key is the name of the feature)
+        :param nb_workers: Number of files loaded concurrently, default to the one given to the dataset
+        :return: dict containing the rows of the features (the key is the name of the feature), read batch per batch
         """
+        if nb_workers is None:
+            nb_workers = self.nbWorkers
+
         # prepare path
         print("meta UID: ", len(self.metadata["uid"]))
         for f in self.metadata["uid"]:
             f[0] = [self.featureRoot, "train", "unlabel_in_domain", "feature", f[0][:-1]]
 
-        # ---- load the features ----
+        # ---- the features, read batch per batch (see LazyRows) ----
         inputs = {}
-        with tqdm.tqdm(total=len(self.metadata["uid"]) * len(self.features), unit="Files") as progress:
+        if self.store is not None and all(self.store.exist("unlabel_in_domain", f) for f in self.features):
             for feature in self.features:
-                inputs[feature] = []
-
-                for i in range(len(self.metadata["uid"])):
-                    info = self.metadata["uid"][i]
-                    path_list = info[0]
-                    path_list[3] = feature
-                    path = os.path.join(*path_list) + ".npy"
+                rows = self.store.rows("unlabel_in_domain", feature, [f[0][4] + ".npy" for f in self.metadata["uid"]])
+                packed, _ = self.store.open("unlabel_in_domain", feature)
+                inputs[feature] = StoreRows([(packed, rows[rows >= 0])])
 
-                    if os.path.isfile(path):
-                        feat = np.load(path)
+            return inputs
 
-                        # preprocessing and add
-                        feat = np.expand_dims(feat, axis=-1)
-                        inputs[feature].append(feat)
+        for feature in self.features:
+            paths = []
+            for info in self.metadata["uid"]:
+                path_list = info[0]
+                path_list[3] = feature
+                paths.append(os.path.join(*path_list) + ".npy")
 
-                    progress.update()
+            existing = [path for path in paths if os.path.isfile(path)]
+            if len(existing) == 0:
+                raise FileNotFoundError("No %s feature file of the unlabel_in_domain subset found in %s" % (
+                    feature, os.path.join(self.featureRoot, "train", "unlabel_in_domain", feature)))
 
-                inputs[feature] = np.array(inputs[feature])
+            inputs[feature] = FileRows(existing, nb_workers)
 
         return inputs
 
@@ -212,41 +409,70 @@ class DCASE2018:
 
     def __createDataset(self, feature: str, training_data: list, validation_data: list):
 
-        def loadFeatures(subset: dict, toLoad: list):
-            subset[feature]["input"] = []
+        def toOutput(info: list) -> list:
+            output = [0] * self.nbClass
+
+            if len(info) > 1:
+                for cls in info[1].split(","):
+                    output[DCASE2018.class_correspondance[cls.rstrip()]] = 1
+            else:
+                output[DCASE2018.class_correspondance["blank"]] = 1
+
+            return output
 
+        def storeSubsets(toLoad: list) -> list:
+            return sorted(set(info[0][2] for info in toLoad))
+
+        def loadFromStore(subset: dict, toLoad: list):
+            # the rows of the packed arrays, read batch per batch (see StoreRows)
+            parts = []
+            for storeSubset in storeSubsets(toLoad):
+                selected = [info for info in toLoad if info[0][2] == storeSubset]
+                rows = self.store.rows(storeSubset, feature, [info[0][4].rstrip() + ".npy" for info in selected])
+
+                # missing files are skipped, the rows are sorted to read the memory map sequentially
+                order = [i for i in np.argsort(rows) if rows[i] >= 0]
+                packed, _ = self.store.open(storeSubset, feature)
+
+                parts.append((packed, rows[order]))
+                subset[feature]["output"].extend([toOutput(selected[i]) for i in order])
+
+            subset[feature]["input"] = StoreRows(parts)
+
+        def loadFeatures(subset: dict, toLoad: list):
+            # the files are only listed, they are read batch per batch (see FileRows)
+            paths = []
             for info in toLoad:
                 pathList = info[0]
                 pathList[3] = feature
                 path = os.path.join(*pathList) + ".npy"
 
                 if os.path.isfile(path):
-                    output = [0] * self.nbClass
-                    feat = np.load(path)
-
-                    subset[feature]["input"].append(feat)
+                    paths.append(path)
+                    subset[feature]["output"].append(toOutput(info))
 
-                    if len(info) > 1:
-                        for cls in info[1].split(","):
-                            output[DCASE2018.class_correspondance[cls.rstrip()]] = 1
-                    else:
-                        output[DCASE2018.class_correspondance["blank"]] = 1
+            subset[feature]["input"] = FileRows(paths, self.nbWorkers)
 
-                    subset[feature]["output"].append(output)
+        useStore = self.store is not None and all(
+            self.store.exist(storeSubset, feature) for storeSubset in storeSubsets(training_data + validation_data))
 
-        loadFeatures(self.training_dataset, training_data)
-        loadFeatures(self.validation_dataset, validation_data)
+        if useStore:
+            loadFromStore(self.training_dataset, training_data)
+            loadFromStore(self.validation_dataset, validation_data)
+        else:
+            loadFeatures(self.training_dataset, training_data)
+            loadFeatures(self.validation_dataset, validation_data)
 
     def __createTestDataset(self, feature):
-        self.testing_dataset[feature]["input"] = []
+        if self.store is not None and self.store.exist("test", feature):
+            # the packed array is used as is, memory-mapped and in the order of its index
+            self.test_file_list = self.store.file_list("test", feature)
+            self.testing_dataset[feature]["input"], _ = self.store.open("test", feature)
+            return
 
         self.test_file_list = os.listdir(os.path.join(self.feat_test, "mel"))
-
-        for file in self.test_file_list:
-            path = os.path.join(self.feat_test, feature, file)
-            f = np.load(path)
-
-            self.testing_dataset[feature]["input"].append(f)
+        self.testing_dataset[feature]["input"] = FileRows(
+            [os.path.join(self.feat_test, feature, file) for file in self.test_file_list], self.nbWorkers)
 
     def getInputShape(self, feature):
         shape = self.training_dataset[feature]["input"][0].shape
@@ -7,6 +7,7 @@
 #########################################################################
 
 from dcase_util.data import ProbabilityEncoder
+from dcase_util.containers import MetaDataContainer
 import sed_eval
 import numpy
 
@@ -75,28 +76,39 @@ def get_f_measure_by_class(keras_model, nb_tags, generator, steps, thresholds=No
     return macro_f_measure
 
 
-def event_based_evaluation(reference_event_list, estimated_event_list):
+def event_based_evaluation(reference_event_list, estimated_event_list, backend="sed_eval"):
     """ Calculate sed_eval event based metric for challenge
 
         Parameters
         ----------
 
-        reference_event_list : MetaDataContainer, list of referenced events
+        reference_event_list : MetaDataContainer or list of dict, list of referenced events
 
-        estimated_event_list : MetaDataContainer, list of estimated events
+        estimated_event_list : MetaDataContainer or list of dict, list of estimated events (see Encoder.toEvents)
+
+        backend : str, "sed_eval" or "numpy" (same F-measures, see event_based_fscore)
 
         Return
         ------
 
-        event_based_metric : EventBasedMetrics
+        event_based_metric : EventBasedMetrics or EventBasedScores
 
         """
 
-    files = {}
-    for event in reference_event_list:
-        files[event['filename']] = event['filename']
+    if backend == "numpy":
+        return event_based_fscore(reference_event_list, estimated_event_list)
+
+    if backend != "sed_eval":
+        raise ValueError("Unknown evaluation backend: %s (sed_eval | numpy)" % backend)
+
+    if not isinstance(reference_event_list, MetaDataContainer):
+        reference_event_list = MetaDataContainer(reference_event_list)
 
-    evaluated_files = sorted(list(files.keys()))
+    # group the events by file in one pass over each list
+    reference_by_file = group_by_filename(reference_event_list)
+    estimated_by_file = group_by_filename(estimated_event_list)
+
+    evaluated_files = sorted(reference_by_file.keys())
 
     event_based_metric = sed_eval.sound_event.EventBasedMetrics(
         event_label_list=reference_event_list.unique_event_labels,
@@ -105,20 +117,330 @@ def event_based_evaluation(reference_event_list, estimated_event_list):
     )
 
     for file in evaluated_files:
-        reference_event_list_for_current_file = []
-        # events = []
-        for event in reference_event_list:
-            if event['filename'] == file:
-                reference_event_list_for_current_file.append(event)
-                # events.append(event.event_label)
-        estimated_event_list_for_current_file = []
-        for event in estimated_event_list:
-            if event['filename'] == file:
-                estimated_event_list_for_current_file.append(event)
-
         event_based_metric.evaluate(
-            reference_event_list=reference_event_list_for_current_file,
-            estimated_event_list=estimated_event_list_for_current_file
+            reference_event_list=reference_by_file[file],
+            estimated_event_list=estimated_by_file.get(file, [])
         )
 
     return event_based_metric
+
+
+def group_by_filename(event_list):
+    """ Index the events of a list by their filename
+
+        Parameters
+        ----------
+
+        event_list : MetaDataContainer or list of dict, list of events
+
+        Return
+        ------
+
+        events_by_file : dict, filename -> list of the events of this file (in the original order)
+
+        """
+
+    events_by_file = {}
+    for event in event_list:
+        events_by_file.setdefault(event['filename'], []).append(event)
+
+    return events_by_file
+
+
+def event_arrays(event_list):
+    """ Split a list of events into one array per field
+
+        Parameters
+        ----------
+
+        event_list : MetaDataContainer or list of dict, list of events
+
+        Return
+        ------
+
+        filename : numpy.array of str
+
+        onset, offset : numpy.array of float, nan when the field is missing
+
+        event_label : numpy.array of object, None when the field is missing
+
+        """
+
+    filename, onset, offset, event_label = [], [], [], []
+    for event in event_list:
+        filename.append(event['filename'])
+        onset.append(event.get('onset'))
+        offset.append(event.get('offset'))
+        event_label.append(event.get('event_label'))
+
+    labels = numpy.empty(len(event_label), dtype=object)
+    labels[:] = event_label
+    return numpy.array(filename, dtype=object), numpy.array(onset, dtype=float), numpy.array(offset, dtype=float), labels
+
+
+def maximum_matching(reference_index, estimated_index):
+    """ Maximum bipartite matching between references and estimations (augmenting paths)
+
+        Parameters
+        ----------
+
+        reference_index, estimated_index : numpy.array of int, the two ends of each hit
+
+        Return
+        ------
+
+        matched : numpy.array of int, the references of the matching
+
+        """
+
+    adjacency = {}
+    for reference, estimated in zip(reference_index.tolist(), estimated_index.tolist()):
+        adjacency.setdefault(reference, []).append(estimated)
+
+    match = {}
+
+    def augment(reference, visited):
+        for estimated in adjacency[reference]:
+            if estimated not in visited:
+                visited.add(estimated)
+                if estimated not in match or augment(match[estimated], visited):
+                    match[estimated] = reference
+                    return True
+        return False
+
+    for reference in adjacency:
+        augment(reference, set())
+
+    return numpy.fromiter(match.values(), dtype=int, count=len(match))
+
+
+def event_based_fscore(reference_event_list, estimated_event_list, t_collar=0.200, percentage_of_length=0.2):
+    """ Event based F-measure computed with numpy, same counts as sed_eval (optimal matching)
+
+        An estimated event hits a reference event of the same file and class when its onset is within t_collar and
+        its offset within max(t_collar, percentage_of_length * reference length). The hits of all the files are
+        computed at once, each reference being only compared to the estimations of its (file, class) group, and the
+        true positives are the size of a maximum matching of the hits. Only the estimations of the reference files
+        are evaluated, as in event_based_evaluation.
+
+        Parameters
+        ----------
+
+        reference_event_list : MetaDataContainer or list of dict, list of referenced events
+
+        estimated_event_list : MetaDataContainer or list of dict, list of estimated events (see Encoder.toEvents)
+
+        t_collar : float, onset collar (and minimal offset collar) in seconds
+
+        percentage_of_length : float, offset collar as a part of the reference length
+
+        Return
+        ------
+
+        event_based_metric : EventBasedScores
+
+        """
+
+    ref_filename, ref_onset, ref_offset, ref_label = event_arrays(reference_event_list)
+    est_filename, est_onset, est_offset, est_label = event_arrays(estimated_event_list)
+
+    files = {file: i for i, file in enumerate(sorted(set(ref_filename)))}
+    event_labels = sorted(set(ref_label[numpy.not_equal(ref_label, None)]))
+    labels = {label: i for i, label in enumerate(event_labels)}
+    nb_class = len(event_labels)
+
+    # only the complete events of the reference files are evaluated
+    ref_valid = numpy.not_equal(ref_label, None) & ~numpy.isnan(ref_onset) & ~numpy.isnan(ref_offset)
+    est_valid = numpy.not_equal(est_label, None) & ~numpy.isnan(est_onset) & ~numpy.isnan(est_offset)
+    est_valid &= numpy.array([file in files for file in est_filename], dtype=bool)
+
+    ref_onset, ref_offset = ref_onset[ref_valid], ref_offset[ref_valid]
+    ref_class = numpy.array([labels[label] for label in ref_label[ref_valid]], dtype=int)
+    ref_key = numpy.array([files[file] for file in ref_filename[ref_valid]], dtype=int) * nb_class + ref_class
+
+    nb_sys = int(est_valid.sum())
+    est_onset, est_offset = est_onset[est_valid], est_offset[est_valid]
+    est_class = numpy.array([labels.get(label, -1) for label in est_label[est_valid]], dtype=int)
+    est_key = numpy.array([files[file] for file in est_filename[est_valid]], dtype=int) * nb_class + est_class
+    est_key[est_class < 0] = -1
+
+    # every (reference, estimation) pair of the same (file, class) group
+    est_order = numpy.argsort(est_key, kind="stable")
+    est_key = est_key[est_order]
+    first = numpy.searchsorted(est_key, ref_key, side="left")
+    count = numpy.searchsorted(est_key, ref_key, side="right") - first
+
+    ref_pair = numpy.repeat(numpy.arange(len(ref_key)), count)
+    est_pair = est_order[numpy.arange(count.sum()) - numpy.repeat(numpy.cumsum(count) - count, count) + first[ref_pair]]
+
+    tolerance = numpy.maximum(t_collar, percentage_of_length * (ref_offset - ref_onset))
+    hit = (numpy.abs(ref_onset[ref_pair] - est_onset[est_pair]) <= t_collar) & \
+          (numpy.abs(ref_offset[ref_pair] - est_offset[est_pair]) <= tolerance[ref_pair])
+    ref_hit, est_hit = ref_pair[hit], est_pair[hit]
+
+    # a hit whose both events have no other hit is always matched, the remaining hits need an augmenting path search
+    single = (numpy.bincount(ref_hit, minlength=len(ref_key))[ref_hit] == 1) & \
+             (numpy.bincount(est_hit, minlength=len(est_key))[est_hit] == 1)
+    matched = numpy.concatenate((ref_hit[single], maximum_matching(ref_hit[~single], est_hit[~single])))
+
+    return EventBasedScores(
+        event_label_list=event_labels,
+        Nref=numpy.bincount(ref_class, minlength=nb_class),
+        Nsys=numpy.bincount(est_class[est_class >= 0], minlength=nb_class),
+        Ntp=numpy.bincount(ref_class[matched], minlength=nb_class),
+        overall_Nsys=nb_sys,
+        evaluated_files=len(files),
+        t_collar=t_collar,
+        percentage_of_length=percentage_of_length,
+    )
+
+
+class EventBasedScores:
+    """ Counts and F-measures of event_based_fscore, with the F-measure part of the sed_eval EventBasedMetrics API
+    (precision or recall are nan without estimated or referenced event, the class-wise average ignores the nan)
+    """
+
+    def __init__(self, event_label_list, Nref, Nsys, Ntp, overall_Nsys, evaluated_files, t_collar,
+                 percentage_of_length):
+        self.event_label_list = list(event_label_list)
+        self.evaluated_files = evaluated_files
+        self.t_collar = t_collar
+        self.percentage_of_length = percentage_of_length
+
+        self.class_wise = {}
+        for label, nref, nsys, ntp in zip(self.event_label_list, Nref, Nsys, Ntp):
+            self.class_wise[label] = {'Nref': float(nref), 'Nsys': float(nsys), 'Ntp': float(ntp)}
+
+        self.overall = {'Nref': float(numpy.sum(Nref)), 'Nsys': float(overall_Nsys), 'Ntp': float(numpy.sum(Ntp))}
+
+    @staticmethod
+    def f_measure(counts):
+        precision = counts['Ntp'] / counts['Nsys'] if counts['Nsys'] else numpy.nan
+        recall = counts['Ntp'] / counts['Nref'] if counts['Nref'] else numpy.nan
+
+        if precision == 0 and recall == 0:
+            f_measure = 0.0
+        else:
+            f_measure = 2 * precision * recall / (precision + recall)
+
+        return {'f_measure': f_measure, 'precision': precision, 'recall': recall}
+
+    def overall_f_measure(self):
+        return self.f_measure(self.overall)
+
+    def class_wise_f_measure(self, event_label):
+        return self.f_measure(self.class_wise[event_label])
+
+    def results_overall_metrics(self):
+        return {'f_measure': self.overall_f_measure()}
+
+    def results_class_wise_metrics(self):
+        return {label: {'f_measure': self.class_wise_f_measure(label)} for label in self.event_label_list}
+
+    def results_class_wise_average_metrics(self):
+        class_wise = [self.class_wise_f_measure(label) for label in self.event_label_list]
+        return {'f_measure': {
+            key: float(numpy.nanmean([scores[key] for scores in class_wise])) if class_wise else numpy.nan
+            for key in ('f_measure', 'precision', 'recall')
+        }}
+
+    def results(self):
+        return {
+            'overall': self.results_overall_metrics(),
+            'class_wise': self.results_class_wise_metrics(),
+            'class_wise_average': self.results_class_wise_average_metrics(),
+        }
+
+    def __str__(self):
+        overall = self.overall_f_measure()
+        average = self.results_class_wise_average_metrics()['f_measure']
+
+        lines = [
+            "Event based metrics (onset-offset, numpy backend)",
+            "  Evaluated files : %d" % self.evaluated_files,
+            "  t_collar : %.3f sec, offset collar : %d %% of length" % (self.t_collar,
+                                                                     100 * self.percentage_of_length),
+            "",
+            "  Overall metrics (micro-average)",
+            "    F-measure (F1) : %.2f %%" % (100 * overall['f_measure']),
+            "    Precision : %.2f %%" % (100 * overall['precision']),
+            "    Recall : %.2f %%" % (100 * overall['recall']),
+            "",
+            "  Class-wise average metrics (macro-average)",
+            "    F-measure (F1) : %.2f %%" % (100 * average['f_measure']),
+            "    Precision : %.2f %%" % (100 * average['precision']),
+            "    Recall : %.2f %%" % (100 * average['recall']),
+            "",
+            "  Class-wise metrics",
+            "    %-28s | %6s %6s | %8s %8s %8s" % ("Event label", "Nref", "Nsys", "F", "Pre", "Rec"),
+        ]
+        for label in self.event_label_list:
+            counts, scores = self.class_wise[label], self.class_wise_f_measure(label)
+            lines.append("    %-28s | %6d %6d | %6.1f %% %6.1f %% %6.1f %%" % (
+                label, counts['Nref'], counts['Nsys'],
+                100 * scores['f_measure'], 100 * scores['precision'], 100 * scores['recall']))
+
+        return "\n".join(lines) + "\n"
+
+
+if __name__ == "__main__":
+    # parity of the numpy backend with sed_eval on the test annotations and perturbed estimations
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--meta", default="meta/test.csv", help="reference annotations")
+    parser.add_argument("--trials", type=int, default=5, help="number of perturbed estimations")
+    args = parser.parse_args()
+
+    reference = MetaDataContainer()
+    reference.load(filename=args.meta)
+    reference_events = [event for event in reference if event.get('event_label') is not None]
+    event_labels = reference.unique_event_labels
+    rng = numpy.random.RandomState(0)
+
+    for trial in range(args.trials):
+        jitter = 0.1 * (trial + 1)
+        estimated = []
+        for event in reference_events:
+            if rng.rand() < 0.1:
+                continue
+
+            # the duplicates create several hits for the same reference (matching needed)
+            for _ in range(1 + (rng.rand() < 0.2)):
+                onset = max(0.0, event['onset'] + rng.uniform(-jitter, jitter))
+                offset = max(onset, event['offset'] + rng.uniform(-jitter, jitter))
+                label = event['event_label'] if rng.rand() > 0.05 else event_labels[rng.randint(len(event_labels))]
+                estimated.append({'filename': event['filename'], 'onset': onset, 'offset': offset,
+                                  'event_label': label})
+
+        # spurious events, some of them in files without reference
+        for _ in range(len(reference_events) // 10):
+            event = reference_events[rng.randint(len(reference_events))]
+            onset = rng.uniform(0, 9)
+            filename = event['filename'] if rng.rand() > 0.2 else "unknown.wav"
+            estimated.append({'filename': filename, 'onset': onset, 'offset': onset + rng.uniform(0.1, 1),
+                              'event_label': event_labels[rng.randint(len(event_labels))]})
+
+        start = time.time()
+        expected = event_based_evaluation(reference, estimated)
+        sed_eval_time = time.time() - start
+
+        start = time.time()
+        obtained = event_based_evaluation(reference, estimated, backend="numpy")
+        numpy_time = time.time() - start
+
+        difference = max(
+            abs(expected.class_wise_f_measure(label)['f_measure'] - obtained.class_wise_f_measure(label)['f_measure'])
+            for label in event_labels
+        )
+        difference = max(difference, abs(expected.overall_f_measure()['f_measure'] -
+                                         obtained.overall_f_measure()['f_measure']))
+        difference = max(difference, abs(expected.results_class_wise_average_metrics()['f_measure']['f_measure'] -
+                                         obtained.results_class_wise_average_metrics()['f_measure']['f_measure']))
+
+        print("jitter %.1f s, %d estimated events: macro F1 %.4f, max |difference| %.2e, sed_eval %.3f s, "
+              "numpy %.3f s (x%.0f)" % (jitter, len(estimated),
+                                       obtained.results_class_wise_average_metrics()['f_measure']['f_measure'],
+                                       difference, sed_eval_time, numpy_time, sed_eval_time / numpy_time))
+        assert difference < 1e-12
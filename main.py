@@ -9,7 +9,6 @@ import numpy as np
 from tensorflow import set_random_seed
 
 from keras.optimizers import Adam
-from keras.models import Model
 from keras.callbacks import EarlyStopping, ModelCheckpoint, ReduceLROnPlateau
 
 import Models
@@ -18,7 +17,8 @@ import Metrics
 from Binarizer import Binarizer
 from Encoder import Encoder
 import CallBacks
-from datasetGenerator import DCASE2018
+from datasetGenerator import DCASE2018, FeatureStore
+import DataSequence
 
 # evaluate
 from evaluation_measures import event_based_evaluation
@@ -52,24 +52,23 @@ if __name__ == '__main__':
     #       MANAGE PROGRAM ARGUMENTS
     # ==================================================================================================================
     parser = argparse.ArgumentParser()
-    parser.add_argument("--normalizer", type=str, help="normalizer [file_MinMax | global_MinMax | file_Mean | global_Mean | file_standard | global_standard | unit")
+    parser.add_argument("--normalizer", type=str, help="normalizer [file_MinMax | global_MinMax | file_Mean | global_Mean | file_Standard | global_Standard | unit")
     parser.add_argument("--output_model", help="basename for save file of the model")
     parser.add_argument("--meta_root", help="Path to the meta directory")
     parser.add_argument("--features_root", help="Path to the features directory")
+    parser.add_argument("--store_root", help="Path to the packed features directory (memory-mapped feature store)")
+    parser.add_argument("-pack", help="Pack the features into the store before building the dataset", action="store_true")
+    parser.add_argument("--workers", type=int, default=8, help="Number of files loaded concurrently")
+    parser.add_argument("--export", help="Path of the csv file where the strong annotations are saved (optional)")
+    parser.add_argument("--evaluation_backend", default="sed_eval", help="Event based evaluation [sed_eval | numpy]")
+    parser.add_argument("--eval_interval", type=int, default=1, help="Compute the per class validation metrics every n epochs")
+    parser.add_argument("--snapshot_dir", help="Keep the weight snapshots of the training on disk instead of memory")
     parser.add_argument("-uid", help="Use unlabel in domain dataset", action="store_true")
     parser.add_argument("-retrain", help="Force retrain model", action="store_true")
     parser.add_argument("-w", help="If set, display the warnigs", action="store_true")
     args = parser.parse_args()
 
-    normalizer = None
-    if args.normalizer:
-        if args.normalizer == "file_MinMax": normalizer = Normalizer.MinMaxScaler()
-        if args.normalizer == "file_Mean": normalizer = Normalizer.MeanScaler()
-        if args.normalizer == "file_Standard": normalizer = Normalizer.StandardScaler()
-        if args.normalizer == "global_MinMax": normalizer = Normalizer.MinMaxScaler(methods="global")
-        if args.normalizer == "global_Mean": normalizer = Normalizer.MeanScaler(methods="global")
-        if args.normalizer == "global_Standard": normalizer = Normalizer.StandardScaler(methods="global")
-        if args.normalizer == "unit": normalizer = Normalizer.UnitScaler()
+    normalizer = Normalizer.get(args.normalizer)
 
     if not args.w:
         import warnings
@@ -101,14 +100,28 @@ if __name__ == '__main__':
     metaRoot = args.meta_root
     featRoot = args.features_root
     feat = ["mel"]
+
+    # reuse the normalization statistics of an already trained model
+    normalizerPath = dirPath + "_normalizer.npz" if dirPath is not None else None
+    if normalizer is not None and normalizerPath is not None and os.path.isfile(normalizerPath) and not args.retrain:
+        normalizer.load(normalizerPath)
+
+    if args.pack and args.store_root is not None:
+        FeatureStore.pack(featRoot, args.store_root, feat)
+
     dataset = DCASE2018(
         feature_root=featRoot,
         meta_root=metaRoot,
         features=feat,
         validation_percent=0.2,
-        normalizer=normalizer
+        normalizer=normalizer,
+        store_root=args.store_root,
+        nb_workers=args.workers
     )
 
+    if normalizer is not None and normalizerPath is not None:
+        normalizer.save(normalizerPath)
+
     # ==================================================================================================================
     #       Build mode & prepare hyper parameters & train
     #           - if not already done
@@ -124,12 +137,14 @@ if __name__ == '__main__':
     completeLogger = CallBacks.CompleteLogger(
         logPath=dirPath,
         validation_data=(dataset.validation_dataset["mel"]["input"], dataset.validation_dataset["mel"]["output"]),
-        fallback = True, fallBackThreshold = 3, stopAt = 100
+        fallback = True, fallBackThreshold = 3, stopAt = 100, eval_interval = args.eval_interval,
+        spillDir = args.snapshot_dir, normalizer = normalizer, batch_size = batch_size
     )
     early_stopping = EarlyStopping(patience=10, verbose=1)
     model_checkpoint = ModelCheckpoint("./keras.model", save_best_only=True)
     reduce_lr = ReduceLROnPlateau(factor=0.15, patience=5, min_lr=0.000005)
 
+    # the logger does the validation and gives the val_* metrics to the other callbacks, it must stay the first
     callbacks = [completeLogger, early_stopping, model_checkpoint, reduce_lr]
 
     # compile & fit model
@@ -137,17 +152,18 @@ if __name__ == '__main__':
         model = Models.crnn_mel64_tr2(dataset)
         #model = Models.dense_crnn_mel64_tr2(dataset)
 
+        training_sequence = DataSequence.DCASE2018Sequence(
+            [(dataset.training_dataset["mel"]["input"], dataset.training_dataset["mel"]["output"])],
+            batch_size=batch_size, normalizer=normalizer
+        )
+
         model.compile(loss=loss, optimizer=optimizer, metrics=metrics)
-        model.fit(
-            x=dataset.training_dataset["mel"]["input"],
-            y=dataset.training_dataset["mel"]["output"],
+        model.fit_generator(
+            training_sequence,
             epochs=epochs,
-            batch_size=batch_size,
-            validation_data=(
-                dataset.validation_dataset["mel"]["input"],
-                dataset.validation_dataset["mel"]["output"]
-            ),
             callbacks=callbacks,
+            workers=args.workers,
+            use_multiprocessing=True,
             verbose=0
         )
 
@@ -174,11 +190,13 @@ if __name__ == '__main__':
 
     # save original model and keep track of the best one.
     # Optimize thresholds
-    prediction = model.predict(dataset.validation_dataset[feat[0]]["input"])
+    prediction = DataSequence.predict(model, dataset.validation_dataset[feat[0]]["input"], normalizer)
     binPrediction = binarizer.binarize(prediction)
     f10 = f1_score(dataset.validation_dataset[feat[0]]["output"], binPrediction, average=None)
 
     binarizer.optimize(dataset.validation_dataset["mel"]["output"], prediction)
+    if dirPath is not None:
+        binarizer.save(dirPath + "_thresholds.json")
     binPrediction = binarizer.binarize(prediction)
     f1 = f1_score(dataset.validation_dataset[feat[0]]["output"], binPrediction, average=None)
 
@@ -204,48 +222,40 @@ if __name__ == '__main__':
 
             # Predict the complete unlabel_in_domain dataset and use it to expand the training dataset
             print("Predicting the unlabel in domain dataset ...")
-            toPredict = [uid_features[f] for f in feat]
-            prediction = model.predict(toPredict)
+            prediction = DataSequence.predict(model, uid_features[feat[0]], normalizer, batch_size=128)
             binPrediction = binarizer.binarize(prediction)
 
             print("Expand training dataset and re-training ...")
             dataset.expand_with_uid(uid_features, binPrediction)
 
-            # use both weak dataset and unlabel in domain dataset as training dataset
-            forTraining = {
-                "input": np.concatenate(
-                    (dataset.training_dataset["mel"]["input"], dataset.training_uid_dataset["mel"]["input"])),
-                "output": np.concatenate(
-                    (dataset.training_dataset["mel"]["output"], dataset.training_uid_dataset["mel"]["output"]))
-            }
+            # use both weak dataset and unlabel in domain dataset as training dataset (streamed, not concatenated)
+            forTraining = DataSequence.DCASE2018Sequence(
+                [(dataset.training_dataset["mel"]["input"], dataset.training_dataset["mel"]["output"]),
+                 (dataset.training_uid_dataset["mel"]["input"], dataset.training_uid_dataset["mel"]["output"])],
+                batch_size=128, normalizer=normalizer
+            )
 
             # use the whole weak dataset as validation dataset
-            forValidation = {
-                "input": np.concatenate(
-                    (dataset.training_dataset["mel"]["input"], dataset.validation_dataset["mel"]["input"])),
-                "output": np.concatenate(
-                    (dataset.training_dataset["mel"]["output"], dataset.validation_dataset["mel"]["output"])),
-            }
+            forValidation = DataSequence.DCASE2018Sequence(
+                [(dataset.training_dataset["mel"]["input"], dataset.training_dataset["mel"]["output"]),
+                 (dataset.validation_dataset["mel"]["input"], dataset.validation_dataset["mel"]["output"])],
+                batch_size=128, normalizer=normalizer, shuffle=False
+            )
 
             # ==================================================================================================================
             #   Train new model with extended dataset (reset the weight)
             # ==================================================================================================================
-            trainingIterationPerEpoch = len(forTraining["input"]) / batch_size
-
             #m odel2 = Models.dense_crnn_mel64_tr2(dataset)
             model_2 = Models.crnn_mel64_tr2(dataset)
 
             model_2.compile(loss=loss, optimizer=optimizer, metrics=metrics)
-            model_2.fit(
-                x=forTraining["input"],
-                y=forTraining["output"],
+            completeLogger.setValidation(forValidation)
+            model_2.fit_generator(
+                forTraining,
                 epochs=100,
-                validation_data=(
-                    forValidation["input"],
-                    forValidation["output"]
-                ),
-                batch_size=128,
                 callbacks=callbacks,
+                workers=args.workers,
+                use_multiprocessing=True,
                 verbose=0
             )
 
@@ -260,7 +270,7 @@ if __name__ == '__main__':
 
         # compute f1 score and same (for later comparison)
         print("Compute the final f1 score ...")
-        prediction = model_2.predict(dataset.validation_dataset[feat[0]]["input"])
+        prediction = DataSequence.predict(model_2, dataset.validation_dataset[feat[0]]["input"], normalizer)
         binPrediction = binarizer.binarize(prediction)
         f1 = f1_score(dataset.validation_dataset[feat[0]]["output"], binPrediction, average=None)
         best["transfer weight"] = model.get_weights()
@@ -272,61 +282,39 @@ if __name__ == '__main__':
     if args.uid:
         model_2.summary()
         g_model = model_2
-        t_model = Model(input=model_2.input, output=model_2.get_layer("time_distributed_1").output)
-        tw_model = Models.use_wgru(dirPath + "_2")
+        g_path = dirPath + "_2" if dirPath is not None else None
 
     else:
         model.summary()
         g_model = model
-        t_model = Model(input=model.input, output=model.get_layer("time_distributed_1").output)
-        tw_model = Models.use_wgru(dirPath)
+        g_path = dirPath
 
     # global prediction
     # gPrediction = gModel.predict(dataset.testingDataset["mel"]["input"])
     # gbPrediction = binarizer.binarize(gPrediction)
 
-    # temporal prediction using both WGRU and GRU
-    t_prediction = t_model.predict(dataset.testing_dataset["mel"]["input"])
-    tw_prediction = tw_model.predict(dataset.testing_dataset["mel"]["input"])
-    nb_frame = t_prediction.shape[1]
-    print(t_prediction.shape)
-
-    # mix the prediction giving the globals prediction
-    wgru_cls = [0, 2, 1]               # "impulse" event well detected by the WGRU
-    gru_cls = [8, 3, 5, 7, 6, 9, 4]   # "stationary" event well detected by the GRU
-
-    final_t_prediction = []
-    for i in range(len(t_prediction)):
-
-        curves = np.array([[0] * dataset.nbClass for _ in range(nb_frame)], dtype=np.float32)
+    # temporal prediction using both WGRU and GRU, one pass in a model sharing the CNN and mixing the heads
+    wgru_cls = [0, 2, 1]               # "impulse" event well detected by the WGRU, the "stationary" ones by the GRU
+    t_model = Models.fused_temporal(g_model, wgru_classes=wgru_cls, temporal_weight=0.25)
+    if g_path is not None:
+        Models.save_inference(g_path, t_model)
 
-        # use the WGRU temporal
-        for c in wgru_cls:
-            curves[:,c] = tw_prediction[i][:, c] # use the wgru temporal prediction
-
-        for c in gru_cls:
-            curves[:,c] = t_prediction[i][:, c]  # use the classic gru temporal prediction
-
-        final_t_prediction.append(curves)
-    final_t_prediction = np.array(final_t_prediction)
+    final_t_prediction = DataSequence.predict(t_model, dataset.testing_dataset["mel"]["input"], normalizer)
     print(final_t_prediction.shape)
 
     encoder = Encoder()
     segments = encoder.encode(final_t_prediction, method="threshold", smooth="smoothMovingAvg")
-    toEvaluate = encoder.parse(segments, dataset.test_file_list)
+    perso_event_list = encoder.toEvents(segments, dataset.test_file_list)
 
-    print("perform evaluation ...")
-    with open("toEvaluate.csv", "w") as f:
-        f.write("filename\tonset\toffset\tevent_label\n")
-        f.write(toEvaluate)
+    if args.export is not None:
+        encoder.export(segments, dataset.test_file_list, args.export)
 
-    perso_event_list = MetaDataContainer()
-    perso_event_list.load(filename="toEvaluate.csv")
+    print("perform evaluation ...")
 
     ref_event_list = MetaDataContainer()
     ref_event_list.load(filename=dataset.meta_test)
 
-    event_based_metric = event_based_evaluation(ref_event_list, perso_event_list)
+    event_based_metric = event_based_evaluation(ref_event_list, perso_event_list, backend=args.evaluation_backend)
     print(event_based_metric)
 
     print("Saving final results in final_results.txt")
@@ -1,17 +1,18 @@
 import argparse
 import os
 import tqdm
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-parser = argparse.ArgumentParser()
-parser.add_argument("-d", help="dir where the data are")
+# headless rendering, set before the parsers import pyplot
+import matplotlib
+matplotlib.use("Agg")
 
-args = parser.parse_args()
+from parse_metrics import MetricParser
+from parse_detail import DetailParser
 
-listFiles = os.listdir(args.d)
+# files that can be parsed
+extensions = ["csv", "npz"]
 
-# remove element that are can't be parse
-extensions = ["csv"]
-toParse = [i for i in listFiles if i.split(".")[-1] in extensions]
 
 # groups the files
 def addToDict(dict, key, value):
@@ -21,27 +22,87 @@ def addToDict(dict, key, value):
     else:
         dict[key] = [value]
 
-files = {}
-for f in toParse:
-    detail = f.split("_")
-    print(detail)
-    addToDict(files, detail[0:-1], detail[-1])
 
-# parse all files
-from parse_metrics import MetricParser
-from parse_detail import DetailParser
+def groupRuns(directory: str) -> dict:
+    """ run name -> list of the suffixes of its log files (metrics.csv, f1.csv, log.npz, ...) """
+    files = {}
+    for f in sorted(os.listdir(directory)):
+        if f.split(".")[-1] in extensions:
+            detail = f.split("_")
+            addToDict(files, detail[0:-1], detail[-1])
+
+    return files
+
+
+def upToDate(logs: list, figures: list) -> bool:
+    """ True if all the figures exist and are newer than all the logs """
+    if not all(os.path.isfile(f) for f in figures):
+        return False
+
+    return min(os.path.getmtime(f) for f in figures) >= max(os.path.getmtime(f) for f in logs)
+
+
+def processRun(path: str, suffixes: list, output: str, force: bool) -> tuple:
+    """
+    Render the two figures of a run when they are missing or older than its logs.
+    :return: best epoch, best val f1, number of epochs, True if the figures were rendered
+    """
+    name = os.path.join(output, os.path.basename(path))
+    logs = [path + "_" + suffix for suffix in suffixes]
+    figures = [name + "_metrics.png", name + ".png"]
+
+    data = MetricParser.loadData(path + "_metrics.csv")
+    bestEpoch = MetricParser.findbestEpoch(data["val f1"])
+
+    rendered = force or not upToDate(logs, figures)
+    if rendered:
+        MetricParser.plot(data, name + "_metrics")
+        DetailParser.parseAndSave(path, name, bestEpoch)
+
+    return bestEpoch, float(data["max val f1"]), len(data["val f1"]), rendered
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", default=".", help="dir where the data are")
+    parser.add_argument("-o", default=".", help="dir where the figures and the summary are saved")
+    parser.add_argument("-j", type=int, default=os.cpu_count(), help="number of processes")
+    parser.add_argument("-force", help="Render the figures even if they are up to date", action="store_true")
+
+    args = parser.parse_args()
+    os.makedirs(args.o, exist_ok=True)
+
+    files = groupRuns(args.d)
+
+    # parse all runs, one process per run
+    summary = []
+    failed = []
+    with ProcessPoolExecutor(max_workers=args.j) as executor, \
+            tqdm.tqdm(total=len(files), unit="Runs") as progress:
+        futures = {executor.submit(processRun, os.path.join(args.d, f), files[f], args.o, args.force): f
+                   for f in files}
+
+        for future in as_completed(futures):
+            try:
+                summary.append((futures[future],) + future.result())
+            except Exception as e:
+                failed.append((futures[future], e))
 
-with tqdm.tqdm(total=len(files), unit="Files") as progress:
-    for f in files:
-        print("f: ", f)
-        if args.d is not None:
-            path = os.path.join(args.d, f)
-        else:
-            path = os.path.join(".", f)
+            progress.update()
 
-        print("path: ", path)
-        e = MetricParser.parseAndSave(path+"_metrics.csv", f + "_metrics")
-        DetailParser.parseAndSave(path, f, e)
+    # summary table, best runs first
+    summary.sort(key=lambda row: row[2], reverse=True)
+    summaryPath = os.path.join(args.o, "summary.csv")
+    with open(summaryPath, "w") as f:
+        f.write("run,best epoch,best val f1,epochs\n")
+        for run, epoch, f1, nbEpoch, _ in summary:
+            f.write("%s,%d,%s,%d\n" % (run, epoch, f1, nbEpoch))
 
-        progress.update()
+    print("{:<50}{:<12}{:<14}{:<8}".format("run", "best epoch", "best val f1", "epochs"))
+    for run, epoch, f1, nbEpoch, _ in summary:
+        print("{:<50}{:<12}{:<14.4f}{:<8}".format(run, epoch, f1, nbEpoch))
 
+    print("%d runs rendered, %d up to date, summary saved in %s" % (
+        sum(row[-1] for row in summary), sum(not row[-1] for row in summary), summaryPath))
+    for run, e in failed:
+        print("Can't parse %s: %s" % (run, e))
@@ -3,6 +3,8 @@ import numpy as np
 import argparse
 import os
 
+import run_log
+
 class DetailParser:
     CLASSES = ["Alarm_bell_ringing", "Speech", "Dog", "Cat", "Vacuum_cleaner", "Dishes", "Frying", "Electric_shaver_toothbrush", "Blender", "Running_water"]
 
@@ -48,23 +50,32 @@ class DetailParser:
 
     @staticmethod
     def parseAndSave(path: str, name: str, epoch: int):
-        data_recall = DetailParser.loadFile(path + "_recall.csv")
-        data_prec = DetailParser.loadFile(path + "_precision.csv")
-        data_f1 = DetailParser.loadFile(path + "_f1.csv")
-        hr = DetailParser.getFinalValue(data_recall, epoch)
-        hp = DetailParser.getFinalValue(data_prec, epoch)
-        hf = DetailParser.getFinalValue(data_f1, epoch)
+        classes = DetailParser.CLASSES
+        log = run_log.load(path)
+
+        if log is not None:
+            row = run_log.evaluatedRow(log, epoch)
+            classes = [str(c) for c in log["classes"]]
+            hr, hp, hf = log["class_recall"][row], log["class_precision"][row], log["class_f1"][row]
+        else:
+            data_recall = DetailParser.loadFile(path + "_recall.csv")
+            data_prec = DetailParser.loadFile(path + "_precision.csv")
+            data_f1 = DetailParser.loadFile(path + "_f1.csv")
+            hr = DetailParser.getFinalValue(data_recall, epoch)
+            hp = DetailParser.getFinalValue(data_prec, epoch)
+            hf = DetailParser.getFinalValue(data_f1, epoch)
 
         plt.figure(figsize=(16, 10))
-        plt.title(name)
-        plt.bar(np.array(range(len(hr))) - 0.2, hr, width= 0.2, tick_label=DetailParser.CLASSES, zorder=3, color = "C0", label="recall")
-        plt.bar(np.array(range(len(hp))), hp, width= 0.2, tick_label=DetailParser.CLASSES, zorder=3, color = "C1", label="precision")
-        plt.bar(np.array(range(len(hf))) + 0.2, hf, width= 0.2, tick_label=DetailParser.CLASSES, zorder=3, color = "C2", label="f1")
+        plt.title(os.path.basename(name))
+        plt.bar(np.array(range(len(hr))) - 0.2, hr, width= 0.2, tick_label=classes, zorder=3, color = "C0", label="recall")
+        plt.bar(np.array(range(len(hp))), hp, width= 0.2, tick_label=classes, zorder=3, color = "C1", label="precision")
+        plt.bar(np.array(range(len(hf))) + 0.2, hf, width= 0.2, tick_label=classes, zorder=3, color = "C2", label="f1")
         #plt.xticks(rotation="85")
         plt.grid(zorder=0)
         plt.tight_layout()
         plt.legend()
         plt.savefig(name + ".png")
+        plt.close()
 
     """
     # display
@@ -3,7 +3,11 @@ import numpy as np
 import argparse
 import os
 
+import run_log
+
 class MetricParser:
+    # name of the keras metrics in the figures
+    ALIASES = {"acc": "binary acc", "accuracy": "binary acc", "binary_accuracy": "binary acc"}
 
     @staticmethod
     def drawLine(high: float) -> tuple:
@@ -47,6 +51,32 @@ class MetricParser:
             "max val binary acc": max(matrix[:,8])
         }
 
+    @staticmethod
+    def separate_columns(log: dict) -> dict:
+        """ Same keys as separate_metrics, from the columnar log (only the metrics that were computed) """
+        data = {"epoch": log["epoch"]}
+        for metric in log["metrics"]:
+            name, prefix = str(metric), ""
+            if name.startswith("val_"):
+                name, prefix = name[4:], "val "
+            data[prefix + MetricParser.ALIASES.get(name, name)] = log[str(metric)]
+
+        for key, column in [("max val f1", "val f1"), ("max recall", "val recall"),
+                            ("max precision", "val precision"), ("max val binary acc", "val binary acc")]:
+            if column in data:
+                data[key] = max(data[column])
+
+        return data
+
+    @staticmethod
+    def loadData(path: str) -> dict:
+        """ The metrics of a run from its columnar log when it exists, from the <run>_metrics.csv file otherwise """
+        log = run_log.load(path[:-len("_metrics.csv")]) if path.endswith("_metrics.csv") else None
+        if log is not None:
+            return MetricParser.separate_columns(log)
+
+        return MetricParser.separate_metrics(MetricParser.loadFile(path))
+
     @staticmethod
     def findbestEpoch(f1: list):
         cpt = 0
@@ -61,25 +91,29 @@ class MetricParser:
 
     @staticmethod
     def parseAndSave(path: str, name: str) -> int:
-        data = MetricParser.loadFile(path)
-        data = MetricParser.separate_metrics(data)
+        data = MetricParser.loadData(path)
+        MetricParser.plot(data, name)
+
+        return MetricParser.findbestEpoch(data["val f1"])
 
+    @staticmethod
+    def plot(data: dict, name: str):
         # display
         plt.figure(figsize=(16, 10))
         plt.subplot(111)
-        plt.plot(data["val loss"], label="val loss", color='C2', linewidth=1)
-        plt.plot(data["loss"], label="tra loss", color='C2', linewidth=1, alpha=0.5)
-        plt.plot(data["val binary acc"], label="val acc (%s)" % data["max val binary acc"], color='C1', linewidth=1)
-        plt.plot(data["binary acc"], label="tra acc", color='C1', linewidth=1, alpha=0.5)
-        plt.plot(data["val f1"], label="val f1 (%s)" % data["max val f1"], color='C0', linewidth=1)
-        plt.plot(data["f1"], label="tra f1", color='C0', linewidth=1, alpha=0.5)
+        for key, label, color in [("loss", "loss", "C2"), ("binary acc", "acc", "C1"), ("f1", "f1", "C0")]:
+            if "val " + key in data:
+                maxi = data.get("max val " + key)
+                legend = "val %s (%s)" % (label, maxi) if maxi is not None else "val %s" % label
+                plt.plot(data["val " + key], label=legend, color=color, linewidth=1)
+            if key in data:
+                plt.plot(data[key], label="tra %s" % label, color=color, linewidth=1, alpha=0.5)
 
         # print reference line
         plt.plot([0.72]*100, '--C0', label="baseline val f1 = 0.72", linewidth=1)
-        plt.title(name)
+        plt.title(os.path.basename(name))
         plt.legend()
         plt.tight_layout()
         plt.savefig(name + ".png")
-
-        return MetricParser.findbestEpoch(data["val f1"])
+        plt.close()
 
@@ -0,0 +1,30 @@
+"""
+Loader of the columnar log written by CallBacks.CompleteLogger (<log path>_log.npz).
+
+One row per epoch at full precision: "epoch", "duration", each keras metric under its own name ("loss", "val_f1",
+...) listed in "metrics", and the per class "class_precision", "class_recall", "class_f1" (<nb epoch>, <nb class>),
+nan for the epochs where they were not computed, the class names being in "classes".
+"""
+import numpy as np
+import os
+
+
+def path(base: str) -> str:
+    return base + "_log.npz"
+
+
+def load(base: str) -> dict:
+    """ The columns of the run <base>, None if it has no columnar log (older runs, csv only) """
+    if not os.path.isfile(path(base)):
+        return None
+
+    with np.load(path(base)) as f:
+        return {key: f[key] for key in f.files}
+
+
+def evaluatedRow(log: dict, epoch: int) -> int:
+    """ Row of the last epoch <= <epoch> where the per class metrics were computed (the first one otherwise) """
+    evaluated = np.flatnonzero(~np.isnan(log["class_f1"]).all(axis=1))
+    before = evaluated[log["epoch"][evaluated] <= epoch]
+
+    return int(before[-1]) if len(before) > 0 else int(evaluated[0])
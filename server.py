@@ -0,0 +1,224 @@
+"""
+Inference server for the strong label detection.
+
+The model, the thresholds of the Binarizer and the normalization statistics are loaded once. The clients POST the
+mel features of one or several clips as a .npy body ((64, 431) or (<nb clip>, 64, 431), with or without the channel
+axis) and receive the detected events of each clip in json:
+
+    curl --data-binary @clip.npy http://localhost:8000/detect
+    {"events": [[{"onset": 0.23, "offset": 2.1, "event_label": "Dog"}, ...]]}
+
+The requests received within <max_latency> ms are gathered into one batch (up to <max_batch> clips) so the CNN runs
+on full batches, a single thread owns the model.
+"""
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import argparse
+import io
+import json
+import queue
+import threading
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import Models
+import Normalizer
+from Binarizer import Binarizer
+from Encoder import Encoder
+
+
+class Detector:
+    """ Temporal prediction of the fused GRU / WGRU model followed by the localization of the Encoder """
+    def __init__(self, modelPath: str, normalizer: Normalizer.Scaler = None, wgru_classes: list = (0, 2, 1),
+                 method: str = "threshold", smooth: str = "smoothMovingAvg", batch_size: int = 32):
+        self.normalizer = normalizer
+        self.method = method
+        self.smooth = smooth
+        self.batch_size = batch_size
+        self.encoder = Encoder()
+
+        # the model is used from the batcher thread, in the graph it was built in
+        self.graph = tf.get_default_graph()
+        with self.graph.as_default():
+            self.model = Models.temporal_model(modelPath, wgru_classes=list(wgru_classes))
+            self.model._make_predict_function()
+
+        self.inputShape = tuple(self.model.input_shape[1:3])
+
+    def detect(self, clips: np.array) -> list:
+        """
+        :param clips: mel features (<nb clip>, <nb band>, <nb frame>)
+        :return: the events of each clip, list of dict {"onset", "offset", "event_label"}
+        """
+        clips = clips.astype(np.float32, copy=False)
+        if self.normalizer is not None:
+            clips = self.normalizer.transform(clips)
+
+        with self.graph.as_default():
+            prediction = self.model.predict(np.expand_dims(clips, axis=-1), batch_size=self.batch_size)
+
+        segments = self.encoder.encode(prediction, method=self.method, smooth=self.smooth)
+        return self.encoder.clipEvents(segments, len(clips))
+
+
+class MicroBatcher(threading.Thread):
+    """
+    Gather the clips of the concurrent requests: a batch is run when <max_batch> clips are waiting or <max_latency>
+    seconds after its first request.
+    """
+    def __init__(self, detector: Detector, max_batch: int = 32, max_latency: float = 0.02):
+        super().__init__(daemon=True)
+        self.detector = detector
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.requests = queue.Queue()
+        self.nbBatch = 0
+        self.nbClip = 0
+
+    def submit(self, clips: np.array) -> list:
+        """ Wait for the events of the clips (called from the request threads) """
+        request = {"clips": clips, "done": threading.Event(), "events": None, "error": None}
+        self.requests.put(request)
+        request["done"].wait()
+
+        if request["error"] is not None:
+            raise request["error"]
+        return request["events"]
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            size = len(batch[0]["clips"])
+            deadline = time.time() + self.max_latency
+
+            while size < self.max_batch:
+                try:
+                    request = self.requests.get(timeout=max(0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                batch.append(request)
+                size += len(request["clips"])
+
+            try:
+                events = self.detector.detect(np.concatenate([r["clips"] for r in batch]))
+                start = 0
+                for request in batch:
+                    request["events"] = events[start:start + len(request["clips"])]
+                    start += len(request["clips"])
+            except Exception as e:
+                for request in batch:
+                    request["error"] = e
+
+            self.nbBatch += 1
+            self.nbClip += size
+            for request in batch:
+                request["done"].set()
+
+
+class DetectionHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/health":
+            self.__reply(404, {"error": "unknown path %s" % self.path})
+            return
+
+        batcher = self.server.batcher
+        self.__reply(200, {"status": "ok", "batches": batcher.nbBatch, "clips": batcher.nbClip,
+                           "mean batch": batcher.nbClip / max(1, batcher.nbBatch)})
+
+    def do_POST(self):
+        if self.path != "/detect":
+            self.__reply(404, {"error": "unknown path %s" % self.path})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            clips = np.load(io.BytesIO(self.rfile.read(length)), allow_pickle=False)
+        except (ValueError, OSError, EOFError) as e:
+            self.__reply(400, {"error": "the body must be a .npy array (%s)" % e})
+            return
+
+        if not np.issubdtype(clips.dtype, np.number):
+            self.__reply(400, {"error": "wrong dtype %s, expected numbers" % clips.dtype})
+            return
+
+        # (band, frame), (band, frame, 1), (clip, band, frame) or (clip, band, frame, 1)
+        if clips.ndim in (3, 4) and clips.shape[-1] == 1:
+            clips = clips[..., 0]
+        if clips.ndim == 2:
+            clips = clips[np.newaxis]
+
+        expected = self.server.batcher.detector.inputShape
+        if clips.ndim != 3 or clips.shape[1:] != expected:
+            self.__reply(400, {"error": "wrong shape %s, expected (<nb clip>, %d, %d)" % ((clips.shape,) + expected)})
+            return
+
+        # converted here, a request can't change the dtype of the batch it is gathered in
+        try:
+            events = self.server.batcher.submit(clips.astype(np.float32, copy=False))
+        except Exception as e:
+            self.__reply(500, {"error": str(e)})
+            return
+
+        self.__reply(200, {"events": events})
+
+    def __reply(self, code: int, content: dict):
+        body = json.dumps(content).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class DetectionServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple, batcher: MicroBatcher, verbose: bool = False):
+        super().__init__(address, DetectionHandler)
+        self.batcher = batcher
+        self.verbose = verbose
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", required=True, help="basename of the saved model (see Models.save)")
+    parser.add_argument("--thresholds", help="thresholds of the Binarizer, default <model>_thresholds.json")
+    parser.add_argument("--normalizer", type=str, help="normalizer used for the training (see main.py)")
+    parser.add_argument("--normalizer_stats", help="statistics of the normalizer, default <model>_normalizer.npz")
+    parser.add_argument("--wgru_classes", default="0,2,1", help="classes taken from the WGRU head, if the inference model is built")
+    parser.add_argument("--method", default="threshold", help="localization method of the Encoder")
+    parser.add_argument("--smooth", default="smoothMovingAvg", help="smoothing of the Encoder")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max_batch", type=int, default=32, help="maximum number of clips in a batch")
+    parser.add_argument("--max_latency", type=float, default=20, help="maximum waiting time of a batch (ms)")
+    parser.add_argument("-v", help="log the requests", action="store_true")
+    args = parser.parse_args()
+
+    Binarizer().load(args.thresholds or args.model + "_thresholds.json")
+
+    normalizer = Normalizer.get(args.normalizer)
+    if normalizer is not None:
+        normalizer.load(args.normalizer_stats or args.model + "_normalizer.npz")
+
+    detector = Detector(
+        args.model, normalizer,
+        wgru_classes=[int(c) for c in args.wgru_classes.split(",")],
+        method=args.method, smooth=args.smooth, batch_size=args.max_batch
+    )
+
+    batcher = MicroBatcher(detector, args.max_batch, args.max_latency / 1000)
+    batcher.start()
+
+    server = DetectionServer((args.host, args.port), batcher, args.v)
+    print("Listening on http://%s:%d (POST /detect, GET /health)" % (args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()